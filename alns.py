@@ -0,0 +1,331 @@
+import logging
+import math
+import time
+import numpy as np
+import clarke_wright
+import local_search
+from problem import VRP
+
+
+# loads removed per iteration: this share of the loads, within MIN_DESTROY..MAX_DESTROY
+DESTROY_SHARE = 0.15
+MIN_DESTROY = 4
+MAX_DESTROY = 40
+# worst and related removal pick from their ranking at position len * random()**RANDOMIZATION, so
+# mostly from the top but not always the same loads
+RANDOMIZATION = 3
+# a solution START_WORSE worse than the start is accepted with probability 1/2 at first, the
+# temperature falls exponentially to END_TEMPERATURE_SHARE of that at the deadline
+START_WORSE = 0.003
+END_TEMPERATURE_SHARE = 0.01
+# operator weights are updated every SEGMENT_ITERATIONS iterations from the scores the operators
+# earned: a new best solution, an improvement on the current one, an accepted worse one
+SEGMENT_ITERATIONS = 100
+REACTION = 0.1
+SCORE_BEST, SCORE_BETTER, SCORE_ACCEPTED = 33, 9, 13
+
+
+class ALNSSolver:
+    """
+    Adaptive large neighbourhood search from the clarke and wright solution (or a warm start) until a
+    deadline.
+
+    Every iteration removes a few loads with a destroy operator (random, worst placed, related to one
+    load, whole routes) and puts them back with a repair operator (greedy, regret-2, regret-3 insertion),
+    and simulated annealing decides whether to keep the result. Operators are picked by weights that
+    adapt to how often they found improvements. The solution is the one of a local_search.LocalSearch,
+    whose link index gives the insertion cost of a load at every position in one gather, and only the
+    routes an iteration touched are copied and, when it is rejected, restored. A new best solution gets
+    a local search pass around the loads that moved.
+    """
+    def __init__(self, vrp: VRP, seed=None, time_budget=20.0, deadline=None, ss=None, initial_solution=None,
+                 **solver_args):
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % (1 << 32))
+        self.time_budget = time_budget
+        self.deadline = deadline
+        self.base_solver = clarke_wright.Solver(vrp, ss=ss, initial_solution=initial_solution, **solver_args)
+        self.ss = self.base_solver.ss
+        self.dist_matrix = self.ss.dist_matrix
+        self.destroy_operators = [('random', self.random_removal), ('worst', self.worst_removal),
+                                  ('related', self.related_removal), ('route', self.route_removal)]
+        self.repair_operators = [('greedy', self.greedy_insertion), ('regret2', self.regret_insertion(2)),
+                                 ('regret3', self.regret_insertion(3))]
+        self.alns_stats = {}
+        self.search = None
+        self.rng = None
+
+    @property
+    def stats(self):
+        stats = dict(self.base_solver.stats)
+        stats.update(self.alns_stats)
+        return stats
+
+    def add_stat(self, name, value):
+        self.alns_stats[name] = self.alns_stats.get(name, 0) + value
+
+    def out_of_time(self):
+        # the base solver has the same deadline once solving starts, and the early stop if there is one
+        return self.base_solver.out_of_time()
+
+    def solve(self):
+        solution, cost = None, None
+        for solution, cost in self.solve_anytime():
+            pass
+        return solution, cost
+
+    def solve_anytime(self):
+        """ Generator yielding the start solution and then every new best solution until the deadline """
+        start = time.time()
+        if self.deadline is None:
+            self.deadline = start + self.time_budget
+        self.base_solver.deadline = self.deadline
+        best_solution, best_cost = None, None
+        for best_solution, best_cost in self.base_solver.solve_anytime():
+            yield best_solution, best_cost
+        logging.warning(f"Initial Solution Cost: {best_cost}")
+
+        start = time.time()
+        self.rng = np.random.default_rng(self.seed)
+        self._reset_search(best_solution)
+        num_loads = len(self.dist_matrix) - 1
+        max_destroy = min(num_loads, max(MIN_DESTROY, min(MAX_DESTROY, int(DESTROY_SHARE * num_loads))))
+        if max_destroy == 0:
+            return
+        min_destroy = min(MIN_DESTROY, max_destroy)
+        current_cost = self.search.cost()
+        start_temperature = START_WORSE * current_cost / math.log(2)
+        destroy_weights = np.ones(len(self.destroy_operators))
+        repair_weights = np.ones(len(self.repair_operators))
+        destroy_scores, destroy_uses = np.zeros_like(destroy_weights), np.zeros_like(destroy_weights)
+        repair_scores, repair_uses = np.zeros_like(repair_weights), np.zeros_like(repair_weights)
+        iteration = accepted = 0
+        while not self.out_of_time():
+            iteration += 1
+            elapsed_share = min(1.0, (time.time() - start) / max(self.deadline - start, 1e-9))
+            temperature = start_temperature * END_TEMPERATURE_SHARE ** elapsed_share
+            d = self.rng.choice(len(destroy_weights), p=destroy_weights / destroy_weights.sum())
+            r = self.rng.choice(len(repair_weights), p=repair_weights / repair_weights.sum())
+            destroy_uses[d] += 1
+            repair_uses[r] += 1
+
+            change = Change(self.search)
+            removed = self.destroy_operators[d][1](int(self.rng.integers(min_destroy, max_destroy + 1)))
+            self._remove(removed, change)
+            self.repair_operators[r][1](removed, change)
+            delta = change.cost_delta()
+
+            score = 0
+            if current_cost + delta < best_cost - local_search.IMPROVEMENT_EPS:
+                current_cost = self._improve_around(change)
+                score = SCORE_BEST
+                best_solution = self.search.solution()
+                best_cost = self.base_solver.solution_cost(best_solution)
+                logging.info(f"ALNS iteration {iteration}: {self.destroy_operators[d][0]}/{self.repair_operators[r][0]} "
+                             f"found cost {best_cost}")
+                yield best_solution, best_cost
+            elif delta < -local_search.IMPROVEMENT_EPS:
+                current_cost += delta
+                score = SCORE_BETTER
+            elif self.rng.random() < math.exp(-max(delta, 0.0) / temperature):
+                current_cost += delta
+                score = SCORE_ACCEPTED if delta > local_search.IMPROVEMENT_EPS else 0
+            else:
+                change.rollback()
+            accepted += not change.rolled_back
+            destroy_scores[d] += score
+            repair_scores[r] += score
+            if len(self.search.routes) > 2 * len(best_solution) + 16:
+                # accepted iterations leave emptied routes behind, compact them away now and then
+                self._reset_search(self.search.solution())
+
+            if iteration % SEGMENT_ITERATIONS == 0:
+                for weights, scores, uses in ((destroy_weights, destroy_scores, destroy_uses),
+                                              (repair_weights, repair_scores, repair_uses)):
+                    used = uses > 0
+                    weights[used] = (1 - REACTION) * weights[used] + REACTION * scores[used] / uses[used]
+                    # never let an operator die out completely
+                    np.maximum(weights, 0.01, out=weights)
+                    scores[:] = 0
+                    uses[:] = 0
+
+        self.add_stat('alns_iterations', iteration)
+        self.add_stat('alns_accepted', accepted)
+        self.add_stat('alns_seconds', time.time() - start)
+        logging.info(f"ALNS ran {iteration} iterations in {time.time() - start:.1f}s, seed {self.seed}, weights "
+                     + ", ".join(f"{name} {w:.2f}" for (name, _), w in zip(self.destroy_operators + self.repair_operators,
+                                                                           np.concatenate([destroy_weights, repair_weights]))))
+
+    def _reset_search(self, solution):
+        self.search = self.base_solver.local_search(solution)
+        self.search._index_all_links()
+
+    def _improve_around(self, change):
+        """ Local search pass over the loads in the changed routes, returns the new current cost """
+        loads = [load_id for q in change.touched_routes() if self.search.routes[q] is not None
+                 for load_id in self.search.routes[q][1:-1]]
+        if self.search.improve(loads):
+            self.search._index_all_links()
+        return self.search.cost()
+
+    def _live_loads(self):
+        """ Every load on a route, with its predecessor and successor (the depot at route ends) """
+        search = self.search
+        num_loads = len(self.dist_matrix)
+        valid = search.link_route >= 0
+        link_from, link_to = search.link_from[valid], search.link_to[valid]
+        prev = np.zeros(num_loads, dtype=np.intp)
+        to_load = link_to != search.depot_id
+        prev[link_to[to_load]] = link_from[to_load]
+        loads = np.flatnonzero(valid[:num_loads])
+        return loads, prev[loads], search.link_to[loads]
+
+    def _pick_ranked(self, ranked, count):
+        """ count loads from a best first ranking, mostly near the top """
+        ranked = list(ranked)
+        picked = []
+        while ranked and len(picked) < count:
+            picked.append(ranked.pop(int(len(ranked) * self.rng.random() ** RANDOMIZATION)))
+        return picked
+
+    def random_removal(self, count):
+        loads, _, _ = self._live_loads()
+        return self.rng.choice(loads, min(count, len(loads)), replace=False).tolist()
+
+    def worst_removal(self, count):
+        """ The loads whose removal saves the most distance """
+        d = self.dist_matrix
+        loads, prev, succ = self._live_loads()
+        saving = d[prev, loads] + d[loads, loads] + d[loads, succ] - d[prev, succ]
+        top = min(len(loads), 4 * count)
+        best = np.argpartition(-saving, top - 1)[:top]
+        return self._pick_ranked(loads[best[np.argsort(-saving[best], kind='stable')]].tolist(), count)
+
+    def related_removal(self, count):
+        """ A random load and the loads with the closest pickups and dropoffs to its own """
+        pickups, dropoffs = self.ss.pickups, self.ss.dropoffs
+        loads, _, _ = self._live_loads()
+        seed = loads[self.rng.integers(len(loads))]
+        distance = (np.linalg.norm(pickups[loads] - pickups[seed], axis=1)
+                    + np.linalg.norm(dropoffs[loads] - dropoffs[seed], axis=1))
+        top = min(len(loads), 4 * count)
+        closest = np.argpartition(distance, top - 1)[:top]
+        ranked = loads[closest[np.argsort(distance[closest], kind='stable')]].tolist()
+        # the seed itself ranks first
+        return ranked[:1] + self._pick_ranked(ranked[1:], count - 1)
+
+    def route_removal(self, count):
+        """ Every load of random routes, at least count of them """
+        routes = [route for route in self.search.routes if route is not None]
+        removed = []
+        for r in self.rng.permutation(len(routes)):
+            if len(removed) >= count:
+                break
+            removed.extend(routes[r][1:-1])
+        return removed
+
+    def _remove(self, loads, change):
+        search = self.search
+        num_loads = len(self.dist_matrix)
+        by_route = {}
+        for load_id in loads:
+            by_route.setdefault(search.route_of[load_id], set()).add(load_id)
+        for r, gone in by_route.items():
+            change.touch(r)
+            search.routes[r] = [load_id for load_id in search.routes[r] if load_id not in gone]
+            search._refresh(r)
+            if search.routes[r] is None:
+                search.route_length[r] = 0.0
+                search.link_route[num_loads + r] = -1
+            else:
+                search._index_links(r)
+        for load_id in loads:
+            search.route_of[load_id] = None
+            search.link_route[load_id] = -1
+
+    def _insert(self, load_id, links, deltas, change):
+        """ Insert at the cheapest of the links by deltas (see LocalSearch._insertion_deltas_many), or on a new route """
+        search = self.search
+        best = int(np.argmin(deltas)) if len(deltas) else 0
+        if len(deltas) and deltas[best] < np.inf:
+            change.touch(int(search.link_route[links[best]]))
+            search._insert_after_link(load_id, links[best])
+        else:
+            search._add_route(load_id)
+
+    def greedy_insertion(self, loads, change):
+        """ Each load in random order at its cheapest feasible position """
+        for load_id in self.rng.permutation(loads).tolist():
+            links, deltas = self.search._insertion_deltas_many([load_id])
+            self._insert(load_id, links, deltas[0], change)
+
+    def regret_insertion(self, k):
+        def insert(loads, change):
+            """
+            Repeatedly insert the load with the largest regret: how much more its cheapest positions in
+            its 2nd..k-th best routes cost than in its best one. Loads that fit nowhere go first.
+            """
+            search = self.search
+            d = self.dist_matrix
+            depot_id = search.depot_id
+            pending = np.array(loads, dtype=np.intp)
+            # a missing route option costs as much as a new route
+            new_route = 500 + d[depot_id, pending] + d[pending, pending] + d[pending, depot_id]
+            while len(pending):
+                links, deltas = search._insertion_deltas_many(pending)
+                # cheapest position per route: the links grouped by route, then a minimum per group
+                link_routes = search.link_route[links]
+                order = np.argsort(link_routes, kind='stable')
+                starts = np.flatnonzero(np.diff(link_routes[order], prepend=-1))
+                per_route = np.minimum.reduceat(deltas[:, order], starts, axis=1) if len(links) else deltas
+                costs = np.sort(per_route, axis=1)[:, :k]
+                costs = np.where(costs < np.inf, costs, new_route[:, np.newaxis])
+                regret = (costs[:, 1:] - costs[:, :1]).sum(axis=1)
+                regret[~(per_route < np.inf).any(axis=1)] = np.inf
+                idx = int(np.argmax(regret))
+                self._insert(int(pending[idx]), links, deltas[idx], change)
+                pending = np.delete(pending, idx)
+                new_route = np.delete(new_route, idx)
+        return insert
+
+
+class Change:
+    """ The routes one ALNS iteration touched, as they were before it, to price and roll it back """
+    def __init__(self, search):
+        self.search = search
+        self.num_routes = len(search.routes)
+        self.before = {}
+        self.rolled_back = False
+
+    def touch(self, r):
+        """ Remember route r as it is, before its first change. Routes added by the iteration are new anyway """
+        if r < self.num_routes and r not in self.before:
+            self.before[r] = (list(self.search.routes[r]), self.search.length[r])
+
+    def touched_routes(self):
+        return list(self.before) + list(range(self.num_routes, len(self.search.routes)))
+
+    def cost_delta(self):
+        search = self.search
+        delta = 0.0
+        for r in self.touched_routes():
+            if search.routes[r] is not None:
+                delta += 500 + search.length[r]
+        for route, length in self.before.values():
+            delta -= 500 + length
+        return delta
+
+    def rollback(self):
+        search = self.search
+        num_loads = len(search.dist_matrix)
+        # routes added by the iteration are the last ones
+        for name in ('routes', 'prefix', 'link_fwd', 'link_rev', 'length'):
+            del getattr(search, name)[self.num_routes:]
+        search.link_to = search.link_to[:num_loads + self.num_routes]
+        search.link_from = search.link_from[:num_loads + self.num_routes]
+        search.link_route = search.link_route[:num_loads + self.num_routes]
+        search.route_length = search.route_length[:self.num_routes]
+        for r, (route, _) in self.before.items():
+            search.routes[r] = route
+            search._refresh(r)
+            search._index_links(r)
+        self.rolled_back = True
@@ -0,0 +1,166 @@
+import sys
+import argparse
+import logging
+import multiprocessing
+import os
+import time
+import numpy as np
+import clarke_wright
+import distances
+import utils
+import main
+
+
+# Set up once per worker process by _init_worker: the parsed solver options and the scratch matrix
+_worker_args = None
+_worker_buffer = None
+
+
+class MatrixBuffer:
+    """
+    One distance matrix allocation reused by every problem a process solves. It grows to the largest
+    problem seen, and each problem gets an (n, n) view of its front. Only one problem may use it at a time.
+    """
+    def __init__(self):
+        self.data = np.empty(0)
+
+    def matrix(self, num_loads):
+        if self.data.size < num_loads * num_loads:
+            self.data = np.empty(num_loads * num_loads)
+        return self.data[:num_loads * num_loads].reshape(num_loads, num_loads)
+
+
+def problem_paths(inputs):
+    """
+    The problem files of inputs, files or directories of them (in name order). '-' reads paths from
+    stdin one per line, as they arrive, so a producer can stream problems in while others are solved.
+    """
+    for input_path in inputs:
+        if input_path == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        elif os.path.isdir(input_path):
+            for name in sorted(os.listdir(input_path)):
+                path = os.path.join(input_path, name)
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield input_path
+
+
+def instance_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def solve_file(path, args, buffer=None):
+    """ (solution, cost) for the problem file at path, the matrix built in buffer when it fits the budget """
+    start_time = time.time()
+    with open(path) as f:
+        coordinates = utils.parse_problem_str(f.read(), clarke_wright.DEPOT, 0)
+    num_loads = len(coordinates[0])
+    dist_matrix = None
+    if buffer is not None and distances.dense_matrix_bytes(num_loads) <= main.memory_budget_bytes(args):
+        dist_matrix = utils.create_distance_matrix_from_coordinates(*coordinates, out=buffer.matrix(num_loads))
+    ss = clarke_wright.StaticState(coordinates=coordinates, dist_matrix=dist_matrix,
+                                   memory_budget=main.memory_budget_bytes(args))
+    return main.solve(None, args, start_time, ss=ss, report_gap=False)
+
+
+def _init_worker(args):
+    global _worker_args, _worker_buffer
+    _worker_args = args
+    _worker_buffer = MatrixBuffer()
+
+
+def _worker(path):
+    """ (path, solution, cost, seconds, error) for one problem. A failed problem doesn't end the batch """
+    start = time.time()
+    try:
+        solution, cost = solve_file(path, _worker_args, _worker_buffer)
+        return path, solution, cost, time.time() - start, None
+    except Exception as e:
+        logging.exception(f"Failed to solve {path}")
+        return path, None, None, time.time() - start, str(e)
+
+
+def solve_batch(paths, args, workers=1, chunksize=1):
+    """
+    Solve every problem file of paths with the main.py solver options args, yielding
+    (path, solution, cost, seconds, error) as each one finishes, not in input order.
+
+    With more than one worker the problems go through a process pool. Workers take the next problem
+    (chunksize at a time) whenever they are done with the last, so a slow problem holds up only its own
+    worker. A list of paths is handed out largest file first, so the long problems don't come last.
+    Each process parses the options, imports the solver and allocates its matrix buffer once.
+    """
+    if isinstance(paths, (list, tuple)):
+        paths = sorted(paths, key=os.path.getsize, reverse=True)
+    if workers <= 1:
+        _init_worker(args)
+        yield from map(_worker, paths)
+        return
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(args,)) as pool:
+        yield from pool.imap_unordered(_worker, paths, chunksize=chunksize)
+
+
+def format_result(name, solution, cost, error):
+    """ A '# name cost' header line, then the solution in the main.py output format """
+    if error is not None:
+        return f"# {name} error: {error}\n"
+    return f"# {name} {cost}\n" + main.format_solution(solution)
+
+
+if __name__ == '__main__':
+    start_time = time.time()
+    logging.basicConfig(
+        level=logging.ERROR,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        # stdout carries the solutions
+        handlers=[
+            logging.StreamHandler(sys.stderr)
+        ]
+    )
+    parser = argparse.ArgumentParser(description='Solve many problems in one process or a pool of them, '
+                                                 'streaming out each solution as it is found')
+    parser.add_argument("inputs", nargs='+',
+                        help="problem files or directories of them, '-' reads problem paths from stdin")
+    main.add_solver_arguments(parser)
+    parser.add_argument("--chunksize", required=False, type=int, default=1,
+                        help='problems a worker takes at a time, more lowers the hand out overhead on tiny problems')
+    parser.add_argument("--output-dir", dest='output_dir', required=False,
+                        help='also write each solution to <instance name>.txt here, in the main.py output format')
+    parser.add_argument("--stats-file", dest='stats_file', required=False,
+                        help='write the batch totals and throughput to this file as json')
+    args = parser.parse_args()
+    if args.output_dir:
+        os.makedirs(args.output_dir, exist_ok=True)
+
+    paths = problem_paths(args.inputs)
+    if '-' not in args.inputs:
+        paths = list(paths)
+    solved, failed, total_cost = 0, 0, 0.0
+    # --workers spreads the problems, each problem is solved in a single process (pool workers can't fork)
+    solver_args = argparse.Namespace(**{**vars(args), 'workers': 1})
+    for path, solution, cost, seconds, error in solve_batch(paths, solver_args, args.workers, args.chunksize):
+        name = instance_name(path)
+        sys.stdout.write(format_result(name, solution, cost, error))
+        sys.stdout.flush()
+        if error is not None:
+            failed += 1
+            continue
+        solved += 1
+        total_cost += cost
+        if args.output_dir:
+            with open(os.path.join(args.output_dir, name + ".txt"), "w") as f:
+                f.write(main.format_solution(solution))
+
+    seconds = time.time() - start_time
+    throughput = (solved + failed) / seconds if seconds > 0 else 0.0
+    print(f"{solved} problems solved, {failed} failed in {seconds:.3f}s: {throughput:.1f} problems/s",
+          file=sys.stderr)
+    if args.stats_file:
+        import json
+        with open(args.stats_file, "w") as f:
+            json.dump({'problems': solved, 'failed': failed, 'total_cost': total_cost, 'total_seconds': seconds,
+                       'problems_per_second': throughput}, f)
@@ -0,0 +1,160 @@
+import math
+import time
+import numpy as np
+
+
+# entries of the distance matrix per block of rows the bounds read at a time
+BLOCK_ELEMENTS = 1 << 22
+# minutes of rounding slack before the driver bound asks for one more driver
+DRIVER_EPS = 1e-6
+
+
+class LowerBound:
+    """
+    Lower bounds on any solution of a problem, see lower_bound: minutes driven, drivers needed and the
+    cost, 500 * drivers + minutes
+    """
+    def __init__(self, minutes, drivers, distance_constraint):
+        self.minutes = minutes
+        self.drivers = drivers
+        self.distance_constraint = distance_constraint
+        self.cost = 500 * drivers + minutes
+
+    def __str__(self):
+        return f"LowerBound(cost={self.cost:.1f}, drivers={self.drivers}, minutes={self.minutes:.1f})"
+
+    def gap(self, cost):
+        """ How far cost is above the bound, as a share of cost """
+        return (cost - self.cost) / cost if cost > 0 else 0.0
+
+
+def lower_bound(ss):
+    """
+    Fast lower bounds from the distance matrix of a clarke_wright.StaticState.
+
+    Minutes: every load is driven from pickup to dropoff, reached from the depot or another load's
+    dropoff and left towards the depot or another load's pickup. Picking a predecessor and a successor
+    per load is an assignment problem (routes relaxed to any set of paths and cycles), bounded from
+    below by a feasible dual: each load's cheapest incoming leg, then each load's cheapest outgoing leg
+    less what the incoming legs already paid, or the other way round. Every driver leaves the depot,
+    so the second order also prices the depot legs up to the best lagrangian multiplier for that.
+
+    Drivers: no route drives more than the distance constraint, so at least minutes / 720 of them, and
+    at least as many as a set of loads no two of which fit in one route (see _incompatible_loads).
+
+    Reads the matrix a block of rows at a time, so a distances.LazyDistances costs O(n^2) time but no
+    more memory than its blocks.
+    """
+    dist = ss.dist_matrix
+    depot_id = ss.depot_id
+    n = len(dist)
+    if n <= 1:
+        return LowerBound(0.0, 0, ss.distance_constraint)
+    loads = np.arange(1, n)
+    block_rows = max(1, BLOCK_ELEMENTS // n)
+
+    def blocks():
+        """ (load ids, their rows of the matrix with the load itself excluded as its own neighbour) """
+        for start in range(1, n, block_rows):
+            rows = loads[start - 1:start - 1 + block_rows]
+            block = np.array(dist[rows[0]:rows[-1] + 1, :], dtype=np.float64)
+            block[np.arange(len(rows)), rows] = np.inf
+            yield rows, block
+
+    depot_row = np.asarray(dist[depot_id, 1:], dtype=np.float64)
+    # first pass: cheapest incoming leg of each load from another load, cheapest outgoing leg of each load
+    cheapest_in = np.full(n - 1, np.inf)
+    outgoing = np.empty(n - 1)
+    for rows, block in blocks():
+        np.minimum(cheapest_in, block[:, 1:].min(axis=0), out=cheapest_in)
+        outgoing[rows - 1] = block.min(axis=1)
+    incoming = np.minimum(cheapest_in, depot_row)
+
+    # second pass: the other side of each dual, priced by the legs the first side already paid
+    outgoing_rest = np.empty(n - 1)
+    incoming_rest = np.full(n - 1, np.inf)
+    for rows, block in blocks():
+        outgoing_rest[rows - 1] = np.minimum(block[:, depot_id], (block[:, 1:] - incoming).min(axis=1))
+        np.minimum(incoming_rest, (block[:, 1:] - outgoing[rows - 1, np.newaxis]).min(axis=0), out=incoming_rest)
+
+    mandatory = float(np.asarray(dist[loads, loads]).sum())
+    in_then_out = incoming.sum() + outgoing_rest.sum()
+    # with a multiplier on "at least drivers depot legs" the depot legs get cheaper by it and the
+    # bound gains it once per driver; the best one is where the drivers'th load turns to the depot
+    depot_premium = np.sort(depot_row - incoming_rest)
+
+    def minutes_for(drivers):
+        multiplier = max(0.0, depot_premium[min(drivers, len(depot_premium)) - 1])
+        out_then_in = outgoing.sum() + np.minimum(depot_row - multiplier, incoming_rest).sum() + multiplier * drivers
+        return mandatory + max(in_then_out, out_then_in)
+
+    drivers = max(1, len(_incompatible_loads(ss)))
+    minutes = minutes_for(drivers)
+    while math.ceil(minutes / ss.distance_constraint - DRIVER_EPS) > drivers:
+        drivers = math.ceil(minutes / ss.distance_constraint - DRIVER_EPS)
+        minutes = minutes_for(drivers)
+    return LowerBound(float(minutes), drivers, ss.distance_constraint)
+
+
+def _incompatible_loads(ss, batch=256):
+    """
+    Loads no two of which fit in one route: the shortest route through both, depot to the one, to the
+    other, back to the depot (the triangle inequality makes any other route with both longer), is over
+    the distance constraint. Greedy, loads with the longest route of their own first. Candidates are
+    checked against the loads chosen so far a batch at a time, and only the survivors one by one.
+    """
+    dist = ss.dist_matrix
+    limit = ss.distance_constraint
+    loads = np.arange(1, len(dist))
+    own = np.asarray(dist[loads, loads], dtype=np.float64)
+    leave = np.asarray(dist[ss.depot_id, loads], dtype=np.float64) + own
+    back = own + np.asarray(dist[loads, ss.depot_id], dtype=np.float64)
+
+    def fits(i, others):
+        """ For load indexes i and others (broadcast), whether some route serves both """
+        i_first = leave[i] + np.asarray(dist[loads[i], loads[others]]) + back[others]
+        i_last = leave[others] + np.asarray(dist[loads[others], loads[i]]) + back[i]
+        return np.minimum(i_first, i_last) <= limit
+
+    chosen = np.empty(0, dtype=np.intp)
+    order = np.argsort(-(leave + back), kind='stable')
+    for start in range(0, len(order), batch):
+        candidates = order[start:start + batch]
+        if len(chosen):
+            candidates = candidates[~fits(candidates[:, np.newaxis], chosen[np.newaxis, :]).any(axis=1)]
+        for i in candidates:
+            if not fits(np.full(len(chosen), i), chosen).any():
+                chosen = np.append(chosen, i)
+    return loads[chosen].tolist()
+
+
+class EarlyStop:
+    """
+    Stops a solve before its deadline once the best cost is within target_gap of the lower bound, or
+    nothing improved for stall_seconds. The caller reports every new best cost with improved; solvers
+    check should_stop along with their deadline. Neither rule fires before the first cost is in.
+    """
+    def __init__(self, bound: LowerBound, target_gap=None, stall_seconds=None):
+        self.bound = bound
+        self.target_gap = target_gap
+        self.stall_seconds = stall_seconds
+        self.best_cost = None
+        self.last_improvement = None
+        # why should_stop first returned True: 'gap' or 'stall'
+        self.reason = None
+
+    def improved(self, cost):
+        if self.best_cost is None or cost < self.best_cost:
+            self.best_cost = cost
+            self.last_improvement = time.time()
+
+    def should_stop(self):
+        if self.reason is not None:
+            return True
+        if self.best_cost is None:
+            return False
+        if self.target_gap is not None and self.bound.gap(self.best_cost) <= self.target_gap:
+            self.reason = 'gap'
+        elif self.stall_seconds is not None and time.time() - self.last_improvement >= self.stall_seconds:
+            self.reason = 'stall'
+        return self.reason is not None
@@ -1,196 +1,393 @@
-from collections import deque
 import logging
-from evaluateShared import Point, VRP
+import sys
+from problem import Point, VRP
 import utils
+import distances
+import spatial
+import local_search
+import profiling
+from routes import Routes, FREE
 import numpy as np
-
-
-class LoadSaving:
-    """ Cost savings representation for clarke and wright algorithm """
-    def __init__(self, current_load_id, next_load_id, savings):
-        self.current_load_id = current_load_id
-        self.next_load_id = next_load_id
+import time
+
+# savings pairs the merge pass filters at once (see MergeFilter) and checks the deadline between. The
+# chunks double up to MAX_MERGE_CHUNK while few of their pairs survive
+MIN_MERGE_CHUNK = 1024
+MAX_MERGE_CHUNK = 1 << 16
+# slack of the vectorized distance check, so that rounding never drops a pair can_link would accept
+FILTER_DISTANCE_SLACK = 1e-6
+# peak bytes per pair of the full savings list: the pair ids and savings, plus the sort's temporaries
+SAVINGS_BYTES_PER_PAIR = 48
+# k nearest pickups per load when the full savings list is over the memory budget
+MAX_FALLBACK_SAVINGS_NEIGHBOURS = 64
+
+
+class SavingsList:
+    """
+    Cost savings for the clarke and wright algorithm, stored as parallel arrays of
+    (current_load_id, next_load_id, savings) rather than one object per pair.
+    """
+    def __init__(self, current_load_ids, next_load_ids, savings):
+        self.current_load_ids = current_load_ids
+        self.next_load_ids = next_load_ids
         self.savings = savings
 
+    def __len__(self):
+        return len(self.savings)
+
     def __str__(self):
-        return f"S({self.current_load_id},{self.next_load_id}): {self.savings}"
+        return f"SavingsList({len(self)} pairs)"
 
+    def _reorder(self, order):
+        self.current_load_ids = self.current_load_ids[order]
+        self.next_load_ids = self.next_load_ids[order]
+        self.savings = self.savings[order]
 
-class StaticState:
-    """ Read only state to pass around """
-    def __init__(self, vrp: VRP):
-        self.vrp = vrp
-        self.distance_constraint = 12 * 60
-        depot = Point(0.0, 0.0)
-        self.depot_id = 0
-        self.dist_matrix = utils.create_distance_matrix(self.vrp, depot, self.depot_id)
+    def sort(self):
+        """ Sort by descending savings. Stable, so ties keep their generation order """
+        self._reorder(np.argsort(-self.savings, kind='stable'))
 
+    def random_swap(self, random_swap_factor, rng=np.random):
+        """
+        Walk the list and swap each item with its successor with probability random_swap_factor.
 
-class Truck:
-    """ Represents a truck and its schedule/route """
-    def __init__(self, ss: StaticState, load_id):
-        self.ss = ss
-        self.dist_matrix = ss.dist_matrix
-        self.depot_id = ss.depot_id
-
-        self.current_distance = (self.dist_matrix[self.depot_id, load_id]
-                                + self.dist_matrix[load_id, load_id]
-                                + self.dist_matrix[load_id, self.depot_id])
-        self.load_ids = deque()
-        self.load_ids.append(load_id)
+        Done as a single permutation: a run of swaps at positions a..b moves item a to b+1 and shifts
+        a+1..b+1 left by one, exactly as the sequential walk would.
+        """
+        n = len(self)
+        if n < 2:
+            return
+        swapped = rng.random(n - 1) < random_swap_factor
+        swap_positions = np.arange(n - 1)
+        order = np.arange(n)
+        # inside a run: take the successor
+        order[:-1][swapped] = swap_positions[swapped] + 1
+        # just after a run: take the item that started it
+        starts_run = np.ones(n - 1, dtype=bool)
+        starts_run[1:] = ~swapped[:-1]
+        run_start = np.maximum.accumulate(np.where(starts_run, swap_positions, 0))
+        ends_run = swapped & np.append(~swapped[1:], True)
+        order[swap_positions[ends_run] + 1] = run_start[ends_run]
+        self._reorder(order)
+
+    def copy(self):
+        """ Shallow copy. Reordering always builds new arrays, so the copies never write into each other """
+        return SavingsList(self.current_load_ids, self.next_load_ids, self.savings)
+
+
+class MergeFilter:
+    """
+    Drops the savings pairs the merge pass would reject, a chunk at a time, from numpy views of the
+    arrays of the Routes under construction. A pair (i, j) is dead when i is on a route it doesn't end,
+    j is on a route it doesn't start, i and j end and start the same route, or the joined route would
+    be over the distance constraint. Routes only grow during construction, so a dead pair stays dead
+    and dropping it early leaves the result as it was; the survivors still get the checks one by one.
+    """
+    def __init__(self, routes: Routes):
+        self.depot_id = routes.depot_id
+        self.limit = routes.distance_constraint + FILTER_DISTANCE_SLACK
+        # views, they follow every link the merge pass makes
+        self.succ = np.frombuffer(routes.succ, dtype='l')
+        self.pred = np.frombuffer(routes.pred, dtype='l')
+        self.other_end = np.frombuffer(routes.other_end, dtype='l')
+        self.distance = np.frombuffer(routes.distance, dtype=np.float64)
+        dist = routes.dist_matrix
+        load_ids = np.arange(len(dist))
+        depot_ids = np.full(len(dist), self.depot_id)
+        self.single = (np.asarray(dist[depot_ids, load_ids]) + np.asarray(dist[load_ids, load_ids])
+                       + np.asarray(dist[load_ids, depot_ids]))
+
+    def live(self, current_load_ids, next_load_ids, savings):
+        """ The pairs that may still link, as lists of python ints """
+        depot_id = self.depot_id
+        # free loads have the depot on both sides too
+        keep = (self.succ[current_load_ids] == depot_id) & (self.pred[next_load_ids] == depot_id)
+        first = self.other_end[current_load_ids]
+        keep &= first != next_load_ids
+        tail_distance = np.where(first == FREE, self.single[current_load_ids], self.distance[first])
+        head_distance = np.where(self.other_end[next_load_ids] == FREE, self.single[next_load_ids],
+                                 self.distance[next_load_ids])
+        # the joined distance of Routes.linked_distance, with the saving standing in for the depot legs
+        keep &= tail_distance + head_distance - savings <= self.limit
+        return current_load_ids[keep].tolist(), next_load_ids[keep].tolist()
+
+
+DEPOT = Point(0.0, 0.0)
 
-    def __str__(self):
-        return str(f"Current Dist: {self.current_distance}. Loads: {self.load_ids}")
-
-    def _new_add_right_dist(self, load_id):
-        curr_last_load_id = self.load_ids[-1]
-        return (self.current_distance
-                + (-1.0 * self.dist_matrix[curr_last_load_id, self.depot_id])
-                + self.dist_matrix[curr_last_load_id, load_id]
-                + self.dist_matrix[load_id, load_id]
-                + self.dist_matrix[load_id, self.depot_id])
-
-    def _new_add_left_dist(self, load_id):
-        curr_first_load_id = self.load_ids[0]
-        return (self.current_distance
-                + (-1.0 * self.dist_matrix[self.depot_id, curr_first_load_id])
-                + self.dist_matrix[self.depot_id, load_id]
-                + self.dist_matrix[load_id, load_id]
-                + self.dist_matrix[load_id, curr_first_load_id])
-
-    def add_load_right(self, load_id):
-        """ Add load to end of this truck's route """
-        new_dist = self._new_add_right_dist(load_id)
-        if new_dist > self.ss.distance_constraint:
-            raise Exception(f"Code error: Invalid truck when adding: {load_id}. new_dist: {new_dist}, current_distance: {self.current_distance}")
-        self.current_distance = new_dist
-        self.load_ids.append(load_id)
-
-    def can_link_right(self, load_id):
-        """ Check if this truck can add this load at the end of its route """
-        new_dist = self._new_add_right_dist(load_id)
-        return new_dist <= self.ss.distance_constraint
-
-    def add_load_left(self, load_id):
-        """ Add load to start of this truck's route """
-        new_dist = self._new_add_left_dist(load_id)
-        if new_dist > self.ss.distance_constraint:
-            raise Exception(f"Code error: Invalid truck when adding: {load_id}. new_dist: {new_dist}, current_distance: {self.current_distance}")
-        self.current_distance = new_dist
-        self.load_ids.appendleft(load_id)
-
-    def can_link_left(self, load_id):
-        """ Check if this truck can add this load at the start of its route """
-        new_dist = self._new_add_left_dist(load_id)
-        return new_dist <= self.ss.distance_constraint
-
-    def starting_load_id(self):
-        return self.load_ids[0]
-
-    def finishing_load_id(self):
-        return self.load_ids[-1]
-
-    def can_merge(self, truck):
-        """ Check if the given truck's route can be merged with this one """
-        curr_last_load_id = self.load_ids[-1]
-        next_truck_first_load_id = truck.load_ids[0]
-        merged_dist = (((self.current_distance
-                       + (-1.0 * self.dist_matrix[curr_last_load_id, self.depot_id]))
-                       + truck.current_distance)
-                       + (-1.0 * self.dist_matrix[self.depot_id, next_truck_first_load_id])
-                       + self.dist_matrix[curr_last_load_id, next_truck_first_load_id])
-        logging.debug(f"Checking for merge. Two total distances: {self.current_distance}, {truck.current_distance}. Merged: {merged_dist}")
-        if merged_dist <= self.ss.distance_constraint:
-            return True
-        return False
 
-    def merge(self, truck):
-        """ Merge the given truck's route into this one """
-        for load_id in truck.load_ids:
-            self.add_load_right(load_id)
+class StaticState:
+    """
+    Read only state to pass around. Built from a VRP, or from the (pickups, dropoffs) coordinate arrays
+    of utils.parse_problem_str, optionally with an already computed distance matrix (see problem_cache).
+    dist_matrix is a dense array, or a distances.LazyDistances when that would not fit memory_budget
+    """
+    def __init__(self, vrp: VRP = None, coordinates=None, dist_matrix=None,
+                 memory_budget=distances.DEFAULT_MEMORY_BUDGET):
+        start = time.time()
+        self.vrp = vrp
+        self.distance_constraint = 12 * 60
+        self.depot_id = 0
+        # bytes the distance matrix and the savings list may take, see distances.create_distances
+        self.memory_budget = memory_budget
+        if coordinates is None:
+            coordinates = utils.load_coordinates(self.vrp, DEPOT, self.depot_id)
+        self.pickups, self.dropoffs = coordinates
+        if dist_matrix is None:
+            dist_matrix = distances.create_distances(self.pickups, self.dropoffs, self.depot_id, memory_budget)
+        self.dist_matrix = dist_matrix
+        self.build_seconds = time.time() - start
 
 
 class Solver:
-    def __init__(self, vrp: VRP, random_swap_factor=None, local_search_iterations=None):
+    def __init__(self, vrp: VRP, random_swap_factor=None, local_search_iterations=None,
+                 sparse_savings=False, savings_neighbours=None, ss: StaticState = None, deadline=None,
+                 local_search_neighbours=20, best_improvement=False, route_elimination=False,
+                 initial_solution=None, instrument=False, early_stop=None, savings_from=None):
         self.vrp = vrp
-        self.ss = StaticState(vrp)
+        # per phase timings and counters, seconds are summed over every run of this solver
+        self.stats = {}
+        # opt in to the counters and memory high water marks of the profiling module, see add_time
+        self.instrument = instrument
+        # a prebuilt StaticState can be shared between solvers for the same problem
+        if ss is None:
+            ss = StaticState(vrp)
+            self.stats['matrix_seconds'] = ss.build_seconds
+        self.ss = ss
         self.depot_id = self.ss.depot_id
         self.dist_matrix = self.ss.dist_matrix
         self.random_swap_factor = random_swap_factor
         self.local_search_iterations = local_search_iterations
-        logging.debug("distance matrix: \n" + str(self.dist_matrix))
+        self.local_search_neighbours = local_search_neighbours
+        self.best_improvement = best_improvement
+        self.route_elimination = route_elimination
+        self.sparse_savings = sparse_savings or savings_neighbours is not None
+        self.savings_neighbours = savings_neighbours
+        self._sorted_savings = None
+        # another Solver of the same problem whose sorted savings this one uses instead of building its own
+        self.savings_from = savings_from
+        # prior schedules to improve instead of constructing, see warm_start
+        self.initial_solution = initial_solution
+        # wall clock time (as in time.time()) that construction and local search stop at
+        self.deadline = deadline
+        # a bounds.EarlyStop that can end them before the deadline
+        self.early_stop = early_stop
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("distance matrix: \n" + str(self.dist_matrix))
+
+    def solve(self, rng=np.random):
+        solution, cost = None, None
+        for solution, cost in self.solve_anytime(rng):
+            pass
+        return solution, cost
 
-    def solve(self):
-        trucks, truck_by_load = self.run_clarke_wright()
-        if self.local_search_iterations:
-            for i in range(self.local_search_iterations):
-                self.local_search_improvement(trucks, truck_by_load)
+    def solve_anytime(self, rng=np.random):
+        """
+        Generator yielding each improved (solution, cost) until the work is done or the deadline passes.
 
-        solution = [list(truck.load_ids) for truck in trucks]
+        The first yield is the clarke and wright construction, or the initial solution made to fit the
+        problem (see warm_start). It is always a complete solution: at the deadline construction stops
+        merging and gives any unassigned loads their own truck.
+        """
+        if self.initial_solution is not None:
+            routes = self.warm_start(self.initial_solution)
+            best_solution = routes
+        else:
+            routes = self.run_clarke_wright(rng)
+            best_solution = routes.schedules()
+        best_cost = self.solution_cost(routes)
+        yield best_solution, best_cost
+
+        search = None
+        if self.route_elimination:
+            start = time.time()
+            search = self.local_search(routes)
+            removed = search.eliminate_routes()
+            self.add_stat('drivers_removed', removed)
+            self.add_time('route_elimination', start)
+            logging.info(f"Route elimination removed {removed} drivers in {time.time() - start:.3f}s")
+            if removed:
+                best_solution = search.solution()
+                best_cost = self.solution_cost(best_solution)
+                yield best_solution, best_cost
+
+        passes = self.local_search_iterations
+        if passes is None and self.initial_solution is not None:
+            # nothing was constructed, so the time goes to local search until it stops improving
+            passes = sys.maxsize
+        if passes:
+            start = time.time()
+            search = search or self.local_search(routes)
+            for i in range(passes):
+                improved = not self.out_of_time() and search.improve()
+                self.add_time('local_search', start)
+                if not improved:
+                    break
+                start = time.time()
+                solution = search.solution()
+                cost = self.solution_cost(solution)
+                if cost < best_cost:
+                    best_solution, best_cost = solution, cost
+                    yield best_solution, best_cost
+
+        if search is not None and self.instrument:
+            self.add_stat('moves_evaluated', search.moves_evaluated)
+            self.add_stat('moves_applied', search.moves_applied)
+
+    def add_stat(self, name, value):
+        self.stats[name] = self.stats.get(name, 0) + value
+
+    def add_time(self, phase, start):
+        self.add_stat(phase + '_seconds', time.time() - start)
+        if self.instrument:
+            # the process' peak so far, so the first phase whose mark jumps is the one that allocated
+            self.stats[phase + '_peak_rss_mb'] = profiling.peak_rss_mb()
+
+    def local_search(self, solution):
+        """ Local search engine over the given schedules or Routes, see local_search.LocalSearch for the moves """
+        return local_search.LocalSearch(self.ss, solution, neighbours=self.local_search_neighbours,
+                                        best_improvement=self.best_improvement, out_of_time=self.out_of_time)
+
+    def solution_cost(self, solution):
+        """ Validated cost of a list of schedules or a Routes """
         expected_loads = len(self.dist_matrix) - 1
-        cost = utils.get_solution_cost(solution, self.dist_matrix, expected_loads)
-        return solution, cost
+        if isinstance(solution, Routes):
+            return utils.get_routes_cost(solution, expected_loads)
+        return utils.get_solution_cost(solution, self.dist_matrix, expected_loads)
 
-    def run_clarke_wright(self):
-        trucks = []
-        truck_by_load: dict = {}
+    def out_of_time(self):
+        if self.early_stop is not None and self.early_stop.should_stop():
+            return True
+        return self.deadline is not None and time.time() >= self.deadline
 
-        savings_list = self.create_savings()
-        savings_list.sort(key=lambda x: x.savings, reverse=True)
+    def sorted_savings(self):
+        """
+        The sorted savings list, built on first use and reused by every later run of this solver, or
+        the list of savings_from. Runs copy it before changing it, so sharing it is safe.
+        """
+        if self.savings_from is not None:
+            return self.savings_from.sorted_savings()
+        if self._sorted_savings is None:
+            start = time.time()
+            self._sorted_savings = self.create_savings()
+            self.add_time('savings', start)
+            start = time.time()
+            self._sorted_savings.sort()
+            self.add_time('sort', start)
+        return self._sorted_savings
+
+    def warm_start(self, schedules):
+        """
+        Schedules from a prior solution (say yesterday's plan, see utils.parse_solution_str) made to fit
+        this problem: unknown and repeated load ids are dropped, a route is cut wherever the next load
+        would take it over the distance constraint, and loads the solution misses are inserted at their
+        cheapest feasible positions.
+        """
+        start = time.time()
+        num_loads = len(self.dist_matrix) - 1
+        routes = Routes(self.ss)
+        dropped = 0
+        for schedule in schedules:
+            tail = None
+            for load_id in schedule:
+                if not 0 < load_id <= num_loads or not routes.is_free(load_id):
+                    dropped += 1
+                elif tail is not None and routes.can_link(tail, load_id):
+                    routes.link(tail, load_id)
+                    tail = load_id
+                else:
+                    routes.start_route(load_id)
+                    tail = load_id
+        missing = [load_id for load_id in range(1, num_loads + 1) if routes.is_free(load_id)]
+        solution = routes.schedules()
+        if missing:
+            search = self.local_search(solution)
+            search.insert_loads(missing)
+            solution = search.solution()
+        self.add_time('warm_start', start)
+        if dropped or missing:
+            logging.warning(f"Initial solution: dropped {dropped} unknown or repeated loads, inserted {len(missing)} missing loads")
+        logging.info(f"Initial solution has {len(solution)} routes, {len(schedules)} given")
+        return solution
+
+    def run_clarke_wright(self, rng=np.random):
+        routes = profiling.CountingRoutes(self.ss, self.add_stat) if self.instrument else Routes(self.ss)
+
+        savings_list = self.sorted_savings()
         if self.random_swap_factor is not None:
-            for i in range(len(savings_list)-1):
-                # randomly decide to swap savings items
-                if np.random.rand() < self.random_swap_factor:
-                    savings_list[i], savings_list[i+1] = savings_list[i+1], savings_list[i]
-
-        for s in savings_list:
-            curr_truck = truck_by_load.get(s.current_load_id)
-            next_truck = truck_by_load.get(s.next_load_id)
-            if not curr_truck and not next_truck:
-                # Neither load is claimed so try to assign a new truck
-                new_truck = Truck(self.ss, s.current_load_id)
-                if new_truck.can_link_right(s.next_load_id):
-                    new_truck.add_load_right(s.next_load_id)
-                    truck_by_load[s.current_load_id] = new_truck
-                    truck_by_load[s.next_load_id] = new_truck
-                    trucks.append(new_truck)
-                    logging.info(f"Bootstrapped Truck with loads: {s.current_load_id}, {s.next_load_id}. Dist: {new_truck.current_distance}")
+            # randomly decide to swap savings items
+            start = time.time()
+            savings_list = savings_list.copy()
+            savings_list.random_swap(self.random_swap_factor, rng)
+            self.add_time('random_swap', start)
+
+        start = time.time()
+        # the messages below are only formatted when info logging is on
+        verbose = logging.getLogger().isEnabledFor(logging.INFO)
+
+        # hot loop, so look the arrays up once. A load is free until it is on a route, and a load on a
+        # route ends it when its successor is the depot (starts it when its predecessor is)
+        other_end, succ, pred = routes.other_end, routes.succ, routes.pred
+        depot_id = self.depot_id
+        merge_filter = MergeFilter(routes)
+        chunk_size, chunk_start, skipped = MIN_MERGE_CHUNK, 0, 0
+        while chunk_start < len(savings_list):
+            if self.out_of_time():
+                logging.warning(f"Deadline reached after {chunk_start} of {len(savings_list)} savings")
+                break
+            chunk = slice(chunk_start, chunk_start + chunk_size)
+            current_load_ids, next_load_ids = merge_filter.live(savings_list.current_load_ids[chunk],
+                                                                savings_list.next_load_ids[chunk],
+                                                                savings_list.savings[chunk])
+            chunk_length = min(chunk_size, len(savings_list) - chunk_start)
+            skipped += chunk_length - len(current_load_ids)
+            chunk_start += chunk_size
+            if len(current_load_ids) * 4 < chunk_length:
+                chunk_size = min(MAX_MERGE_CHUNK, chunk_size * 2)
+            for current_load_id, next_load_id in zip(current_load_ids, next_load_ids):
+                curr_free = other_end[current_load_id] == FREE
+                next_free = other_end[next_load_id] == FREE
+                if curr_free and next_free:
+                    # Neither load is claimed so try to assign a new truck
+                    if routes.can_link(current_load_id, next_load_id):
+                        routes.link(current_load_id, next_load_id)
+                        if verbose:
+                            logging.info(f"Bootstrapped Truck with loads: {current_load_id}, {next_load_id}. Dist: {routes.distance[current_load_id]}")
+                    elif verbose:
+                        logging.info(f"Cant bootstrap new Truck with loads: {current_load_id}, {next_load_id}")
+                elif next_free:
+                    # One truck has the curr/first load,
+                    #  if it can extend its route to handle the next load in the savings, do so
+                    if succ[current_load_id] == depot_id and routes.can_link(current_load_id, next_load_id):
+                        routes.link(current_load_id, next_load_id)
+                        if verbose:
+                            logging.info(f"Extended Truck route with loads: {current_load_id}, {next_load_id}")
+                elif curr_free:
+                    # One truck has the next/last load in the savings,
+                    # if it can prepend its route to handle the first load in the savings, do so
+                    if pred[next_load_id] == depot_id and routes.can_link(current_load_id, next_load_id):
+                        routes.link(current_load_id, next_load_id)
+                        if verbose:
+                            logging.info(f"Prepended Truck route with loads: {current_load_id}, {next_load_id}")
                 else:
-                    logging.info(f"Cant bootstrap new Truck with loads: {s.current_load_id}, {s.next_load_id}")
-            elif curr_truck and not next_truck:
-                # One truck has the curr/first load,
-                #  if it can extend its route to handle the next load in the savings, do so
-                if curr_truck.finishing_load_id() == s.current_load_id and curr_truck.can_link_right(s.next_load_id):
-                    curr_truck.add_load_right(s.next_load_id)
-                    truck_by_load[s.next_load_id] = curr_truck
-                    logging.info(f"Extended Truck route with loads: {s.current_load_id}, {s.next_load_id}. Dist: {curr_truck.current_distance}")
-            elif not curr_truck and next_truck:
-                # One truck has the next/last load in the savings,
-                # if it can prepend its route to handle the first load in the savings, do so
-                if next_truck.starting_load_id() == s.next_load_id and next_truck.can_link_left(s.current_load_id):
-                    next_truck.add_load_left(s.current_load_id)
-                    truck_by_load[s.current_load_id] = next_truck
-                    logging.info(f"Prepended Truck route with loads: {s.current_load_id}, {s.next_load_id}. Dist: {next_truck.current_distance}")
-            else:
-                # Both loads have already been assigned. See if we can merge truck routes
-                #  Can only do this for S(i,j) if i is ending the route and j is starting the route
-                if curr_truck != next_truck and curr_truck.finishing_load_id() == s.current_load_id and next_truck.starting_load_id() == s.next_load_id:
-                    if curr_truck.can_merge(next_truck):
-                        logging.info(f"Merging the Truck ending with load: {s.current_load_id} with the one starting with: {s.next_load_id}")
-                        for load_id in next_truck.load_ids:
-                            truck_by_load[load_id] = curr_truck
-                        curr_truck.merge(next_truck)
-                        trucks.remove(next_truck)
+                    # Both loads have already been assigned. See if we can merge truck routes
+                    #  Can only do this for S(i,j) if i is ending the route and j is starting the route
+                    if (succ[current_load_id] == depot_id and pred[next_load_id] == depot_id
+                            and other_end[current_load_id] != next_load_id):
+                        if routes.can_link(current_load_id, next_load_id):
+                            if verbose:
+                                logging.info(f"Merging the Truck ending with load: {current_load_id} with the one starting with: {next_load_id}")
+                            routes.link(current_load_id, next_load_id)
 
         # Find loads that have not been assigned and create single routes
         for load_id in range(1, len(self.dist_matrix)):
-            if load_id not in truck_by_load:
-                new_truck = Truck(self.ss, load_id)
-                trucks.append(new_truck)
-                truck_by_load[load_id] = new_truck
-                logging.warning(f"Bootstrapped Truck with single load: {load_id}, distance: {new_truck.current_distance}")
+            if other_end[load_id] == FREE:
+                routes.start_route(load_id)
+                logging.warning(f"Bootstrapped Truck with single load: {load_id}, distance: {routes.distance[load_id]}")
 
-        return trucks, truck_by_load
+        if self.instrument:
+            self.add_stat('merge_pairs_skipped', skipped)
+        self.add_time('merge', start)
+        return routes
 
     def create_savings(self):
         """
@@ -203,68 +400,77 @@ class Solver:
                                (d(D, i_p) + d(i_p, i_d) + d(i_d, j_p) + d(j_p, j_d) + d(j_d, D))
         Simplifies to: S(i,j) = d(i_d, D) + d(D, j_p) - d(i_d, j_p)
         """
-        savings_list = []
         num_loads = len(self.dist_matrix)
-        for i in range(1, num_loads):
-            for j in range(1, num_loads):
-                if i == j:
-                    continue
-                savings = self.dist_matrix[i, self.depot_id] + self.dist_matrix[self.depot_id, j] - self.dist_matrix[i, j]
-                savings_list.append(LoadSaving(i, j, savings))
-
-        return savings_list
-
-    def local_search_improvement(self, trucks, truck_by_load):
+        sparse_savings, savings_neighbours = self.sparse_savings, self.savings_neighbours
+        if not sparse_savings and (num_loads - 1) * (num_loads - 2) * SAVINGS_BYTES_PER_PAIR > self.ss.memory_budget:
+            # the radius alone keeps most pairs for the usual problems, so bound the neighbours as well
+            sparse_savings = True
+            savings_neighbours = int(min(MAX_FALLBACK_SAVINGS_NEIGHBOURS,
+                                         max(1, self.ss.memory_budget // (SAVINGS_BYTES_PER_PAIR * (num_loads - 1)))))
+            logging.warning(f"The full savings list for {num_loads - 1} loads does not fit the memory budget, "
+                            f"using sparse savings with {savings_neighbours} neighbours")
+        if sparse_savings:
+            current_load_ids, next_load_ids = self.sparse_savings_pairs(savings_neighbours)
+            return self.savings_for_pairs(current_load_ids, next_load_ids)
+
+        load_ids = np.arange(1, num_loads, dtype=np.int32)
+        current_load_ids = np.repeat(load_ids, max(num_loads - 2, 0))
+        # every other load for each row, in ascending order, skipping i == j
+        next_load_ids = np.tile(load_ids, num_loads - 1).reshape(num_loads - 1, num_loads - 1)
+        next_load_ids = next_load_ids[~np.eye(num_loads - 1, dtype=bool)]
+        return self.savings_for_pairs(current_load_ids, next_load_ids)
+
+    def savings_for_pairs(self, current_load_ids, next_load_ids):
+        savings = (self.dist_matrix[current_load_ids, self.depot_id]
+                   + self.dist_matrix[self.depot_id, next_load_ids]
+                   - self.dist_matrix[current_load_ids, next_load_ids])
+        return SavingsList(current_load_ids, next_load_ids, savings)
+
+    def sparse_savings_pairs(self, savings_neighbours=None):
         """
-        Idea here is to test out swapped loads between trucks to see if we can get a better solution
+        Only generate the (i, j) pairs that could ever be linked, using a grid over the pickups.
+
+        i can only be followed by j if depot -> i -> j -> depot fits in the distance constraint, so the
+        dropoff of i only needs to look for pickups within
+            radius(i) = constraint - (d(D, i_p) + d(i_p, i_d)) - min_j(d(j_p, j_d) + d(j_d, D))
+        By the triangle inequality no longer route can link them either, so on its own this pruning
+        does not change the solution. With savings_neighbours=k only the k nearest pickups inside
+        that radius are kept, which is approximate but makes generation roughly O(n*k log n).
 
-        Not implemented right now is another variant: moving a single load to another truck
+        Pairs are returned in the same (i, j) order as the full list so ties sort identically.
         """
         num_loads = len(self.dist_matrix)
-        for i in range(1, num_loads):
-            for j in range(1, num_loads):
-                if i == j:
-                    continue
-                self.swap_if_better(trucks, truck_by_load, i, j)
-
-    def swap_if_better(self, trucks, truck_by_load, load_i, load_j):
-        """ If we can swap loads i and j to make a reduced cost, swap them in place """
-        i_truck = truck_by_load.get(load_i)
-        j_truck = truck_by_load.get(load_j)
-        if i_truck == j_truck:
-            return
-        distance_total = i_truck.current_distance + j_truck.current_distance
-
-        new_i_truck = self.swap_load(i_truck, load_i, load_j)
-        new_j_truck = self.swap_load(j_truck, load_j, load_i)
-        if new_i_truck is not None and new_j_truck is not None:
-            new_distance_total = new_i_truck.current_distance + new_j_truck.current_distance
-            if new_distance_total < distance_total:
-                logging.warning(f"Found better cost to substitution! {load_i} with {load_j}.")
-                for load_id in new_i_truck.load_ids:
-                    truck_by_load[load_id] = new_i_truck
-                trucks.remove(i_truck)
-                trucks.append(new_i_truck)
-                for load_id in new_j_truck.load_ids:
-                    truck_by_load[load_id] = new_j_truck
-                trucks.remove(j_truck)
-                trucks.append(new_j_truck)
-
-    def swap_load(self, truck, curr_load_id, new_load_id):
-        """ Builds a new truck with the swapped loads """
-        loads_copy = truck.load_ids.copy()
-        curr_load_idx = loads_copy.index(curr_load_id)
-        loads_copy[curr_load_idx] = new_load_id
-
-        new_truck = None
-        for load_id in loads_copy:
-            if new_truck is None:
-                new_truck = Truck(self.ss, load_id)
+        load_ids = np.arange(1, num_loads, dtype=np.int32)
+        if len(load_ids) < 2:
+            return load_ids[:0], load_ids[:0]
+        # indexed by load id, the depot entry is never used
+        all_ids = np.arange(num_loads)
+        load_dist = self.dist_matrix[all_ids, all_ids]
+        route_start = self.dist_matrix[self.depot_id, :] + load_dist
+        route_end = load_dist + self.dist_matrix[:, self.depot_id]
+        # small slack so float rounding never drops a feasible pair
+        radii = self.ss.distance_constraint - route_start - route_end[load_ids].min() + 1e-6
+
+        grid = spatial.PointGrid(self.ss.pickups[load_ids], load_ids)
+        current_load_ids = []
+        next_load_ids = []
+        for load_id in load_ids.tolist():
+            if savings_neighbours is not None:
+                # ask for one extra since the load's own pickup may be among the nearest
+                candidates, pickup_distances = grid.nearest(self.ss.dropoffs[load_id], savings_neighbours + 1, radii[load_id])
+                others = candidates != load_id
+                candidates = candidates[others][np.argsort(pickup_distances[others], kind='stable')[:savings_neighbours]]
             else:
-                if new_truck.can_link_right(load_id):
-                    new_truck.add_load_right(load_id)
-                else:
-                    logging.info(f"Failed to substitute {curr_load_id} with {new_load_id}, in Truck: {truck}")
-                    return None
-        logging.info(f"Succeeded in substituting {curr_load_id} with {new_load_id}, Old Truck: {truck}, New Truck: {new_truck}")
-        return new_truck
+                candidates, _ = grid.within(self.ss.dropoffs[load_id], radii[load_id])
+                candidates = candidates[candidates != load_id]
+            candidates = np.sort(candidates)
+            current_load_ids.append(np.full(len(candidates), load_id, dtype=np.int32))
+            next_load_ids.append(candidates.astype(np.int32))
+        current_load_ids = np.concatenate(current_load_ids)
+        next_load_ids = np.concatenate(next_load_ids)
+
+        # exact pairwise check, the radius only bounds it
+        linked_dist = (route_start[current_load_ids] + self.dist_matrix[current_load_ids, next_load_ids]
+                       + route_end[next_load_ids])
+        feasible = linked_dist <= self.ss.distance_constraint + 1e-6
+        return current_load_ids[feasible], next_load_ids[feasible]
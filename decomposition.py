@@ -0,0 +1,181 @@
+import logging
+import multiprocessing
+import time
+import numpy as np
+import clarke_wright
+import local_search
+import profiling
+import utils
+from multistart import MultiStartSolver
+
+
+# share of the time budget kept for repairing the region boundaries
+REPAIR_TIME_SHARE = 0.25
+
+
+def sector_partition(pickups, dropoffs, num_regions, rng=None):
+    """
+    Regions of equal size by the angle of each load's pickup/dropoff midpoint around the depot. Row 0
+    (the depot) is skipped; returns a list of load id arrays.
+    """
+    midpoints = (pickups[1:] + dropoffs[1:]) / 2.0
+    order = np.argsort(np.arctan2(midpoints[:, 1], midpoints[:, 0]), kind='stable')
+    return [np.sort(region) + 1 for region in np.array_split(order, num_regions) if len(region)]
+
+
+def kmeans_partition(pickups, dropoffs, num_regions, rng=None, iterations=20):
+    """ Regions from k-means (Lloyd's iterations) on the pickup/dropoff midpoints """
+    rng = rng if rng is not None else np.random.default_rng(0)
+    midpoints = (pickups[1:] + dropoffs[1:]) / 2.0
+    num_regions = min(num_regions, len(midpoints))
+    if num_regions == 0:
+        return []
+    centres = midpoints[rng.choice(len(midpoints), num_regions, replace=False)]
+    for _ in range(iterations):
+        squared = ((midpoints[:, np.newaxis, :] - centres[np.newaxis, :, :])**2).sum(axis=2)
+        labels = squared.argmin(axis=1)
+        counts = np.bincount(labels, minlength=num_regions)
+        sums = np.zeros_like(centres)
+        np.add.at(sums, labels, midpoints)
+        # an emptied cluster keeps its old centre
+        moved = np.where(counts[:, np.newaxis] > 0, sums / np.maximum(counts, 1)[:, np.newaxis], centres)
+        if np.array_equal(moved, centres):
+            break
+        centres = moved
+    return [np.flatnonzero(labels == region) + 1 for region in range(num_regions) if counts[region]]
+
+
+PARTITION_METHODS = {
+    'sectors': sector_partition,
+    'kmeans': kmeans_partition,
+}
+
+
+def region_deadline(deadline, regions_left, workers, now=None):
+    """
+    Deadline for a region starting now, with regions_left regions (this one included) still to start
+    on workers workers before the shared deadline: an equal slice of what is left for each round of
+    regions a worker still has to solve. Time a region doesn't use goes to the ones after it.
+    """
+    now = time.time() if now is None else now
+    rounds = -(-regions_left // max(1, workers))
+    return now + max(0.0, deadline - now) / max(1, rounds)
+
+
+def _solve_region(args):
+    """ Solve one region as a problem of its own. Returns its schedules in region load ids and its stats """
+    pickups, dropoffs, memory_budget, random_swap_factor, seed, deadline, regions_left, workers, solver_args = args
+    # taken when the region starts, not when it is queued, so a region waiting for a worker gets its share
+    deadline = region_deadline(deadline, regions_left, workers)
+    ss = clarke_wright.StaticState(coordinates=(pickups, dropoffs), memory_budget=memory_budget)
+    if random_swap_factor:
+        solver = MultiStartSolver(None, random_swap_factor, seed=seed, deadline=deadline, ss=ss, **solver_args)
+        solution, _ = solver.solve()
+    else:
+        solver = clarke_wright.Solver(None, ss=ss, deadline=deadline, **solver_args)
+        solution, _ = solver.solve(np.random.default_rng(seed))
+    return solution, solver.stats
+
+
+class DecompositionSolver:
+    """
+    Solves large problems by splitting the loads into regions around the depot, solving every region
+    on its own (in parallel with workers > 1), and stitching the routes back together.
+
+    Routes never cross a region boundary after stitching, so a repair pass runs the local search moves
+    (relocate, exchange, 2-opt*) and route elimination over the loads and routes that have a candidate
+    successor in another region, which merges and rebalances routes across neighbouring regions. The
+    regions get the time budget minus REPAIR_TIME_SHARE of it, the repair gets the rest. Each region
+    gets its own slice of the regions' time (see region_deadline), so restarts in one region can't use
+    up the time of the regions queued behind it.
+    """
+    def __init__(self, ss, regions, partition='sectors', workers=1, seed=None, time_budget=20.0, deadline=None,
+                 random_swap_factor=None, early_stop=None, **solver_args):
+        self.ss = ss
+        self.regions = regions
+        self.partition = PARTITION_METHODS[partition]
+        self.workers = workers
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % (1 << 32))
+        self.time_budget = time_budget
+        self.deadline = deadline
+        self.random_swap_factor = random_swap_factor
+        # ends the boundary repair early; the regions, smaller problems of their own, run to their deadline
+        self.early_stop = early_stop
+        self.solver_args = solver_args
+        self.stats = {}
+
+    def add_stat(self, name, value):
+        self.stats[name] = self.stats.get(name, 0) + value
+
+    def out_of_time(self):
+        if self.early_stop is not None and self.early_stop.should_stop():
+            return True
+        return time.time() >= self.deadline
+
+    def solve(self):
+        solution, cost = None, None
+        for solution, cost in self.solve_anytime():
+            pass
+        return solution, cost
+
+    def solve_anytime(self):
+        """ Generator yielding the stitched solution, then each improvement of the boundary repair """
+        start = time.time()
+        if self.deadline is None:
+            self.deadline = start + self.time_budget
+        rng = np.random.default_rng(self.seed)
+        regions = self.partition(self.ss.pickups, self.ss.dropoffs, self.regions, rng)
+        self.add_stat('regions', len(regions))
+        region_deadline = start + (self.deadline - start) * (1.0 - REPAIR_TIME_SHARE)
+
+        schedules = []
+        for region, (solution, stats) in zip(regions, self._solve_regions(regions, region_deadline)):
+            schedules.extend(region[np.asarray(schedule) - 1].tolist() for schedule in solution)
+            profiling.merge_stats(self.stats, stats)
+        self.add_stat('regions_seconds', time.time() - start)
+        best_cost = self.solution_cost(schedules)
+        logging.info(f"Stitched {len(regions)} regions into {len(schedules)} routes, cost {best_cost}")
+        yield schedules, best_cost
+
+        start = time.time()
+        region_of = np.zeros(len(self.ss.pickups), dtype=np.intp)
+        for idx, region in enumerate(regions):
+            region_of[region] = idx
+        search = local_search.LocalSearch(self.ss, schedules,
+                                          neighbours=self.solver_args.get('local_search_neighbours', 20),
+                                          best_improvement=self.solver_args.get('best_improvement', False),
+                                          out_of_time=self.out_of_time)
+        successors = np.array(search.successors)
+        crossing = (region_of[successors[1:]] != region_of[1:, np.newaxis]).any(axis=1)
+        boundary = (np.flatnonzero(crossing) + 1).tolist()
+        self.add_stat('boundary_loads', len(boundary))
+
+        removed = search.eliminate_routes(sorted({search.route_of[load_id] for load_id in boundary}))
+        self.add_stat('drivers_removed', removed)
+        if removed:
+            best_solution = search.solution()
+            best_cost = self.solution_cost(best_solution)
+            yield best_solution, best_cost
+        while not self.out_of_time() and search.improve(boundary):
+            solution = search.solution()
+            cost = self.solution_cost(solution)
+            if cost >= best_cost:
+                break
+            best_cost = cost
+            yield solution, cost
+        self.add_stat('repair_seconds', time.time() - start)
+
+    def _solve_regions(self, regions, deadline):
+        tasks = []
+        for idx, region in enumerate(regions):
+            rows = np.concatenate([[self.ss.depot_id], region])
+            tasks.append((self.ss.pickups[rows], self.ss.dropoffs[rows], self.ss.memory_budget,
+                          self.random_swap_factor, int(np.random.SeedSequence([self.seed, idx]).generate_state(1)[0]),
+                          deadline, len(regions) - idx, self.workers, self.solver_args))
+        if self.workers <= 1:
+            return [_solve_region(task) for task in tasks]
+        with multiprocessing.Pool(self.workers) as pool:
+            return pool.map(_solve_region, tasks, chunksize=1)
+
+    def solution_cost(self, schedules):
+        return utils.get_solution_cost(schedules, self.ss.dist_matrix, len(self.ss.pickups) - 1)
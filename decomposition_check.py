@@ -0,0 +1,41 @@
+import sys
+import os
+import argparse
+import logging
+import time
+import main
+from problem_cache import load_static_state
+
+
+def solve_cost(problem_path, solver_argv):
+    parser = argparse.ArgumentParser()
+    main.add_solver_arguments(parser)
+    args = parser.parse_args(solver_argv)
+    ss = load_static_state(problem_path, memory_budget=main.memory_budget_bytes(args))
+    _, cost = main.solve(None, args, time.time(), ss=ss, report_gap=False)
+    return cost
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    logging.basicConfig(level=logging.ERROR)
+    parser = argparse.ArgumentParser(description="Checks that --regions with --random-swap-factor restarts on one "
+                                                 "worker is no worse than --regions without restarts")
+    parser.add_argument("problems", nargs='*', default=[os.path.join(here, "training_problems", "problem5.txt")])
+    parser.add_argument("--regions", type=int, default=4)
+    parser.add_argument("--time-limit", dest='time_limit', type=float, default=4.0)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    base_argv = [f"--regions={args.regions}", f"--time-limit={args.time_limit}", f"--seed={args.seed}", "--workers=1"]
+    failures = []
+    for problem_path in args.problems:
+        plain = solve_cost(problem_path, base_argv)
+        restarts = solve_cost(problem_path, base_argv + ["--random-swap-factor=0.4"])
+        print(f"{os.path.basename(problem_path)}: {plain:.1f} without restarts, {restarts:.1f} with")
+        if restarts > plain:
+            failures.append(f"{os.path.basename(problem_path)}: restarts cost {restarts:.1f} > {plain:.1f}")
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,95 @@
+import math
+import numpy as np
+import utils
+
+
+# default for --memory-budget, in bytes
+DEFAULT_MEMORY_BUDGET = 2 << 30
+# one float64 entry of the dense matrix
+DENSE_BYTES_PER_ENTRY = 8
+
+
+class LazyDistances:
+    """
+    Distance "matrix" computed on demand from the coordinate arrays, for problems whose dense matrix
+    does not fit in memory.
+
+    Supports the indexing the solver uses on the dense matrix, with the same values bit for bit:
+    len(), .item(i, j), dist[i, j], element-wise gathers dist[ids, ids], rows and columns
+    (dist[depot_id, :]) and blocks of rows (dist[start:end, 1:]). Larger requests are computed a
+    bounded block of rows at a time, so memory stays O(n) plus whatever the caller asks for. The depot
+    row and column, which every savings and route length computation reads, are kept precomputed.
+    """
+    def __init__(self, pickups, dropoffs, depot_id=0, block_elements=1 << 22):
+        self.pickups = pickups
+        self.dropoffs = dropoffs
+        self.depot_id = depot_id
+        self.block_elements = block_elements
+        self.shape = (len(pickups), len(pickups))
+        self.ndim = 2
+        self.dtype = np.dtype(np.float64)
+        # python floats, the scalar lookups in the construction and local search loops avoid numpy scalars
+        self._pickup_x, self._pickup_y = pickups[:, 0].tolist(), pickups[:, 1].tolist()
+        self._dropoff_x, self._dropoff_y = dropoffs[:, 0].tolist(), dropoffs[:, 1].tolist()
+        all_ids = np.arange(len(pickups))
+        self.depot_row = self._pairs(np.full(len(pickups), depot_id), all_ids)
+        self.depot_column = self._pairs(all_ids, np.full(len(pickups), depot_id))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __str__(self):
+        return f"LazyDistances({self.shape[0]}x{self.shape[1]})"
+
+    def item(self, i, j):
+        # same arithmetic as utils.fill_distance_rows
+        dx = self._dropoff_x[i] - self._pickup_x[j]
+        dy = self._dropoff_y[i] - self._pickup_y[j]
+        return math.sqrt(dx*dx + dy*dy)
+
+    def _pairs(self, rows, columns):
+        dx = self.dropoffs[rows, 0] - self.pickups[columns, 0]
+        dy = self.dropoffs[rows, 1] - self.pickups[columns, 1]
+        return np.sqrt(dx*dx + dy*dy)
+
+    def _block(self, rows, columns):
+        """ The dense rows x columns block for index arrays, a bounded number of rows at a time """
+        out = np.empty((len(rows), len(columns)))
+        pickups = self.pickups[columns]
+        block_rows = max(1, self.block_elements // max(1, len(columns)))
+        for start in range(0, len(rows), block_rows):
+            block = slice(start, start + block_rows)
+            utils.fill_distance_rows(pickups, self.dropoffs[rows[block]], slice(None), out[block])
+        return out
+
+    def __getitem__(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, slice) or isinstance(columns, slice):
+            # outer indexing like numpy's, an integer index drops its axis
+            row_ids = np.arange(self.shape[0])[rows] if isinstance(rows, slice) else np.asarray(rows)
+            column_ids = np.arange(self.shape[1])[columns] if isinstance(columns, slice) else np.asarray(columns)
+            if row_ids.ndim == 0 or column_ids.ndim == 0:
+                return self[row_ids, column_ids]
+            return self._block(row_ids, column_ids)
+        rows, columns = np.asarray(rows), np.asarray(columns)
+        if rows.ndim == 0 and columns.ndim == 0:
+            return np.float64(self.item(int(rows), int(columns)))
+        if rows.ndim == 0 and rows == self.depot_id:
+            return self.depot_row[columns]
+        if columns.ndim == 0 and columns == self.depot_id:
+            return self.depot_column[rows]
+        return self._pairs(*np.broadcast_arrays(rows, columns))
+
+
+def dense_matrix_bytes(num_loads):
+    return num_loads * num_loads * DENSE_BYTES_PER_ENTRY
+
+
+def create_distances(pickups, dropoffs, depot_id=0, memory_budget=DEFAULT_MEMORY_BUDGET):
+    """
+    The dense distance matrix if it fits in memory_budget bytes, otherwise a LazyDistances over the
+    same coordinates. A matrix cached on disk (see problem_cache) is a third, memory mapped, option.
+    """
+    if dense_matrix_bytes(len(pickups)) <= memory_budget:
+        return utils.create_distance_matrix_from_coordinates(pickups, dropoffs)
+    return LazyDistances(pickups, dropoffs, depot_id)
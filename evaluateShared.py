@@ -2,78 +2,18 @@ import subprocess
 import os
 import sys
 import io
+import itertools
 import math
 import time
 import argparse
-
-
-class Point:
-    def __init__(self, x, y):
-        self.x = x
-        self.y = y
-
-    def toString(self):
-        return "(" + str(self.x) + "," + str(self.y) + ")"
-
-
-def distanceBetweenPoints(p1: Point, p2: Point):
-    xDiff = p1.x - p2.x
-    yDiff = p1.y - p2.y
-    return math.sqrt(xDiff*xDiff + yDiff*yDiff)
-
-
-class Load:
-    def __init__(self, id, pickup, dropoff):
-        self.id = id
-        self.pickup = pickup
-        self.dropoff = dropoff
-
-
-class VRP:
-    def __init__(self, loads):
-        self.loads = loads
-
-    def toProblemString(self):
-        s = "loadNumber pickup dropoff\n"
-        for idx, load in enumerate(self.loads):
-            s += str(idx+1) + " " + load.pickup.toString() + " " + load.dropoff.toString() + "\n"
-        return s
-
-    def __str__(self):
-        return self.toProblemString()
-
-
-def loadProblemFromFile(filePath):
-    f = open(filePath, "r")
-    problemStr = f.read()
-    f.close()
-    return loadProblemFromProblemStr(problemStr)
-
-
-def getPointFromPointStr(pointStr):
-    pointStr = pointStr.replace("(","").replace(")","")
-    splits = pointStr.split(",")
-    return Point(float(splits[0]), float(splits[1]))
-
-
-def loadProblemFromProblemStr(problemStr):
-    loads = []
-    buf = io.StringIO(problemStr)
-    gotHeader = False
-    while True:
-        line = buf.readline()
-        if not gotHeader:
-            gotHeader = True
-            continue
-        if len(line) == 0:
-            break
-        line = line.replace("\n", "")
-        splits = line.split()
-        id = splits[0]
-        pickup = getPointFromPointStr(splits[1])
-        dropoff = getPointFromPointStr(splits[2])
-        loads.append(Load(id, pickup, dropoff))
-    return VRP(loads)
+import concurrent.futures
+import csv
+import json
+import tempfile
+import urllib.parse
+import urllib.request
+import numpy as np
+from problem import Point, Load, VRP, loadProblemFromFile, getPointFromPointStr, loadProblemFromProblemStr
 
 
 def loadSolutionFromString(solutionStr):
@@ -97,60 +37,247 @@ def loadSolutionFromString(solutionStr):
     return schedules, ""
 
 
-def loadCountOrAssignmentError(problem, solutionSchedules):
-    solutionLoadIDs = {}
-    for schedule in solutionSchedules:
-        for loadID in schedule:
-            if loadID in solutionLoadIDs:
-                return "load " + loadID + " was included in at least two driver schedules"
-            solutionLoadIDs[loadID] = True
-        
-    if len(solutionLoadIDs) != len(problem.loads):
-        return "the solution load count is not equal to the problem load count"
-        
-    for load in problem.loads:
-        if load.id not in solutionLoadIDs:
-            return "load " + load.id + " was not assigned to a driver"
-    
-    return ""
-
-def getDistanceOfScheduleWithReturnHome(schedule, loadByID):
-    distance = 0.0
-    home = Point(0,0)
-    currentLoc = home
-    for loadID in schedule:
-        load = loadByID[loadID]
-        #to pickup
-        distance += distanceBetweenPoints(currentLoc, load.pickup)
-        currentLoc = load.pickup
-        #to dropoff
-        distance += distanceBetweenPoints(currentLoc, load.dropoff)
-        currentLoc = load.dropoff
-    distance += distanceBetweenPoints(currentLoc, home)
-    return distance
-        
+def getProblemArrays(problem):
+    # load id -> index map (1 based, in problem order) and the pickup/dropoff coordinates by index, index 0 is home.
+    # Built once per problem and kept on it, evaluating many solutions of a problem only flattens the schedules
+    if getattr(problem, "evaluationArrays", None) is None:
+        loadIndex = {load.id: idx + 1 for idx, load in enumerate(problem.loads)}
+        pickups = np.zeros((len(problem.loads) + 1, 2))
+        dropoffs = np.zeros((len(problem.loads) + 1, 2))
+        pickups[1:] = np.fromiter(itertools.chain.from_iterable((load.pickup.x, load.pickup.y) for load in problem.loads),
+                                  dtype=np.float64, count=2*len(problem.loads)).reshape(-1, 2)
+        dropoffs[1:] = np.fromiter(itertools.chain.from_iterable((load.dropoff.x, load.dropoff.y) for load in problem.loads),
+                                   dtype=np.float64, count=2*len(problem.loads)).reshape(-1, 2)
+        problem.evaluationArrays = (loadIndex, pickups, dropoffs)
+    return problem.evaluationArrays
+
+
+def flattenSolution(problem, solutionSchedules):
+    # all schedules as one array of load indexes (-1 for unknown ids) plus route offsets and lengths
+    loadIndex, _, _ = getProblemArrays(problem)
+    lengths = np.fromiter(map(len, solutionSchedules), dtype=np.intp, count=len(solutionSchedules))
+    allIDs = itertools.chain.from_iterable(solutionSchedules)
+    flat = np.fromiter(map(loadIndex.get, allIDs, itertools.repeat(-1)), dtype=np.intp, count=int(lengths.sum()))
+    starts = np.zeros(len(lengths), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return flat, starts, lengths
+
+
+def unknownLoadsError(solutionSchedules, flat):
+    # flattenSolution maps ids that aren't in the problem to -1, which must never be used as an index
+    if not (flat < 0).any():
+        return ""
+    allIDs = [loadID for schedule in solutionSchedules for loadID in schedule]
+    return "unknown loads " + ", ".join(allIDs[idx] for idx in np.flatnonzero(flat < 0))
+
+
+def loadCountOrAssignmentError(problem, solutionSchedules, flatSolution=None):
+    flat, _, _ = flatSolution if flatSolution is not None else flattenSolution(problem, solutionSchedules)
+    errors = []
+    unknown = unknownLoadsError(solutionSchedules, flat)
+    if unknown:
+        errors.append(unknown)
+    counts = np.bincount(flat[flat > 0], minlength=len(problem.loads) + 1)
+    duplicated = [problem.loads[idx - 1].id for idx in np.flatnonzero(counts > 1)]
+    if duplicated:
+        errors.append("loads " + ", ".join(duplicated) + " were included in at least two driver schedules")
+    if len(flat) != len(problem.loads):
+        errors.append("the solution load count is not equal to the problem load count")
+    unassigned = [problem.loads[idx].id for idx in np.flatnonzero(counts[1:] == 0)]
+    if unassigned:
+        errors.append("loads " + ", ".join(unassigned) + " were not assigned to a driver")
+    return "; ".join(errors)
+
+
+def getScheduleDistances(problem, flatSolution):
+    # every schedule's driven minutes at once. The legs of a schedule are added in driving order (depot,
+    # pickup, dropoff, ..., depot), k-th load of every schedule together, so the sums match a per schedule loop
+    flat, starts, lengths = flatSolution
+    distances = np.zeros(len(starts))
+    if len(flat) == 0:
+        return distances
+    _, pickups, dropoffs = getProblemArrays(problem)
+    previous = np.empty_like(flat)
+    previous[1:] = flat[:-1]
+    previous[starts[lengths > 0]] = 0
+    toPickup = pointDistances(dropoffs[previous], pickups[flat])
+    toDropoff = pointDistances(pickups[flat], dropoffs[flat])
+
+    order = np.argsort(-lengths, kind="stable")
+    orderedStarts = starts[order]
+    negatedLengths = -lengths[order]
+    totals = np.zeros(len(starts))
+    for position in range(lengths.max()):
+        active = np.searchsorted(negatedLengths, -position, side="left")
+        legs = orderedStarts[:active] + position
+        totals[:active] += toPickup[legs]
+        totals[:active] += toDropoff[legs]
+    distances[order] = totals
+    last = np.where(lengths > 0, flat[np.maximum(starts + lengths - 1, 0)], 0)
+    distances += pointDistances(dropoffs[last], np.zeros((len(last), 2)))
+    return distances
+
+
+def pointDistances(fromPoints, toPoints):
+    # sqrt(xDiff*xDiff + yDiff*yDiff) per row, the same floats as utils.distance
+    xDiff = fromPoints[:, 0] - toPoints[:, 0]
+    yDiff = fromPoints[:, 1] - toPoints[:, 1]
+    return np.sqrt(xDiff*xDiff + yDiff*yDiff)
+
+
 def getSolutionCostWithError(problem, solutionSchedules):
-    err = loadCountOrAssignmentError(problem, solutionSchedules)
+    flatSolution = flattenSolution(problem, solutionSchedules)
+    err = loadCountOrAssignmentError(problem, solutionSchedules, flatSolution)
     if err != "":
         return 0, err
-    
-    return getSolutionCost(problem, solutionSchedules)
-
-def getSolutionCost(problem, solutionSchedules):
-    loadByID ={}
-    for load in problem.loads:
-        loadByID[load.id] = load
-
-    totalDrivenMinutes = 0.0
-    for idx, schedule in enumerate(solutionSchedules):
-        scheduleMinutes = getDistanceOfScheduleWithReturnHome(schedule, loadByID)
-        if scheduleMinutes > 12*60:
-            return 0, print("schedule idx " + str(idx) + " is invalid: driver runs for " + str(scheduleMinutes) + " minutes")
-        totalDrivenMinutes += scheduleMinutes
-    
+
+    return getSolutionCost(problem, solutionSchedules, flatSolution)
+
+
+def getSolutionCost(problem, solutionSchedules, flatSolution=None):
+    if flatSolution is None:
+        flatSolution = flattenSolution(problem, solutionSchedules)
+    err = unknownLoadsError(solutionSchedules, flatSolution[0])
+    if err != "":
+        return 0, err
+    scheduleMinutes = getScheduleDistances(problem, flatSolution)
+    invalid = np.flatnonzero(scheduleMinutes > 12*60)
+    if len(invalid) > 0:
+        return 0, "; ".join("schedule idx " + str(idx) + " is invalid: driver runs for " + str(scheduleMinutes[idx]) + " minutes" for idx in invalid)
+
+    totalDrivenMinutes = sum(scheduleMinutes.tolist())
     return 500*len(solutionSchedules) + totalDrivenMinutes, ""
 
 
+def requestSolution(serverURL, problemStr, serverArgs):
+    # serverArgs like "--route-elimination --time-limit=5" become ?route-elimination&time-limit=5
+    query = []
+    for arg in serverArgs.split():
+        key, _, value = arg.lstrip("-").partition("=")
+        query.append((key, value))
+    url = serverURL.rstrip("/") + "/solve?" + urllib.parse.urlencode(query)
+    request = urllib.request.Request(url, data=problemStr.encode("utf-8"), method="POST")
+    with urllib.request.urlopen(request) as response:
+        return response.read().decode("utf-8")
+
+
+def percentile(values, p):
+    # linear interpolation between closest ranks
+    values = sorted(values)
+    if len(values) == 0:
+        return 0.0
+    rank = (len(values) - 1) * p / 100.0
+    low = math.floor(rank)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (rank - low)
+
+
+def runBenchmarkCase(cmdStr, inputPath, seed):
+    # one run of one config on one problem, errors are recorded instead of stopping the suite
+    record = {"config": cmdStr, "problem": os.path.basename(inputPath), "seed": seed,
+              "cost": None, "drivers": None, "minutes": None, "runTime": None, "phases": {}, "error": ""}
+    statsFile = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+    statsFile.close()
+    try:
+        cmd = cmdStr.split() + [inputPath, "--seed", str(seed), "--stats-file", statsFile.name]
+        startTime = time.time()
+        result = subprocess.run(cmd, capture_output=True)
+        record["runTime"] = time.time() - startTime
+        if result.returncode != 0:
+            record["error"] = "exit code " + str(result.returncode) + ": " + result.stderr.decode("utf-8")[-500:]
+            return record
+        schedules, err = loadSolutionFromString(result.stdout.decode("utf-8"))
+        if err == "":
+            cost, err = getSolutionCostWithError(loadProblemFromFile(inputPath), schedules)
+        if err:
+            record["error"] = str(err)
+            return record
+        record["cost"] = cost
+        record["drivers"] = len(schedules)
+        record["minutes"] = cost - 500*len(schedules)
+        if os.path.getsize(statsFile.name) > 0:
+            with open(statsFile.name) as f:
+                record["phases"] = json.load(f)
+    finally:
+        os.remove(statsFile.name)
+    return record
+
+
+def summarizeRuns(runs):
+    summary = {}
+    for config in dict.fromkeys(run["config"] for run in runs):
+        configRuns = [run for run in runs if run["config"] == config]
+        good = [run for run in configRuns if not run["error"]]
+        phases = {}
+        for run in good:
+            for name, value in run["phases"].items():
+                phases.setdefault(name, []).append(value)
+        summary[config] = {
+            "runs": len(configRuns),
+            "errors": len(configRuns) - len(good),
+            "meanCost": sum(run["cost"] for run in good) / max(len(good), 1),
+            "meanDrivers": sum(run["drivers"] for run in good) / max(len(good), 1),
+            "meanMinutes": sum(run["minutes"] for run in good) / max(len(good), 1),
+            "p50RunTime": percentile([run["runTime"] for run in good], 50),
+            "p95RunTime": percentile([run["runTime"] for run in good], 95),
+            "meanPhases": {name: sum(values) / len(values) for name, values in phases.items()},
+        }
+    return summary
+
+
+def compareToBaseline(summary, baseline, costTolerance, timeTolerance):
+    regressions = []
+    for config, current in summary.items():
+        if config not in baseline:
+            continue
+        previous = baseline[config]
+        if current["errors"] > previous["errors"]:
+            regressions.append(config + ": " + str(current["errors"]) + " failed runs, baseline had " + str(previous["errors"]))
+        if current["meanCost"] > previous["meanCost"] * (1 + costTolerance):
+            regressions.append(config + ": mean cost " + str(current["meanCost"]) + " vs baseline " + str(previous["meanCost"]))
+        if current["p95RunTime"] > previous["p95RunTime"] * (1 + timeTolerance):
+            regressions.append(config + ": p95 run time " + str(current["p95RunTime"]) + "s vs baseline " + str(previous["p95RunTime"]) + "s")
+    return regressions
+
+
+def runSuite(args, inputPaths):
+    cases = [(cmdStr, inputPath, seed) for cmdStr in args.cmd for inputPath in inputPaths for seed in range(args.repeat)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        runs = list(pool.map(lambda case: runBenchmarkCase(*case), cases))
+
+    summary = summarizeRuns(runs)
+    for config, result in summary.items():
+        print(config)
+        print("	runs: " + str(result["runs"]) + ", errors: " + str(result["errors"]))
+        print("	mean cost: " + str(result["meanCost"]) + ", mean drivers: " + str(result["meanDrivers"]) + ", mean minutes: " + str(result["meanMinutes"]))
+        print("	p50 run time: " + str(result["p50RunTime"] * 1000) + "ms, p95 run time: " + str(result["p95RunTime"] * 1000) + "ms")
+        for name, value in result["meanPhases"].items():
+            print("		" + name + ": " + str(value))
+    for run in runs:
+        if run["error"]:
+            print("error in " + run["config"] + " on " + run["problem"] + " (seed " + str(run["seed"]) + "): " + run["error"])
+
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"summary": summary, "runs": runs}, f, indent=2)
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(["config", "problem", "seed", "cost", "drivers", "minutes", "runTime", "error"])
+            for run in runs:
+                writer.writerow([run[key] for key in ["config", "problem", "seed", "cost", "drivers", "minutes", "runTime", "error"]])
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["summary"]
+        regressions = compareToBaseline(summary, baseline, args.costTolerance, args.timeTolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if regressions:
+            sys.exit(1)
+        print("no regressions against " + args.baseline)
+
+
 def printSolutionFormatNag():
     print("Program should only print a solution (no debugging messages) in format that looks like this:")
     print("[1,4,9,7]")
@@ -161,10 +288,23 @@ def printSolutionFormatNag():
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--problemDir", help="Path to folder containing problems")
-    parser.add_argument("--cmd", help="Command to run your program (not including a problem file)")
+    parser.add_argument("--cmd", action="append", help="Command to run your program (not including a problem file). Can be repeated in --suite mode to compare configs")
+    parser.add_argument("--server", help="URL of a running solver service (server.py) to send problems to instead of running --cmd")
+    parser.add_argument("--serverArgs", default="", help="Solver options to send with each problem in --server mode")
+    parser.add_argument("--suite", action="store_true", help="Benchmark mode: run every --cmd on every problem concurrently and report statistics")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per config and problem in --suite mode, each with its own --seed")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Concurrent runs in --suite mode")
+    parser.add_argument("--report", help="Write the --suite results to this json file")
+    parser.add_argument("--csv", help="Write the --suite runs to this csv file")
+    parser.add_argument("--baseline", help="A previous --report to compare against, exits with an error on regressions")
+    parser.add_argument("--costTolerance", type=float, default=0.001, help="Allowed relative mean cost increase over the baseline")
+    parser.add_argument("--timeTolerance", type=float, default=0.25, help="Allowed relative p95 run time increase over the baseline")
     args=parser.parse_args()
 
     files = [f for f in os.listdir(args.problemDir)]
+    if args.suite:
+        runSuite(args, [args.problemDir + "/" + f for f in sorted(files) if f[0] != "."])
+        sys.exit(0)
     costs = []
     sumRunTime = 0.0
     
@@ -174,11 +314,14 @@ if __name__ == '__main__':
         print(inputFile)
         print("\trunning...")
         inputPath = args.problemDir + "/" + inputFile
-        #run commands on input path
-        cmd = args.cmd.split()
-        cmd.append(inputPath)
         startTime = time.time()
-        output = subprocess.check_output(cmd).decode("utf-8")
+        if args.server:
+            output = requestSolution(args.server, open(inputPath).read(), args.serverArgs)
+        else:
+            #run commands on input path
+            cmd = args.cmd[0].split()
+            cmd.append(inputPath)
+            output = subprocess.check_output(cmd).decode("utf-8")
         runTime = time.time() - startTime
         print("\trun time:", runTime, "s")
         if runTime > 30:
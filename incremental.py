@@ -0,0 +1,237 @@
+import logging
+import time
+import numpy as np
+import clarke_wright
+import distances
+import local_search
+import utils
+
+
+class IncrementalPlan:
+    """
+    A solved problem kept alive while loads arrive and cancel, re-planned locally instead of re-solved.
+
+    Loads are known by their own keys (anything hashable; by default the problem's load ids) and live in
+    the slots 1..n of the coordinate arrays and the distance matrix, which keep spare capacity. Adding
+    loads computes only their rows and columns, removing one moves the last load into its slot, and the
+    candidate successor lists are patched the same way. New loads go in at their cheapest feasible
+    position (LocalSearch.insert_loads), then a bounded local search runs over the loads around the
+    change, and routes that lost loads are offered to route elimination.
+    """
+    def __init__(self, ss, schedules, keys=None, neighbours=20, repair_passes=2, best_improvement=False):
+        num_loads = len(ss.pickups) - 1
+        self.depot_id = ss.depot_id
+        self.distance_constraint = ss.distance_constraint
+        self.memory_budget = ss.memory_budget
+        self.neighbours = neighbours
+        self.repair_passes = repair_passes
+        self.best_improvement = best_improvement
+        self.keys = [None] + (list(keys) if keys is not None else list(range(1, num_loads + 1)))
+        self.slot_of = {key: slot for slot, key in enumerate(self.keys) if slot != self.depot_id}
+        self.num_loads = num_loads
+        self.pickups = np.array(ss.pickups)
+        self.dropoffs = np.array(ss.dropoffs)
+        # the dense matrix is copied, it is written to (and a cached one is a read only memory map)
+        self.matrix = np.array(ss.dist_matrix) if isinstance(ss.dist_matrix, np.ndarray) else None
+        self.routes = [list(schedule) for schedule in schedules]
+        # route index and position in it of every slot, so a cancelled load is found without a scan
+        self.route_of = None
+        self.position_of = None
+        self._index_routes()
+        self.successors = None
+        self._all_successors()
+        # timings and counters of the last change
+        self.stats = {}
+
+    def _capacity(self):
+        return len(self.pickups) - 1
+
+    def _reserve(self, num_loads):
+        """ Grow the arrays (doubling) so slots up to num_loads exist """
+        if num_loads <= self._capacity():
+            return
+        rows = max(num_loads, 2 * self._capacity()) + 1
+        used = self.num_loads + 1
+        for name in ('pickups', 'dropoffs', 'successors', 'route_of', 'position_of'):
+            old = getattr(self, name)
+            grown = np.zeros((rows,) + old.shape[1:], dtype=old.dtype)
+            grown[:used] = old[:used]
+            setattr(self, name, grown)
+        if self.matrix is not None:
+            grown = np.empty((rows, rows))
+            grown[:used, :used] = self.matrix[:used, :used]
+            self.matrix = grown
+
+    def _index_routes(self):
+        """ Rebuild route_of and position_of from self.routes """
+        flat, starts, lengths = utils.flatten_schedules(self.routes)
+        if self.route_of is None or len(self.route_of) < len(self.pickups):
+            self.route_of = np.zeros(len(self.pickups), dtype=np.intp)
+            self.position_of = np.zeros(len(self.pickups), dtype=np.intp)
+        self.route_of[flat] = np.repeat(np.arange(len(self.routes)), lengths)
+        self.position_of[flat] = np.arange(len(flat)) - np.repeat(starts, lengths)
+
+    def _distances(self):
+        used = self.num_loads + 1
+        if self.matrix is not None:
+            return self.matrix[:used, :used]
+        return distances.LazyDistances(self.pickups[:used], self.dropoffs[:used], self.depot_id)
+
+    def _static_state(self):
+        used = self.num_loads + 1
+        return clarke_wright.StaticState(coordinates=(self.pickups[:used], self.dropoffs[:used]),
+                                         dist_matrix=self._distances(), memory_budget=self.memory_budget)
+
+    def _width(self):
+        return max(min(self.neighbours, self.num_loads - 2), 0)
+
+    def _all_successors(self):
+        ss = self._static_state()
+        successors = local_search.candidate_successors(ss.dist_matrix, self.depot_id, self.neighbours,
+                                                       ss.pickups, ss.dropoffs)
+        self.successors = np.zeros((len(self.pickups), successors.shape[1]), dtype=np.intp)
+        self.successors[:len(successors)] = successors
+
+    def _update_successors(self, slots):
+        """ Recompute the candidate successors of the given slots, same as candidate_successors would """
+        width = self._width()
+        if len(slots) == 0 or width == 0:
+            return
+        dist = self._distances()
+        slots = np.asarray(slots, dtype=np.intp)
+        block = np.array(dist[slots, 1:], dtype=np.float64)
+        block[np.arange(len(slots)), slots - 1] = np.inf
+        closest = np.argpartition(block, width - 1, axis=1)[:, :width]
+        order = np.argsort(np.take_along_axis(block, closest, axis=1), axis=1, kind='stable')
+        self.successors[slots] = np.take_along_axis(closest, order, axis=1) + 1
+
+    def schedules(self):
+        """ The current plan as lists of load keys """
+        return [[self.keys[slot] for slot in route] for route in self.routes]
+
+    def cost(self):
+        """ Validated cost of the current plan """
+        return utils.get_solution_cost(self.routes, self._distances(), self.num_loads, self.distance_constraint)
+
+    def add_load(self, key, pickup, dropoff, time_limit=None):
+        return self.add_loads([(key, pickup, dropoff)], time_limit)
+
+    def add_loads(self, loads, time_limit=None):
+        """
+        Add (key, (pickup x, pickup y), (dropoff x, dropoff y)) loads to the plan. Only the new rows and
+        columns of the distance matrix are computed. Returns the new cost.
+        """
+        start = time.time()
+        for key, _, _ in loads:
+            if key in self.slot_of:
+                raise Exception(f"load {key} is already in the plan")
+        old_width = self._width()
+        first = self.num_loads + 1
+        self._reserve(self.num_loads + len(loads))
+        slots = np.arange(first, first + len(loads))
+        for slot, (key, pickup, dropoff) in zip(slots.tolist(), loads):
+            self.pickups[slot] = pickup
+            self.dropoffs[slot] = dropoff
+            self.keys.append(key)
+            self.slot_of[key] = slot
+        self.num_loads += len(loads)
+        used = self.num_loads + 1
+        if self.matrix is not None:
+            # rows of the new loads, then the old loads' columns towards them, same arithmetic as the full matrix
+            utils.fill_distance_rows(self.pickups[:used], self.dropoffs[:used], slice(first, used),
+                                     self.matrix[first:used, :used])
+            utils.fill_distance_rows(self.pickups[first:used], self.dropoffs[:first], slice(None),
+                                     self.matrix[:first, first:used])
+
+        if self._width() != old_width:
+            self._all_successors()
+        else:
+            self._update_successors(slots)
+            # old loads whose successor lists a new load gets into
+            dist = self._distances()
+            old_slots = np.arange(1, first)
+            worst = dist[old_slots, self.successors[old_slots, -1]] if old_width else np.full(first - 1, np.inf)
+            closer = (np.array(dist[old_slots, first:used]) < worst[:, np.newaxis]).any(axis=1)
+            self._update_successors(old_slots[closer])
+
+        search = self._search(time_limit, start)
+        new_routes = search.insert_loads(slots.tolist())
+        near = set(slots.tolist()) | set(self.successors[slots].ravel().tolist())
+        self._repair(search, sorted(near))
+        self.stats = {'added': len(loads), 'new_routes': new_routes, 'seconds': time.time() - start}
+        logging.info(f"Added {len(loads)} loads in {self.stats['seconds'] * 1000:.1f}ms")
+        return self.cost()
+
+    def remove_load(self, key, time_limit=None):
+        return self.remove_loads([key], time_limit)
+
+    def remove_loads(self, keys, time_limit=None):
+        """ Cancel the loads with the given keys. Returns the new cost """
+        start = time.time()
+        for key in keys:
+            if key not in self.slot_of:
+                raise Exception(f"load {key} is not in the plan")
+        old_width = self._width()
+        near = set()
+        for key in keys:
+            slot = self.slot_of.pop(key)
+            route = self.routes[self.route_of[slot]]
+            position = int(self.position_of[slot])
+            near.update(route[max(position - 1, 0):position + 2])
+            del route[position]
+            self.position_of[route[position:]] -= 1
+            near.discard(slot)
+            rescan = np.flatnonzero((self.successors[1:self.num_loads + 1] == slot).any(axis=1)) + 1
+            renamed = self._move_last_to(slot)
+            if renamed in near:
+                near.discard(renamed)
+                near.add(slot)
+            self.num_loads -= 1
+            if self._width() == old_width:
+                rescan = [slot if load_id == renamed else load_id for load_id in rescan.tolist()]
+                self._update_successors([load_id for load_id in rescan if load_id <= self.num_loads])
+        if self._width() != old_width:
+            self._all_successors()
+        self.routes = [route for route in self.routes if route]
+
+        search = self._search(time_limit, start)
+        touched = sorted({search.route_of[load_id] for load_id in near})
+        removed = search.eliminate_routes(touched)
+        self._repair(search, sorted(near))
+        self.stats = {'removed': len(keys), 'drivers_removed': removed, 'seconds': time.time() - start}
+        logging.info(f"Removed {len(keys)} loads in {self.stats['seconds'] * 1000:.1f}ms")
+        return self.cost()
+
+    def _move_last_to(self, slot):
+        """ Fill the freed slot with the last load so the slots stay 1..n. Returns the last load's old slot """
+        last = self.num_loads
+        if slot != last:
+            self.pickups[slot] = self.pickups[last]
+            self.dropoffs[slot] = self.dropoffs[last]
+            if self.matrix is not None:
+                self.matrix[slot, :last + 1] = self.matrix[last, :last + 1]
+                self.matrix[:last + 1, slot] = self.matrix[:last + 1, last]
+            self.successors[slot] = self.successors[last]
+            successors = self.successors[1:last]
+            successors[successors == last] = slot
+            self.keys[slot] = self.keys[last]
+            self.slot_of[self.keys[slot]] = slot
+            self.routes[self.route_of[last]][self.position_of[last]] = slot
+            self.route_of[slot] = self.route_of[last]
+            self.position_of[slot] = self.position_of[last]
+        self.keys.pop()
+        return last
+
+    def _search(self, time_limit, start):
+        deadline = None if time_limit is None else start + time_limit
+        return local_search.LocalSearch(self._static_state(), self.routes, best_improvement=self.best_improvement,
+                                        out_of_time=lambda: deadline is not None and time.time() >= deadline,
+                                        successors=self.successors[:self.num_loads + 1].tolist())
+
+    def _repair(self, search, loads):
+        """ Bounded local search over the loads around a change """
+        for _ in range(self.repair_passes):
+            if not search.improve(loads):
+                break
+        self.routes = search.solution()
+        self._index_routes()
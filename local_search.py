@@ -0,0 +1,492 @@
+import logging
+import numpy as np
+import spatial
+from routes import Routes
+
+
+# improvements smaller than this are float noise
+IMPROVEMENT_EPS = 1e-9
+
+
+def candidate_successors(dist_matrix, depot_id, neighbours, pickups=None, dropoffs=None):
+    """
+    For every load, the loads whose pickup is closest to its dropoff (the best loads to follow it).
+
+    Returns an int array of shape (num_loads, neighbours) indexed by load id; the depot row is unused.
+    Scans the matrix a block of rows at a time, or when the matrix is computed on demand (see
+    distances.LazyDistances) and the coordinates are given, queries a grid over the pickups instead.
+    """
+    num_loads = len(dist_matrix)
+    neighbours = min(neighbours, num_loads - 2)
+    successors = np.zeros((num_loads, max(neighbours, 0)), dtype=np.intp)
+    if neighbours <= 0:
+        return successors
+    if not isinstance(dist_matrix, np.ndarray) and pickups is not None:
+        grid = spatial.PointGrid(pickups[1:], np.arange(1, num_loads))
+        for load_id in range(1, num_loads):
+            # one extra since the load's own pickup may be among the nearest
+            ids, distances = grid.nearest(dropoffs[load_id], neighbours + 1)
+            others = ids != load_id
+            successors[load_id] = ids[others][np.argsort(distances[others], kind='stable')[:neighbours]]
+        return successors
+    block_rows = max(1, (1 << 20) // num_loads)
+    for start in range(1, num_loads, block_rows):
+        end = min(start + block_rows, num_loads)
+        block = np.array(dist_matrix[start:end, 1:], dtype=np.float64)
+        # never pick the load itself
+        block[np.arange(end - start), np.arange(start, end) - 1] = np.inf
+        closest = np.argpartition(block, neighbours - 1, axis=1)[:, :neighbours]
+        order = np.argsort(np.take_along_axis(block, closest, axis=1), axis=1, kind='stable')
+        successors[start:end] = np.take_along_axis(closest, order, axis=1) + 1
+    return successors
+
+
+class LocalSearch:
+    """
+    Neighbourhood search over a set of routes where every move is scored in O(1).
+
+    Each route is kept as [depot, load, ..., load, depot] with cached prefix sums, so a move only
+    looks up the handful of legs it changes. Moves are generated from candidate lists: for a load x
+    and one of its nearest successors y, every move below makes x be followed by y.
+      - relocate / or-opt: move a segment of 1..3 loads ending at x to just before y, or starting at y
+        to just after x (within a route or between routes)
+      - exchange: swap x with the load before y, or y with the load after x (between routes)
+      - 2-opt: reverse a part of x's route so that y follows x
+      - 2-opt*: join the start of x's route to the tail of y's route and vice versa
+    The objective is the solution cost, so a move that empties a route is worth its 500 as well.
+    A routes.Routes solution is converted to schedule lists first: its linked arrays have no
+    positions, so they can't give the prefix sums in O(1).
+    """
+    def __init__(self, ss, solution, neighbours=20, best_improvement=False, out_of_time=None,
+                 max_segment_length=3, successors=None):
+        self.ss = ss
+        self.dist_matrix = ss.dist_matrix
+        self.depot_id = ss.depot_id
+        self.distance_constraint = ss.distance_constraint
+        self.best_improvement = best_improvement
+        self.out_of_time = out_of_time if out_of_time is not None else (lambda: False)
+        self.max_segment_length = max_segment_length
+        # candidate successor lists can be passed in by callers that maintain them (see incremental)
+        if successors is None:
+            successors = candidate_successors(self.dist_matrix, self.depot_id, neighbours,
+                                              ss.pickups, ss.dropoffs).tolist()
+        self.successors = successors
+        self.moves_evaluated = 0
+        self.moves_applied = 0
+
+        num_loads = len(self.dist_matrix)
+        self.route_of = [None] * num_loads
+        self.pos_of = [0] * num_loads
+        self.routes = []
+        self.prefix = []
+        self.link_fwd = []
+        self.link_rev = []
+        self.length = []
+        if isinstance(solution, Routes):
+            solution = solution.schedules()
+        for schedule in solution:
+            self.routes.append([self.depot_id] + list(schedule) + [self.depot_id])
+            self.prefix.append(None)
+            self.link_fwd.append(None)
+            self.link_rev.append(None)
+            self.length.append(0.0)
+            self._refresh(len(self.routes) - 1)
+
+    def solution(self):
+        return [route[1:-1] for route in self.routes if route is not None]
+
+    def to_routes(self):
+        return Routes.from_schedules(self.ss, self.solution())
+
+    def cost(self):
+        return sum(500 + length for route, length in zip(self.routes, self.length) if route is not None)
+
+    def _refresh(self, r):
+        """ Recompute positions and prefix sums of route r after it changed """
+        route = self.routes[r]
+        if len(route) == 2:
+            # emptied by a move
+            self.routes[r] = None
+            self.length[r] = 0.0
+            return
+        d = self.dist_matrix.item
+        prefix = [0.0]
+        link_fwd = [0.0]
+        link_rev = [0.0]
+        for k in range(len(route) - 1):
+            a, b = route[k], route[k + 1]
+            link = d(a, b)
+            prefix.append(prefix[-1] + link + d(b, b))
+            link_fwd.append(link_fwd[-1] + link)
+            link_rev.append(link_rev[-1] + d(b, a))
+        for k in range(1, len(route) - 1):
+            self.route_of[route[k]] = r
+            self.pos_of[route[k]] = k
+        self.prefix[r] = prefix
+        self.link_fwd[r] = link_fwd
+        self.link_rev[r] = link_rev
+        self.length[r] = prefix[-1]
+
+    def _suffix(self, r, k):
+        """ Cost from arriving at position k of route r (including its own load) back to the depot """
+        node = self.routes[r][k]
+        return self.length[r] - self.prefix[r][k] + self.dist_matrix.item(node, node)
+
+    def improve(self, loads=None):
+        """ One pass over the candidate moves of every load, or of the given loads. Returns whether anything improved """
+        improved = False
+        for x in (range(1, len(self.dist_matrix)) if loads is None else loads):
+            if self.out_of_time():
+                break
+            best = None
+            for y in self.successors[x]:
+                for move in self._moves(x, y):
+                    self.moves_evaluated += 1
+                    if move[0] < -IMPROVEMENT_EPS and (best is None or move[0] < best[0]):
+                        best = move
+                        if not self.best_improvement:
+                            break
+                if best is not None and not self.best_improvement:
+                    break
+            if best is not None:
+                self._apply(best)
+                improved = True
+        return improved
+
+    def _moves(self, x, y):
+        """ Yields (delta, kind, *args) for every feasible move that makes y follow x """
+        rx, ry = self.route_of[x], self.route_of[y]
+        px, py = self.pos_of[x], self.pos_of[y]
+        if rx == ry and py == px + 1:
+            return
+        for s in range(1, self.max_segment_length + 1):
+            # segment ending at x goes in front of y
+            if px - s + 1 >= 1:
+                move = self._relocate(rx, px - s + 1, px, ry, py - 1)
+                if move is not None:
+                    yield move
+            # segment starting at y goes behind x
+            if py + s - 1 <= len(self.routes[ry]) - 2:
+                move = self._relocate(ry, py, py + s - 1, rx, px)
+                if move is not None:
+                    yield move
+        if rx != ry:
+            if py > 1:
+                move = self._exchange(rx, px, ry, py - 1)
+                if move is not None:
+                    yield move
+            if px < len(self.routes[rx]) - 2:
+                move = self._exchange(ry, py, rx, px + 1)
+                if move is not None:
+                    yield move
+            move = self._two_opt_star(rx, px, ry, py)
+            if move is not None:
+                yield move
+        elif px < py:
+            for a, b in ((px + 1, py), (px, py - 1)):
+                if a < b:
+                    move = self._two_opt(rx, a, b)
+                    if move is not None:
+                        yield move
+
+    def _relocate(self, ra, a, b, rb, c):
+        """ Move positions a..b of route ra to between positions c and c+1 of route rb """
+        if ra == rb and a - 1 <= c <= b:
+            return None
+        d = self.dist_matrix.item
+        seq_a, seq_b = self.routes[ra], self.routes[rb]
+        first, last = seq_a[a], seq_a[b]
+        prefix = self.prefix[ra]
+        segment = prefix[b] - prefix[a] + d(first, first)
+        removed = (self.length[ra] - (prefix[b] - prefix[a - 1]) - d(last, seq_a[b + 1])
+                   + d(seq_a[a - 1], seq_a[b + 1]))
+        u, v = seq_b[c], seq_b[c + 1]
+        inserted = d(u, first) + segment + d(last, v) - d(u, v)
+        if ra == rb:
+            new_len = removed + inserted
+            if new_len > self.distance_constraint:
+                return None
+            return new_len - self.length[ra], 'relocate', ra, a, b, rb, c
+        new_b = self.length[rb] + inserted
+        if new_b > self.distance_constraint:
+            return None
+        # removed is 0 when the whole route moves, which saves its driver
+        delta = removed - self.length[ra] + inserted - (500 if a == 1 and b == len(seq_a) - 2 else 0)
+        return delta, 'relocate', ra, a, b, rb, c
+
+    def _exchange(self, ra, i, rb, j):
+        """ Swap position i of route ra with position j of route rb """
+        d = self.dist_matrix.item
+        seq_a, seq_b = self.routes[ra], self.routes[rb]
+        x, y = seq_a[i], seq_b[j]
+        pa, na = seq_a[i - 1], seq_a[i + 1]
+        pb, nb = seq_b[j - 1], seq_b[j + 1]
+        dx, dy = d(x, x), d(y, y)
+        new_a = self.length[ra] - d(pa, x) - dx - d(x, na) + d(pa, y) + dy + d(y, na)
+        if new_a > self.distance_constraint:
+            return None
+        new_b = self.length[rb] - d(pb, y) - dy - d(y, nb) + d(pb, x) + dx + d(x, nb)
+        if new_b > self.distance_constraint:
+            return None
+        return new_a + new_b - self.length[ra] - self.length[rb], 'exchange', ra, i, rb, j
+
+    def _two_opt(self, r, a, b):
+        """ Reverse positions a..b of route r """
+        d = self.dist_matrix.item
+        seq = self.routes[r]
+        link_fwd, link_rev = self.link_fwd[r], self.link_rev[r]
+        new_len = (self.length[r] - d(seq[a - 1], seq[a]) - (link_fwd[b] - link_fwd[a]) - d(seq[b], seq[b + 1])
+                   + d(seq[a - 1], seq[b]) + (link_rev[b] - link_rev[a]) + d(seq[a], seq[b + 1]))
+        if new_len > self.distance_constraint:
+            return None
+        return new_len - self.length[r], 'two_opt', r, a, b
+
+    def _two_opt_star(self, ra, i, rb, j):
+        """ Route ra keeps positions ..i then takes rb from j on, rb keeps ..j-1 then takes ra from i+1 on """
+        d = self.dist_matrix.item
+        seq_a, seq_b = self.routes[ra], self.routes[rb]
+        new_a = self.prefix[ra][i] + d(seq_a[i], seq_b[j]) + self._suffix(rb, j)
+        if new_a > self.distance_constraint:
+            return None
+        new_b = self.prefix[rb][j - 1] + d(seq_b[j - 1], seq_a[i + 1]) + self._suffix(ra, i + 1)
+        if new_b > self.distance_constraint:
+            return None
+        delta = new_a + new_b - self.length[ra] - self.length[rb]
+        if j == 1 and i + 1 == len(seq_a) - 1:
+            # rb is left with nothing
+            delta -= 500
+        return delta, 'two_opt_star', ra, i, rb, j
+
+    def eliminate_routes(self, route_ids=None):
+        """
+        Try to empty the smallest routes (of route_ids, the indexes of the schedules this search was
+        given, if set) by inserting their loads into the other routes.
+
+        Loads go in at their cheapest feasible position. When a load fits nowhere, an ejection chain
+        puts it in place of one of its candidate successors, which in turn is inserted elsewhere. A
+        route is only removed if all its loads find a place, otherwise it is left as it was.
+
+        Every link in the solution is kept in arrays indexed by the node it leaves (a load, or the
+        depot start of a route), so the insertion delta of a load at every position in the solution is
+        one vectorized gather. Returns the number of routes removed.
+        """
+        self._index_all_links()
+        removed = 0
+        candidates = range(len(self.routes)) if route_ids is None else route_ids
+        by_size = sorted((len(self.routes[r]), self.length[r], r) for r in candidates if self.routes[r] is not None)
+        for _, _, r in by_size:
+            if self.out_of_time():
+                break
+            if self.routes[r] is not None and self._eliminate_route(r):
+                removed += 1
+        return removed
+
+    def insert_loads(self, load_ids):
+        """
+        Put loads that are on no route into the solution, largest first, each at its cheapest feasible
+        position, in place of a candidate successor (ejection chain) when it fits nowhere directly, or
+        else on a new route of its own. Returns the number of new routes.
+        """
+        self._index_all_links()
+        d = self.dist_matrix.item
+        new_routes = 0
+        for load_id in sorted(load_ids, key=lambda load_id: -d(load_id, load_id)):
+            deltas = self._insertion_deltas(load_id, ())
+            link = int(np.argmin(deltas)) if len(deltas) else 0
+            if len(deltas) and deltas[link] < np.inf:
+                self._insert_after_link(load_id, link)
+                continue
+            chain = self._ejection_chain(load_id, None)
+            if chain is not None and chain[0] < 500 + self._single_length(load_id):
+                _, ejected, link = chain
+                q = self.route_of[ejected]
+                self.routes[q][self.pos_of[ejected]] = load_id
+                self._refresh(q)
+                self._index_links(q)
+                self._insert_after_link(ejected, link)
+                continue
+            self._add_route(load_id)
+            new_routes += 1
+        return new_routes
+
+    def _single_length(self, load_id):
+        d = self.dist_matrix.item
+        return d(self.depot_id, load_id) + d(load_id, load_id) + d(load_id, self.depot_id)
+
+    def _add_route(self, load_id):
+        """ A new route serving only load_id, also added to the link index """
+        r = len(self.routes)
+        self.routes.append([self.depot_id, load_id, self.depot_id])
+        self.prefix.append(None)
+        self.link_fwd.append(None)
+        self.link_rev.append(None)
+        self.length.append(0.0)
+        self._refresh(r)
+        self.link_to = np.append(self.link_to, 0)
+        self.link_from = np.append(self.link_from, self.depot_id)
+        self.link_route = np.append(self.link_route, -1)
+        self.route_length = np.append(self.route_length, 0.0)
+        self._index_links(r)
+
+    def _index_all_links(self):
+        num_loads = len(self.dist_matrix)
+        num_routes = len(self.routes)
+        # link k leaves load k, or the depot start of route k - num_loads
+        self.link_to = np.zeros(num_loads + num_routes, dtype=np.intp)
+        self.link_from = np.concatenate([np.arange(num_loads), np.full(num_routes, self.depot_id)])
+        self.link_route = np.full(num_loads + num_routes, -1, dtype=np.intp)
+        self.route_length = np.array(self.length, dtype=np.float64)
+        for r, route in enumerate(self.routes):
+            if route is not None:
+                self._index_links(r)
+
+    def _index_links(self, r):
+        route = self.routes[r]
+        if route is None:
+            return
+        starts = [len(self.dist_matrix) + r] + route[1:-1]
+        self.link_to[starts] = route[1:]
+        self.link_route[starts] = r
+        self.route_length[r] = self.length[r]
+
+    def _insertion_deltas(self, load_id, excluded_routes):
+        """ Distance added by inserting load_id after every link's start, inf where infeasible """
+        d = self.dist_matrix
+        valid = self.link_route >= 0
+        for r in excluded_routes:
+            valid &= self.link_route != r
+        deltas = np.full(len(self.link_route), np.inf)
+        links = np.flatnonzero(valid)
+        link_from, link_to = self.link_from[links], self.link_to[links]
+        added = d[link_from, load_id] + d[load_id, load_id] + d[load_id, link_to] - d[link_from, link_to]
+        feasible = self.route_length[self.link_route[links]] + added <= self.distance_constraint
+        deltas[links[feasible]] = added[feasible]
+        return deltas
+
+    def _insertion_deltas_many(self, load_ids):
+        """ _insertion_deltas of several loads in one gather: the valid links and a row of deltas per load """
+        d = self.dist_matrix
+        links = np.flatnonzero(self.link_route >= 0)
+        link_from, link_to = self.link_from[links], self.link_to[links]
+        loads = np.asarray(load_ids)[:, np.newaxis]
+        added = d[link_from, loads] + d[loads, loads] + d[loads, link_to] - d[link_from, link_to]
+        feasible = self.route_length[self.link_route[links]] + added <= self.distance_constraint
+        return links, np.where(feasible, added, np.inf)
+
+    def _insert_after_link(self, load_id, link):
+        r = self.link_route[link]
+        seq = self.routes[r]
+        position = 0 if link >= len(self.dist_matrix) else self.pos_of[link]
+        seq.insert(position + 1, load_id)
+        self._refresh(r)
+        self._index_links(r)
+
+    def _eliminate_route(self, r):
+        d = self.dist_matrix.item
+        loads = sorted(self.routes[r][1:-1], key=lambda load_id: -d(load_id, load_id))
+        old_length = self.length[r]
+        # route -> its sequence before this attempt, to roll back
+        touched = {}
+        added = 0.0
+        for load_id in loads:
+            deltas = self._insertion_deltas(load_id, (r,))
+            link = int(np.argmin(deltas))
+            if deltas[link] < np.inf:
+                touched.setdefault(int(self.link_route[link]), list(self.routes[self.link_route[link]]))
+                added += deltas[link]
+                self._insert_after_link(load_id, link)
+                continue
+            chain = self._ejection_chain(load_id, r)
+            if chain is None:
+                self._rollback(r, touched)
+                return False
+            delta, ejected, link = chain
+            q = self.route_of[ejected]
+            touched.setdefault(q, list(self.routes[q]))
+            link_route = int(self.link_route[link])
+            touched.setdefault(link_route, list(self.routes[link_route]))
+            added += delta
+            self.routes[q][self.pos_of[ejected]] = load_id
+            self._refresh(q)
+            self._index_links(q)
+            self._insert_after_link(ejected, link)
+
+        if added - old_length - 500 >= -IMPROVEMENT_EPS:
+            self._rollback(r, touched)
+            return False
+        self.moves_applied += 1
+        self.routes[r] = None
+        self.length[r] = 0.0
+        self.route_length[r] = 0.0
+        self.link_route[len(self.dist_matrix) + r] = -1
+        logging.debug("Eliminated route %s with %s loads", r, len(loads))
+        return True
+
+    def _ejection_chain(self, load_id, r):
+        """ Best (delta, ejected load, link to reinsert it at) for putting load_id in place of a neighbour """
+        d = self.dist_matrix.item
+        best = None
+        for ejected in self.successors[load_id]:
+            q = self.route_of[ejected]
+            # the candidate may itself be waiting for insertion
+            if q is None or q == r or self.routes[q] is None:
+                continue
+            seq = self.routes[q]
+            k = self.pos_of[ejected]
+            prev, nxt = seq[k - 1], seq[k + 1]
+            replaced = (d(prev, load_id) + d(load_id, load_id) + d(load_id, nxt)
+                        - d(prev, ejected) - d(ejected, ejected) - d(ejected, nxt))
+            if self.length[q] + replaced > self.distance_constraint:
+                continue
+            deltas = self._insertion_deltas(ejected, (r, q))
+            link = int(np.argmin(deltas))
+            if deltas[link] < np.inf and (best is None or replaced + deltas[link] < best[0]):
+                best = (replaced + deltas[link], ejected, link)
+        return best
+
+    def _rollback(self, r, touched):
+        for q, seq in touched.items():
+            self.routes[q] = seq
+            self._refresh(q)
+            self._index_links(q)
+        # the loads still in r may have been pointed at their new routes
+        self._refresh(r)
+        self._index_links(r)
+
+    def _apply(self, move):
+        delta, kind = move[0], move[1]
+        self.moves_applied += 1
+        if kind == 'relocate':
+            ra, a, b, rb, c = move[2:]
+            seq_a = self.routes[ra]
+            segment = seq_a[a:b + 1]
+            if ra == rb:
+                if c < a:
+                    seq_a[:] = seq_a[:c + 1] + segment + seq_a[c + 1:a] + seq_a[b + 1:]
+                else:
+                    seq_a[:] = seq_a[:a] + seq_a[b + 1:c + 1] + segment + seq_a[c + 1:]
+            else:
+                seq_b = self.routes[rb]
+                seq_b[c + 1:c + 1] = segment
+                del seq_a[a:b + 1]
+                self._refresh(rb)
+            self._refresh(ra)
+        elif kind == 'exchange':
+            ra, i, rb, j = move[2:]
+            seq_a, seq_b = self.routes[ra], self.routes[rb]
+            seq_a[i], seq_b[j] = seq_b[j], seq_a[i]
+            self._refresh(ra)
+            self._refresh(rb)
+        elif kind == 'two_opt':
+            r, a, b = move[2:]
+            seq = self.routes[r]
+            seq[a:b + 1] = seq[a:b + 1][::-1]
+            self._refresh(r)
+        elif kind == 'two_opt_star':
+            ra, i, rb, j = move[2:]
+            seq_a, seq_b = self.routes[ra], self.routes[rb]
+            self.routes[ra] = seq_a[:i + 1] + seq_b[j:]
+            self.routes[rb] = seq_b[:j] + seq_a[i + 1:]
+            self._refresh(ra)
+            self._refresh(rb)
+        logging.debug("Applied %s move with delta %s", kind, delta)
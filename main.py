@@ -1,13 +1,145 @@
 import sys
 import argparse
-from evaluateShared import loadProblemFromFile
-from visualize import visualize
-import clarke_wright
 import logging
 import time
+# Kept light on purpose: numpy and the solver modules are imported when solving, matplotlib only with
+# --visualize or --plot. startup_benchmark.py checks that this stays that way.
+
+
+def add_solver_arguments(parser):
+    parser.add_argument("--random-swap-factor", dest='random_swap_factor', required=False, type=float)
+    parser.add_argument("--local-search-iterations", dest='local_search_iterations', required=False, type=int)
+    parser.add_argument("--local-search-neighbours", dest='local_search_neighbours', required=False, type=int, default=20)
+    parser.add_argument("--best-improvement", dest='best_improvement', required=False, action='store_true')
+    parser.add_argument("--route-elimination", dest='route_elimination', required=False, action='store_true')
+    parser.add_argument("--sparse-savings", dest='sparse_savings', required=False, action='store_true')
+    parser.add_argument("--savings-neighbours", dest='savings_neighbours', required=False, type=int)
+    parser.add_argument("--time-limit", dest='time_limit', required=False, type=float, default=20.0,
+                        help='wall clock budget in seconds for the solve')
+    parser.add_argument("--target-gap", dest='target_gap', required=False, type=float,
+                        help='stop before the time limit once the cost is within this share (0.02 is 2%%) of the '
+                             'lower bound')
+    parser.add_argument("--stall-time", dest='stall_time', required=False, type=float,
+                        help='stop before the time limit once the cost has not improved for this many seconds')
+    parser.add_argument("--memory-budget", dest='memory_budget', required=False, type=float, default=2048,
+                        help='MiB the distance matrix and savings list may use. Larger problems compute distances '
+                             'on demand and use sparse savings')
+    parser.add_argument("--route-pool", dest='route_pool', required=False, action='store_true',
+                        help='with --random-swap-factor, keep the routes of every restart and spend the last part of '
+                             'the time limit combining the best of them')
+    parser.add_argument("--alns", required=False, action='store_true',
+                        help='improve the constructed solution with adaptive large neighbourhood search until the time limit')
+    parser.add_argument("--regions", required=False, type=int,
+                        help='split the loads into this many regions, solve them separately and repair the boundaries')
+    parser.add_argument("--partition", required=False, choices=['sectors', 'kmeans'], default='sectors',
+                        help='how --regions splits the loads: angular sectors around the depot or k-means')
+    parser.add_argument("--instrument", required=False, action='store_true',
+                        help='count link attempts by kind and local search moves, and record the peak memory after '
+                             'each phase, in the solver stats (see --stats-file)')
+    parser.add_argument("--workers", required=False, type=int, default=1)
+    parser.add_argument("--seed", required=False, type=int)
+
+
+def memory_budget_bytes(args):
+    return int(args.memory_budget * (1 << 20))
+
+
+def prepare_problem(vrp_problem):
+    # make a usability tweak to the problem data and turn ids from strings to ints
+    for load in vrp_problem.loads:
+        load.id = int(load.id)
+    return vrp_problem
+
+
+def solve(vrp_problem, args, start_time, ss=None, stats=None, initial_solution=None, report_gap=True):
+    """
+    Solve with the options from add_solver_arguments. ss can be a prebuilt StaticState for the problem
+    (vrp_problem may then be None), and the solver's phase timings and counters are added to the stats dict if one is given.
+    initial_solution is a list of schedules to improve instead of constructing from scratch.
+
+    The cost is reported with its gap to the lower bound of bounds.lower_bound, which is skipped on
+    problems with on demand distances, or without report_gap, unless --target-gap needs it.
+    """
+    import clarke_wright
+    import distances
+    if ss is None:
+        ss = clarke_wright.StaticState(vrp_problem, memory_budget=memory_budget_bytes(args))
+        if stats is not None:
+            stats['matrix_seconds'] = ss.build_seconds
+    bound = None
+    if args.target_gap is not None or (report_gap and not isinstance(ss.dist_matrix, distances.LazyDistances)):
+        from bounds import lower_bound
+        start = time.time()
+        bound = lower_bound(ss)
+        bound_seconds = time.time() - start
+        logging.info(f"{bound} in {bound_seconds:.3f}s")
+    early_stop = None
+    if args.target_gap is not None or args.stall_time is not None:
+        from bounds import EarlyStop
+        early_stop = EarlyStop(bound, target_gap=args.target_gap, stall_seconds=args.stall_time)
+    solver_args = dict(local_search_iterations=args.local_search_iterations,
+                       local_search_neighbours=args.local_search_neighbours,
+                       best_improvement=args.best_improvement,
+                       route_elimination=args.route_elimination,
+                       sparse_savings=args.sparse_savings,
+                       savings_neighbours=args.savings_neighbours,
+                       ss=ss,
+                       initial_solution=initial_solution,
+                       instrument=args.instrument,
+                       early_stop=early_stop)
+
+    if args.alns and (args.regions or args.random_swap_factor):
+        raise Exception("--alns can't be combined with --regions or --random-swap-factor")
+    if args.route_pool and not args.random_swap_factor:
+        raise Exception("--route-pool collects the routes of the --random-swap-factor restarts")
+    if args.regions:
+        from decomposition import DecompositionSolver
+        if initial_solution is not None:
+            raise Exception("an initial solution can't be combined with --regions")
+        del solver_args['initial_solution']
+        del solver_args['ss']
+        solver = DecompositionSolver(ss, args.regions, partition=args.partition, workers=args.workers,
+                                     seed=args.seed, deadline=start_time + args.time_limit,
+                                     random_swap_factor=args.random_swap_factor, **solver_args)
+    elif args.alns:
+        from alns import ALNSSolver
+        solver = ALNSSolver(vrp_problem, seed=args.seed, deadline=start_time + args.time_limit, **solver_args)
+    elif args.random_swap_factor:
+        from multistart import MultiStartSolver
+        solver = MultiStartSolver(vrp_problem, args.random_swap_factor, workers=args.workers,
+                                  seed=args.seed, deadline=start_time + args.time_limit,
+                                  route_pool=args.route_pool, **solver_args)
+    else:
+        solver = clarke_wright.Solver(vrp_problem, deadline=start_time + args.time_limit, **solver_args)
+    solution, cost = None, None
+    for solution, cost in solver.solve_anytime():
+        if early_stop is not None:
+            early_stop.improved(cost)
+            if early_stop.should_stop():
+                break
+    if bound is None:
+        logging.warning(f"Solution Cost: {cost}")
+    else:
+        logging.warning(f"Solution Cost: {cost}, {bound.gap(cost):.1%} over the lower bound {bound.cost:.1f}")
+    if early_stop is not None and early_stop.reason is not None:
+        logging.info(f"Stopped early on {early_stop.reason} after {time.time() - start_time:.3f}s")
+    if stats is not None:
+        stats.update(solver.stats)
+        if bound is not None:
+            stats['lower_bound_seconds'] = bound_seconds
+            stats['lower_bound'] = bound.cost
+            stats['gap'] = bound.gap(cost)
+        if early_stop is not None and early_stop.reason is not None:
+            stats['stopped_on_' + early_stop.reason] = 1
+    return solution, cost
+
+
+def format_solution(solution):
+    return "".join(str(truck) + "\n" for truck in solution)
 
 
 if __name__ == '__main__':
+    start_time = time.time()
     logging.basicConfig(
         level=logging.ERROR,
         format="%(asctime)s [%(levelname)s] %(message)s",
@@ -17,36 +149,67 @@ if __name__ == '__main__':
     )
     parser = argparse.ArgumentParser(description='Description of your program')
     parser.add_argument("input_path", help='path to input file with problem')
-    parser.add_argument("--random-swap-factor", dest='random_swap_factor', required=False, type=float)
-    parser.add_argument("--local-search-iterations", dest='local_search_iterations', required=False, type=int)
+    add_solver_arguments(parser)
     parser.add_argument("--visualize", required=False, action='store_true')
+    parser.add_argument("--plot", required=False,
+                        help='save a plot of the solution to this file (png, svg or pdf by extension), no display needed')
+    parser.add_argument("--plot-routes", dest='plot_routes', required=False, type=int,
+                        help='draw a random sample of this many routes in --visualize and --plot')
+    parser.add_argument("--plot-depot-legs", dest='plot_depot_legs', required=False, action='store_true',
+                        help='also draw the legs out of and back to the depot')
+    parser.add_argument("--plot-changes-from", dest='plot_changes_from', required=False,
+                        help='file with another solution of the problem; plot only the routes that differ from it')
+    parser.add_argument("--stats-file", dest='stats_file', required=False,
+                        help='write solver phase timings and counters to this file as json')
+    parser.add_argument("--cache-dir", dest='cache_dir', required=False,
+                        help='cache the parsed problem and distance matrix here, keyed by the file contents')
+    parser.add_argument("--initial-solution", dest='initial_solution', required=False,
+                        help='file with a prior solution in the output format to improve instead of constructing one. '
+                             'Loads it misses are inserted, unknown loads dropped')
+    parser.add_argument("--profile", required=False,
+                        help='profile the solve and save the result to this file')
+    parser.add_argument("--profiler", required=False, choices=['cprofile', 'pyinstrument'], default='cprofile',
+                        help='cprofile saves pstats data, pyinstrument (if installed) an html report')
     args = parser.parse_args()
 
-    vrp_problem = loadProblemFromFile(args.input_path)
-    # make a usability tweak to the problem data and turn ids from strings to ints
-    for load in vrp_problem.loads:
-        load.id = int(load.id)
+    # the solver and the plots only need the coordinate arrays, no Load objects
+    from problem_cache import load_static_state
+    stats = {}
+    ss = load_static_state(args.input_path, cache_dir=args.cache_dir, stats=stats,
+                           memory_budget=memory_budget_bytes(args))
 
-    logging.debug(vrp_problem)
-
-    if args.random_swap_factor:
-        solution, cost = clarke_wright.Solver(vrp_problem, local_search_iterations=args.local_search_iterations).solve()
-        logging.warning(f"Initial Solution Cost: {cost}")
-        t_end = time.time() + 20  # approx run for ~20 seconds
-        while time.time() < t_end:
-            tmp_solution, tmp_cost = clarke_wright.Solver(vrp_problem,
-                                                          random_swap_factor=args.random_swap_factor,
-                                                          local_search_iterations=args.local_search_iterations).solve()
-            if tmp_cost < cost:
-                solution = tmp_solution
-                cost = tmp_cost
-                logging.warning(f"Better Solution Cost: {cost}")
+    initial_solution = None
+    if args.initial_solution:
+        from utils import parse_solution_str
+        with open(args.initial_solution) as f:
+            initial_solution = parse_solution_str(f.read())
+
+    if args.profile:
+        from profiling import profiled
+        with profiled(args.profile, args.profiler):
+            solution, cost = solve(None, args, start_time, ss=ss, stats=stats, initial_solution=initial_solution)
     else:
-        solution, cost = clarke_wright.Solver(vrp_problem, local_search_iterations=args.local_search_iterations).solve()
-        logging.warning(f"Solution Cost: {cost}")
+        solution, cost = solve(None, args, start_time, ss=ss, stats=stats, initial_solution=initial_solution)
+
+    sys.stdout.write(format_solution(solution))
 
-    for truck in solution:
-        print(truck)
+    if args.stats_file:
+        import json
+        stats['total_seconds'] = time.time() - start_time
+        if args.instrument:
+            from profiling import peak_rss_mb
+            stats['peak_rss_mb'] = peak_rss_mb()
+        with open(args.stats_file, "w") as f:
+            json.dump(stats, f)
 
-    if args.visualize:
-        visualize(vrp_problem.loads, solution)
+    if args.visualize or args.plot:
+        import visualize
+        if args.plot_changes_from:
+            from utils import parse_solution_str
+            with open(args.plot_changes_from) as f:
+                before = parse_solution_str(f.read())
+            visualize.plot_changes(ss.pickups, ss.dropoffs, before, solution, path=args.plot,
+                                   depot_legs=args.plot_depot_legs)
+        else:
+            visualize.plot_solution(ss.pickups, ss.dropoffs, solution, path=args.plot, max_routes=args.plot_routes,
+                                    depot_legs=args.plot_depot_legs, seed=args.seed or 0)
@@ -0,0 +1,289 @@
+import sys
+import os
+import json
+import math
+import time
+import argparse
+import tracemalloc
+import numpy as np
+import clarke_wright
+import distances
+import utils
+
+
+PHASES = ["matrix", "savings", "sort", "construction", "local_search", "cost"]
+LAYOUTS = ["uniform", "clustered"]
+# the sizes past the memory budget run on on demand distances and sparse savings, so the sweep stays
+# within --memory-budget all the way up
+DEFAULT_SIZES = [100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000]
+# from this many loads a phase takes seconds, so one timed run is enough whatever --repeat says
+SINGLE_RUN_SIZE = 10000
+# loads lie in a disc of this radius around the depot, so depot -> pickup -> dropoff -> depot is at
+# most 4 * RADIUS = 700 minutes and every load fits in a route of its own
+RADIUS = 175.0
+# clustered layout: one cluster per this many loads (at least MIN_CLUSTERS), spread by CLUSTER_SPREAD * RADIUS
+LOADS_PER_CLUSTER = 100
+MIN_CLUSTERS = 4
+CLUSTER_SPREAD = 0.06
+# phases faster than this are timer noise, and never count as regressions
+MIN_COMPARED_SECONDS = 0.02
+
+
+def _disc_points(rng, count, radius):
+    """ Uniform points in a disc around the origin """
+    r = radius * np.sqrt(rng.random(count))
+    angle = rng.random(count) * 2 * math.pi
+    return np.stack([r * np.cos(angle), r * np.sin(angle)], axis=1)
+
+
+def _layout_points(rng, count, layout, centres):
+    if layout == "uniform":
+        return _disc_points(rng, count, RADIUS)
+    points = centres[rng.integers(len(centres), size=count)] + rng.normal(0.0, CLUSTER_SPREAD * RADIUS, (count, 2))
+    # pull the few points that fell out of the disc back onto its edge
+    norms = np.maximum(np.hypot(points[:, 0], points[:, 1]) / RADIUS, 1.0)
+    return points / norms[:, np.newaxis]
+
+
+def generate_problem_str(num_loads, layout="uniform", seed=0):
+    """
+    A random problem in the `loadNumber pickup dropoff` format. "uniform" spreads pickups and dropoffs
+    over a disc around the depot, "clustered" draws both around a shared set of cluster centres. The
+    same (num_loads, layout, seed) always gives the same problem.
+    """
+    if layout not in LAYOUTS:
+        raise Exception(f"unknown layout {layout}, expected one of {LAYOUTS}")
+    rng = np.random.default_rng([seed, num_loads, LAYOUTS.index(layout)])
+    centres = _disc_points(rng, max(MIN_CLUSTERS, num_loads // LOADS_PER_CLUSTER), RADIUS * 0.8)
+    pickups = _layout_points(rng, num_loads, layout, centres).tolist()
+    dropoffs = _layout_points(rng, num_loads, layout, centres).tolist()
+    lines = ["loadNumber pickup dropoff"]
+    lines.extend(f"{load_id} ({px},{py}) ({dx},{dy})"
+                 for load_id, ((px, py), (dx, dy)) in enumerate(zip(pickups, dropoffs), start=1))
+    return "\n".join(lines) + "\n"
+
+
+def write_problems(directory, sizes, layouts, seed=0):
+    """ Write generate_problem_str instances as <layout>_<num_loads>.txt files. Returns their paths """
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for layout in layouts:
+        for num_loads in sizes:
+            path = os.path.join(directory, f"{layout}_{num_loads}.txt")
+            with open(path, "w") as f:
+                f.write(generate_problem_str(num_loads, layout, seed))
+            paths.append(path)
+    return paths
+
+
+class PhaseMemory:
+    """ Peak bytes each phase allocated over what was live when it started, with tracemalloc """
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.peaks = {}
+        self._phase = None
+        self._live = 0
+
+    def start(self, phase):
+        if self.enabled:
+            self._phase = phase
+            tracemalloc.reset_peak()
+            self._live = tracemalloc.get_traced_memory()[0]
+
+    def stop(self):
+        if self.enabled:
+            self.peaks[self._phase] = max(0, tracemalloc.get_traced_memory()[1] - self._live)
+
+
+def run_phases(problem_str, memory_budget=distances.DEFAULT_MEMORY_BUDGET, trace_memory=False):
+    """
+    One run of every phase on a problem: the distance matrix (dense or on demand, by memory_budget),
+    the savings list, its sort, the clarke and wright merge pass, one local search pass and the
+    validated solution cost. Returns ({phase: seconds}, {phase: peak bytes} if trace_memory else {},
+    the backends used: "dense" or "lazy" distances and "full" or "sparse" savings). Memory tracing
+    slows the python loops down, so the seconds of such a run are not comparable.
+    """
+    pickups, dropoffs = utils.parse_problem_str(problem_str, clarke_wright.DEPOT, 0)
+    num_loads = len(pickups) - 1
+    seconds = {}
+    memory = PhaseMemory(trace_memory)
+
+    def timed(phase, fn, *args):
+        memory.start(phase)
+        start = time.perf_counter()
+        result = fn(*args)
+        seconds[phase] = time.perf_counter() - start
+        memory.stop()
+        return result
+
+    ss = timed("matrix", clarke_wright.StaticState, None, (pickups, dropoffs), None, memory_budget)
+    solver = clarke_wright.Solver(None, ss=ss)
+    savings = timed("savings", solver.create_savings)
+    timed("sort", savings.sort)
+    backends = {"matrix": "lazy" if isinstance(ss.dist_matrix, distances.LazyDistances) else "dense",
+                "savings": "full" if len(savings) == num_loads * (num_loads - 1) else "sparse"}
+    # the merge pass reads the solver's own sorted list, hand it the one just timed
+    solver._sorted_savings = savings
+    routes = timed("construction", solver.run_clarke_wright)
+    del savings
+    search = timed("local_search", lambda: _one_pass(solver, routes))
+    schedules = search.solution()
+    timed("cost", utils.get_solution_cost, schedules, ss.dist_matrix, num_loads)
+    return seconds, memory.peaks, backends
+
+
+def _one_pass(solver, routes):
+    search = solver.local_search(routes)
+    search.improve()
+    return search
+
+
+def benchmark(sizes, layouts, repeat=1, seed=0, memory_budget=distances.DEFAULT_MEMORY_BUDGET, trace_memory=True,
+              log=print):
+    """
+    run_phases over every layout and size: the fastest of repeat runs for the seconds (one run from
+    SINGLE_RUN_SIZE loads), plus one traced run for the memory peaks. Returns a list of {"layout", "num_loads", "seconds", "peak_mb", "backends"}
+    results.
+    """
+    results = []
+    for layout in layouts:
+        for num_loads in sizes:
+            problem_str = generate_problem_str(num_loads, layout, seed)
+            best = {}
+            for _ in range(repeat if num_loads < SINGLE_RUN_SIZE else 1):
+                seconds, _, backends = run_phases(problem_str, memory_budget)
+                best = {phase: min(value, best.get(phase, value)) for phase, value in seconds.items()}
+            peak_mb = {}
+            if trace_memory:
+                tracemalloc.start()
+                try:
+                    _, peaks, _ = run_phases(problem_str, memory_budget, trace_memory=True)
+                finally:
+                    tracemalloc.stop()
+                peak_mb = {phase: value / (1 << 20) for phase, value in peaks.items()}
+            results.append({"layout": layout, "num_loads": num_loads, "seconds": best, "peak_mb": peak_mb,
+                            "backends": backends})
+            log(f"{layout} {num_loads}: " + ", ".join(f"{phase} {best[phase]:.4f}s" for phase in PHASES))
+    return results
+
+
+def scaling_exponents(results, layout, phase, key="seconds"):
+    """
+    For consecutive sizes of a layout, the exponent k of value ~ n^k between them: about 1 for linear
+    phases, 2 for quadratic ones. None where a value is missing or zero.
+    """
+    rows = sorted((r["num_loads"], r[key].get(phase)) for r in results if r["layout"] == layout)
+    exponents = []
+    for (n1, v1), (n2, v2) in zip(rows, rows[1:]):
+        exponents.append(math.log(v2 / v1) / math.log(n2 / n1) if v1 and v2 and n2 != n1 else None)
+    return exponents
+
+
+def format_report(results):
+    """
+    Per layout and phase, seconds and peak MiB by size with the scaling exponent from the size before.
+    An exponent across a change of backends (see run_phases) compares two different implementations.
+    """
+    lines = []
+    for layout in sorted({r["layout"] for r in results}, key=LAYOUTS.index):
+        rows = sorted((r for r in results if r["layout"] == layout), key=lambda r: r["num_loads"])
+        lines.append(f"{layout}:")
+        lines.append(f"\t{'loads':<13}" + "".join(f"{r['num_loads']:>24}" for r in rows))
+        lines.append(f"\t{'backends':<13}" + "".join(f"{r['backends']['matrix'] + ' ' + r['backends']['savings']:>24}"
+                                                   for r in rows))
+        for phase in PHASES:
+            exponents = [None] + scaling_exponents(results, layout, phase)
+            cells = []
+            for r, exponent in zip(rows, exponents):
+                cell = f"{r['seconds'][phase]:.4f}s"
+                if r["peak_mb"]:
+                    cell += f" {r['peak_mb'][phase]:.1f}MiB"
+                cell += f" ^{exponent:.1f}" if exponent is not None else "     "
+                cells.append(f"{cell:>24}")
+            lines.append(f"\t{phase:<13}" + "".join(cells))
+    return "\n".join(lines)
+
+
+def compare(results, baseline, tolerance):
+    """ Failures for every phase more than tolerance slower than in the baseline results of the same size """
+    failures = []
+    previous = {(r["layout"], r["num_loads"]): r for r in baseline}
+    for r in results:
+        before = previous.get((r["layout"], r["num_loads"]))
+        if before is None:
+            continue
+        for phase, seconds in r["seconds"].items():
+            allowed = before["seconds"].get(phase, math.inf) * (1.0 + tolerance)
+            if seconds > max(allowed, MIN_COMPARED_SECONDS):
+                failures.append(f"{r['layout']} {r['num_loads']} {phase}: {seconds:.4f}s, allowed {allowed:.4f}s")
+    return failures
+
+
+def plot_curves(results, path):
+    """ Save log-log time-vs-n and peak-memory-vs-n curves per phase, a line style per layout """
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    fig, (time_ax, memory_ax) = plt.subplots(1, 2, figsize=(14, 6))
+    styles = dict(zip(LAYOUTS, ["-", "--"]))
+    colors = dict(zip(PHASES, plt.get_cmap("tab10").colors))
+    for layout in sorted({r["layout"] for r in results}, key=LAYOUTS.index):
+        rows = sorted((r for r in results if r["layout"] == layout), key=lambda r: r["num_loads"])
+        sizes = [r["num_loads"] for r in rows]
+        for phase in PHASES:
+            label = f"{phase} ({layout})"
+            time_ax.plot(sizes, [r["seconds"][phase] for r in rows], styles[layout], color=colors[phase],
+                         marker="o", label=label)
+            if all(r["peak_mb"] for r in rows):
+                memory_ax.plot(sizes, [max(r["peak_mb"][phase], 1e-3) for r in rows], styles[layout],
+                               color=colors[phase], marker="o", label=label)
+    for ax, ylabel in ((time_ax, "seconds"), (memory_ax, "peak MiB")):
+        ax.set_xscale("log")
+        ax.set_yscale("log")
+        ax.set_xlabel("loads")
+        ax.set_ylabel(ylabel)
+        ax.grid(True, which="both", alpha=0.3)
+    time_ax.legend(fontsize=7)
+    fig.savefig(path, dpi=120, bbox_inches="tight")
+    plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Per phase time and memory scaling of the solver on generated problems")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="numbers of loads to generate")
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="runs per size to take the fastest of")
+    parser.add_argument("--memory-budget", dest='memory_budget', type=float, default=2048,
+                        help="MiB for the distance matrix and savings list, as in main.py")
+    parser.add_argument("--no-memory", dest='no_memory', action='store_true',
+                        help="skip the traced run that measures the memory peaks")
+    parser.add_argument("--write-problems", dest='write_problems',
+                        help="only write the generated problems to this directory")
+    parser.add_argument("--report", help="save the results to this json file")
+    parser.add_argument("--baseline", help="json report of an earlier run to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth of a phase's time")
+    parser.add_argument("--plot", help="save the scaling curves to this image file")
+    args = parser.parse_args()
+
+    if args.write_problems:
+        for path in write_problems(args.write_problems, args.sizes, args.layouts, args.seed):
+            print(path)
+        sys.exit(0)
+
+    results = benchmark(args.sizes, args.layouts, repeat=args.repeat, seed=args.seed,
+                        memory_budget=int(args.memory_budget * (1 << 20)), trace_memory=not args.no_memory)
+    print(format_report(results))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.plot:
+        plot_curves(results, args.plot)
+
+    failures = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.tolerance)
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,196 @@
+import logging
+import multiprocessing
+import queue
+import time
+import numpy as np
+import clarke_wright
+import profiling
+from route_pool import RoutePool, select_routes
+from problem import VRP
+
+
+# share of the time budget kept for the set partitioning over the route pool
+ROUTE_POOL_TIME_SHARE = 0.1
+
+# Set up once per worker process by _init_worker. With the fork start method the solver (distance
+# matrix and sorted savings) is inherited from the parent rather than copied per task.
+_worker_solver = None
+_worker_best_cost = None
+_worker_improvements = None
+_worker_collect_routes = False
+
+
+def _init_worker(solver, best_cost, improvements, collect_routes):
+    global _worker_solver, _worker_best_cost, _worker_improvements, _worker_collect_routes
+    _worker_solver = solver
+    # the early stop hears of improvements in the parent process, which ends the pool when it fires
+    _worker_solver.early_stop = None
+    # the sentinel sends this worker's stats to the parent, which adds them to its own
+    _worker_solver.stats = {}
+    _worker_best_cost = best_cost
+    _worker_improvements = improvements
+    _worker_collect_routes = collect_routes
+
+
+def _restarts(solver, rng):
+    """ Randomized restarts until the solver's deadline, yielding each (solution, cost) """
+    while not solver.out_of_time():
+        yield solver.solve(rng)
+
+
+def _worker(args):
+    seed, worker_idx = args
+    rng = np.random.default_rng([seed, worker_idx])
+    iterations = 0
+    pool = RoutePool(_worker_solver.dist_matrix) if _worker_collect_routes else None
+    for solution, cost in _restarts(_worker_solver, rng):
+        iterations += 1
+        if pool is not None:
+            pool.add_solution(solution)
+        if cost < _worker_best_cost.value:
+            with _worker_best_cost.get_lock():
+                if cost < _worker_best_cost.value:
+                    _worker_best_cost.value = cost
+                    _worker_improvements.put((solution, cost))
+    # sentinel, after every improvement this worker sent, with its stats and the routes it collected
+    routes = pool.items() if pool is not None else None
+    _worker_improvements.put((None, (iterations, _worker_solver.stats, routes)))
+
+
+class MultiStartSolver:
+    """
+    Runs the randomized clarke and wright restarts until a deadline. With an initial_solution the
+    first solution is that one, improved, instead of the plain construction.
+
+    The distance matrix and the sorted savings list are built once and shared read only with every
+    restart (and every worker process), so a restart only pays for the random swaps and the merge
+    pass. Each worker gets its own RNG seeded from (seed, worker index).
+
+    With route_pool, the distinct routes of every restart are collected (see route_pool.RoutePool) and
+    the last ROUTE_POOL_TIME_SHARE of the time goes to picking the best combination of them that serves
+    every load once, followed by local search.
+    """
+    def __init__(self, vrp: VRP, random_swap_factor, workers=1, seed=None, time_budget=20.0, deadline=None,
+                 ss=None, initial_solution=None, route_pool=False, **solver_args):
+        self.vrp = vrp
+        self.workers = workers
+        self.seed = seed if seed is not None else int(np.random.SeedSequence().entropy % (1 << 32))
+        self.time_budget = time_budget
+        # an explicit wall clock deadline wins over time_budget, which is counted from solve()
+        self.deadline = deadline
+        self.base_solver = clarke_wright.Solver(vrp, ss=ss, initial_solution=initial_solution, **solver_args)
+        self.random_solver = clarke_wright.Solver(vrp, random_swap_factor=random_swap_factor,
+                                                  ss=self.base_solver.ss, savings_from=self.base_solver,
+                                                  **solver_args)
+        self.iterations = 0
+        self.route_pool = RoutePool(self.base_solver.dist_matrix) if route_pool else None
+
+    @property
+    def stats(self):
+        """ Phase timings and counters of the solvers, the pool workers' included, plus the number of restarts """
+        stats = profiling.merge_stats(dict(self.base_solver.stats), self.random_solver.stats)
+        stats['restarts'] = self.iterations
+        if self.route_pool is not None:
+            stats['pool_routes_added'] = self.route_pool.added
+            stats['pool_routes'] = len(self.route_pool)
+        return stats
+
+    def solve(self):
+        solution, cost = None, None
+        for solution, cost in self.solve_anytime():
+            pass
+        return solution, cost
+
+    def solve_anytime(self):
+        """ Generator yielding each improved (solution, cost) until the time budget runs out """
+        deadline = self.deadline if self.deadline is not None else time.time() + self.time_budget
+        self.base_solver.deadline = deadline
+        self.random_solver.deadline = deadline
+        if self.route_pool is not None:
+            self.random_solver.deadline = deadline - ROUTE_POOL_TIME_SHARE * (deadline - time.time())
+
+        best_solution, best_cost = self.base_solver.solve()
+        logging.warning(f"Initial Solution Cost: {best_cost}")
+        yield best_solution, best_cost
+        if self.route_pool is not None:
+            self.route_pool.add_solution(best_solution)
+        # the restarts swap a copy of the base solver's sorted savings, built once before any worker starts
+        self.random_solver.sorted_savings()
+
+        if self.workers <= 1:
+            rng = np.random.default_rng([self.seed, 0])
+            improvements = self._restarts_in_process(rng)
+        else:
+            improvements = self._restarts_in_pool(best_cost)
+
+        for solution, cost in improvements:
+            if cost < best_cost:
+                best_solution, best_cost = solution, cost
+                logging.warning(f"Better Solution Cost: {best_cost}")
+                yield best_solution, best_cost
+        logging.info(f"Ran {self.iterations} restarts on {self.workers} workers with seed {self.seed}")
+
+        if self.route_pool is not None and not self._stopped_early():
+            solution = self._recombine(best_solution, deadline)
+            if solution is not None:
+                cost = self.base_solver.solution_cost(solution)
+                if cost < best_cost:
+                    best_solution, best_cost = solution, cost
+                    logging.warning(f"Route pool Solution Cost: {best_cost}")
+                    yield best_solution, best_cost
+
+    def _recombine(self, incumbent, deadline):
+        """ The best partition of the route pool, improved by local search until the deadline """
+        start = time.time()
+        # the partitioning gets most of the remaining time, local search the rest
+        solution = select_routes(self.route_pool, len(self.base_solver.dist_matrix) - 1,
+                                 (deadline - start) * 0.75, incumbent)
+        self.base_solver.add_time('set_partitioning', start)
+        if solution is None:
+            return None
+        start = time.time()
+        search = self.base_solver.local_search(solution)
+        while not self.base_solver.out_of_time() and search.improve():
+            pass
+        self.base_solver.add_time('pool_local_search', start)
+        return search.solution()
+
+    def _stopped_early(self):
+        early_stop = self.base_solver.early_stop
+        return early_stop is not None and early_stop.should_stop()
+
+    def _restarts_in_process(self, rng):
+        for solution, cost in _restarts(self.random_solver, rng):
+            self.iterations += 1
+            if self.route_pool is not None:
+                self.route_pool.add_solution(solution)
+            yield solution, cost
+
+    def _restarts_in_pool(self, initial_cost):
+        best_cost = multiprocessing.Value('d', initial_cost)
+        improvements = multiprocessing.Queue()
+        with multiprocessing.Pool(self.workers, initializer=_init_worker,
+                                  initargs=(self.random_solver, best_cost, improvements,
+                                            self.route_pool is not None)) as pool:
+            result = pool.map_async(_worker, [(self.seed, idx) for idx in range(self.workers)])
+            running = self.workers
+            while running:
+                try:
+                    solution, cost = improvements.get(timeout=0.1)
+                except queue.Empty:
+                    # re-raise a worker error, otherwise its sentinel is still on the way
+                    if result.ready():
+                        result.get()
+                    elif self._stopped_early():
+                        # leaving the pool terminates the workers
+                        return
+                    continue
+                if solution is None:
+                    running -= 1
+                    iterations, worker_stats, routes = cost
+                    self.iterations += iterations
+                    profiling.merge_stats(self.random_solver.stats, worker_stats)
+                    if routes is not None:
+                        self.route_pool.add_routes(routes)
+                else:
+                    yield solution, cost
@@ -0,0 +1,64 @@
+import io
+
+
+class Point:
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+    def toString(self):
+        return "(" + str(self.x) + "," + str(self.y) + ")"
+
+
+class Load:
+    def __init__(self, id, pickup, dropoff):
+        self.id = id
+        self.pickup = pickup
+        self.dropoff = dropoff
+
+
+class VRP:
+    def __init__(self, loads):
+        self.loads = loads
+
+    def toProblemString(self):
+        s = "loadNumber pickup dropoff\n"
+        for idx, load in enumerate(self.loads):
+            s += str(idx+1) + " " + load.pickup.toString() + " " + load.dropoff.toString() + "\n"
+        return s
+
+    def __str__(self):
+        return self.toProblemString()
+
+
+def loadProblemFromFile(filePath):
+    f = open(filePath, "r")
+    problemStr = f.read()
+    f.close()
+    return loadProblemFromProblemStr(problemStr)
+
+
+def getPointFromPointStr(pointStr):
+    pointStr = pointStr.replace("(","").replace(")","")
+    splits = pointStr.split(",")
+    return Point(float(splits[0]), float(splits[1]))
+
+
+def loadProblemFromProblemStr(problemStr):
+    loads = []
+    buf = io.StringIO(problemStr)
+    gotHeader = False
+    while True:
+        line = buf.readline()
+        if not gotHeader:
+            gotHeader = True
+            continue
+        if len(line) == 0:
+            break
+        line = line.replace("\n", "")
+        splits = line.split()
+        id = splits[0]
+        pickup = getPointFromPointStr(splits[1])
+        dropoff = getPointFromPointStr(splits[2])
+        loads.append(Load(id, pickup, dropoff))
+    return VRP(loads)
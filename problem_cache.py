@@ -0,0 +1,76 @@
+import hashlib
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+import utils
+import distances
+import clarke_wright
+
+
+# bump when the cached arrays change meaning, so stale entries are rebuilt instead of misread
+CACHE_VERSION = 1
+
+
+def problem_key(problem_bytes: bytes):
+    return hashlib.sha1(problem_bytes).hexdigest()
+
+
+def _save_atomically(path, save):
+    """ Write through a temporary file in the same directory, so concurrent runs never read half a file """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            save(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def load_static_state(file_path, cache_dir=None, stats=None, memory_budget=distances.DEFAULT_MEMORY_BUDGET):
+    """
+    StaticState for the problem file at file_path.
+
+    With a cache_dir, the coordinates and the distance matrix are stored as .npy files under the hash of
+    the file contents, and a repeated run on the same problem loads them instead of parsing and building
+    the matrix. The matrix is memory mapped read only, so it is only paged in as the solver touches it and
+    is shared between processes through the page cache. A matrix over memory_budget is not built, and
+    so not cached either: the StaticState gets a distances.LazyDistances. Parse and matrix timings are
+    added to stats.
+    """
+    start = time.time()
+    with open(file_path, "rb") as f:
+        problem_bytes = f.read()
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        base_path = os.path.join(cache_dir, f"{problem_key(problem_bytes)}.v{CACHE_VERSION}")
+        coordinates_path = base_path + ".coordinates.npy"
+        matrix_path = base_path + ".matrix.npy"
+        if os.path.exists(coordinates_path):
+            pickups, dropoffs = np.load(coordinates_path)
+            coordinates = (pickups, dropoffs)
+            dist_matrix = np.load(matrix_path, mmap_mode="r") if os.path.exists(matrix_path) else None
+            _add_stat(stats, "cache_load_seconds", time.time() - start)
+            logging.info(f"Loaded {file_path} from cache {base_path}")
+            return clarke_wright.StaticState(coordinates=coordinates, dist_matrix=dist_matrix,
+                                             memory_budget=memory_budget)
+
+    coordinates = utils.parse_problem_str(problem_bytes.decode("utf-8"), clarke_wright.DEPOT, 0)
+    _add_stat(stats, "parse_seconds", time.time() - start)
+    ss = clarke_wright.StaticState(coordinates=coordinates, memory_budget=memory_budget)
+    _add_stat(stats, "matrix_seconds", ss.build_seconds)
+
+    if cache_dir is not None:
+        # matrix first: an entry counts as cached once its coordinates exist
+        if isinstance(ss.dist_matrix, np.ndarray):
+            _save_atomically(matrix_path, lambda f: np.save(f, ss.dist_matrix))
+        _save_atomically(coordinates_path, lambda f: np.save(f, np.stack([ss.pickups, ss.dropoffs])))
+        logging.info(f"Cached {file_path} as {base_path}")
+    return ss
+
+
+def _add_stat(stats, name, value):
+    if stats is not None:
+        stats[name] = stats.get(name, 0) + value
@@ -0,0 +1,84 @@
+import contextlib
+import sys
+from routes import Routes, FREE
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process so far, in MiB, or None where the resource module is missing """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def merge_stats(stats, other):
+    """ Add the stats of another solver (or process) to stats: timings and counters add up, memory peaks don't """
+    for name, value in other.items():
+        if name.endswith("_peak_rss_mb"):
+            stats[name] = max(stats.get(name, 0), value)
+        else:
+            stats[name] = stats.get(name, 0) + value
+    return stats
+
+
+def link_kind(routes, tail, head):
+    """ What linking tail to head does: start a route from two free loads, extend a route by one, or merge two """
+    free = (routes.other_end[tail] == FREE) + (routes.other_end[head] == FREE)
+    return ("merge", "extend", "bootstrap")[free]
+
+
+class CountingRoutes(Routes):
+    """
+    routes.Routes that counts its can_link checks (attempts and infeasible ones) and links by kind, see
+    link_kind, into add_stat. The solver only builds one when instrumented, so plain solves pay nothing.
+    """
+    __slots__ = ('add_stat',)
+
+    def __init__(self, ss, add_stat):
+        super().__init__(ss)
+        self.add_stat = add_stat
+
+    def can_link(self, tail, head):
+        possible = super().can_link(tail, head)
+        kind = link_kind(self, tail, head)
+        self.add_stat(kind + "_attempts", 1)
+        if not possible:
+            self.add_stat(kind + "_infeasible", 1)
+        return possible
+
+    def link(self, tail, head):
+        self.add_stat(link_kind(self, tail, head) + "_links", 1)
+        super().link(tail, head)
+
+
+@contextlib.contextmanager
+def profiled(path, profiler="cprofile"):
+    """
+    Profile the block and save the result to path: cProfile stats (read them with pstats or snakeviz),
+    or with profiler="pyinstrument" an html report, if pyinstrument is installed.
+    """
+    if profiler == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            raise Exception("pyinstrument is not installed, pip install pyinstrument or use the cprofile profiler")
+        profile = Profiler()
+        profile.start()
+        try:
+            yield
+        finally:
+            profile.stop()
+            with open(path, "w") as f:
+                f.write(profile.output_html())
+    else:
+        import cProfile
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
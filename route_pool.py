@@ -0,0 +1,201 @@
+import logging
+import time
+import numpy as np
+import utils
+
+
+# the lagrangian step size starts at this and halves when the lower bound stalls for STALL_ITERATIONS
+START_STEP = 2.0
+STALL_ITERATIONS = 20
+MIN_STEP = 1e-3
+# a greedy cover from the current multipliers every this many subgradient iterations
+GREEDY_INTERVAL = 5
+
+
+class RoutePool:
+    """
+    The distinct routes of many solutions, keyed by their set of loads, keeping the shortest order seen
+    for each set. Routes come from feasible solutions, so every one of them is feasible.
+    """
+    def __init__(self, dist_matrix, depot_id=0):
+        self.dist_matrix = dist_matrix
+        self.depot_id = depot_id
+        self.routes = {}
+        self.added = 0
+
+    def __len__(self):
+        return len(self.routes)
+
+    def add_solution(self, schedules):
+        flat, starts, lengths = utils.flatten_schedules(schedules)
+        distances = utils.route_distances(flat, starts, lengths, self.dist_matrix, self.depot_id).tolist()
+        self.add_routes(zip(schedules, distances))
+
+    def add_routes(self, routes):
+        """ Add (schedule, distance) pairs """
+        for schedule, distance in routes:
+            self.added += 1
+            key = frozenset(schedule)
+            seen = self.routes.get(key)
+            if seen is None or distance < seen[1]:
+                self.routes[key] = (list(schedule), distance)
+
+    def items(self):
+        return list(self.routes.values())
+
+
+def select_routes(pool, num_loads, time_limit, incumbent=None):
+    """
+    Set partitioning over the pool: routes that serve every load exactly once at the least
+    500 * drivers + minutes. Uses scipy's MILP solver (HiGHS) if scipy is installed, otherwise
+    lagrangian_cover. incumbent, a solution whose routes are all in the pool, guarantees a feasible
+    answer. Returns the schedules, or None if nothing was found within time_limit seconds.
+    """
+    schedules, distances = zip(*pool.items())
+    route_loads = np.fromiter((load_id for schedule in schedules for load_id in schedule), dtype=np.intp)
+    sizes = np.fromiter(map(len, schedules), dtype=np.intp, count=len(schedules))
+    costs = 500 + np.array(distances)
+    try:
+        from scipy.optimize import milp
+    except ImportError:
+        milp = None
+    if milp is not None:
+        chosen = _milp_partition(milp, route_loads, sizes, costs, num_loads, time_limit)
+    else:
+        chosen = lagrangian_cover(route_loads, sizes, costs, num_loads, time_limit, incumbent_routes(pool, incumbent))
+    if chosen is None:
+        return None
+    return remove_overcover([schedules[r] for r in chosen], pool.dist_matrix, pool.depot_id)
+
+
+def incumbent_routes(pool, incumbent):
+    if incumbent is None:
+        return None
+    index = {key: r for r, key in enumerate(pool.routes)}
+    return np.array([index[frozenset(schedule)] for schedule in incumbent], dtype=np.intp)
+
+
+def _milp_partition(milp, route_loads, sizes, costs, num_loads, time_limit):
+    from scipy.optimize import LinearConstraint
+    from scipy.sparse import csr_matrix
+    columns = np.repeat(np.arange(len(sizes)), sizes)
+    cover = csr_matrix((np.ones(len(route_loads)), (route_loads - 1, columns)), shape=(num_loads, len(sizes)))
+    result = milp(costs, constraints=LinearConstraint(cover, lb=1, ub=1), integrality=np.ones(len(sizes)),
+                  bounds=(0, 1), options={"time_limit": time_limit})
+    if result.x is None:
+        logging.warning(f"Set partitioning found no solution: {result.message}")
+        return None
+    return np.flatnonzero(result.x > 0.5)
+
+
+def lagrangian_cover(route_loads, sizes, costs, num_loads, time_limit, incumbent=None):
+    """
+    Heuristic for the set covering relaxation (every load at least once): subgradient optimization of
+    the lagrangian multipliers of the cover constraints, with a greedy cover priced by the current
+    multipliers every GREEDY_INTERVAL iterations. Routes are in CSR form, route r serving
+    route_loads[starts[r]:starts[r] + sizes[r]]. Returns the indexes of the cheapest cover found.
+    """
+    deadline = time.time() + time_limit
+    starts = np.zeros(len(sizes), dtype=np.intp)
+    np.cumsum(sizes[:-1], out=starts[1:])
+    route_of_entry = np.repeat(np.arange(len(sizes)), sizes)
+    best = incumbent
+    best_cost = costs[incumbent].sum() if incumbent is not None else np.inf
+    # start from each load's cheapest cost per load served
+    multipliers = np.full(num_loads + 1, np.inf)
+    np.minimum.at(multipliers, route_loads, np.repeat(costs / sizes, sizes))
+    multipliers[0] = 0.0
+    multipliers[multipliers == np.inf] = 0.0
+    step = START_STEP
+    best_bound, stalled = -np.inf, 0
+    iteration = 0
+    while time.time() < deadline and step > MIN_STEP:
+        reduced = costs - np.add.reduceat(multipliers[route_loads], starts)
+        chosen = reduced < 0
+        bound = multipliers[1:].sum() + reduced[chosen].sum()
+        if bound > best_bound + 1e-9:
+            best_bound, stalled = bound, 0
+        else:
+            stalled += 1
+            if stalled >= STALL_ITERATIONS:
+                step, stalled = step / 2, 0
+        if iteration % GREEDY_INTERVAL == 0:
+            cover = _greedy_cover(route_loads, starts, sizes, costs, route_of_entry, multipliers, num_loads)
+            cover_cost = costs[cover].sum() if cover is not None else np.inf
+            if cover_cost < best_cost - 1e-9:
+                best, best_cost = cover, cover_cost
+        if best_cost - best_bound < 1e-6:
+            break
+        # cover constraint slack: 1 - times each load is served by the lagrangian solution
+        gradient = 1.0 - np.bincount(route_loads[chosen[route_of_entry]], minlength=num_loads + 1)
+        gradient[0] = 0.0
+        norm = (gradient * gradient).sum()
+        if norm == 0:
+            break
+        # polyak step towards the best cover, or a bit above the bound while there is none
+        target = best_cost if best_cost < np.inf else 1.05 * abs(best_bound) + 1.0
+        multipliers = np.maximum(0.0, multipliers + step * (target - best_bound) / norm * gradient)
+        iteration += 1
+    logging.info(f"Lagrangian cover: {iteration} iterations, cost {best_cost}, lower bound {best_bound}")
+    return best
+
+
+def _greedy_cover(route_loads, starts, sizes, costs, route_of_entry, multipliers, num_loads):
+    """
+    Repeatedly take the route with the least cost, less the multipliers of the uncovered loads it
+    serves, per uncovered load; then drop routes that became redundant, most expensive first. None
+    when some load is in no route.
+    """
+    uncovered = np.ones(num_loads + 1, dtype=bool)
+    uncovered[0] = False
+    taken = []
+    while uncovered.any():
+        fresh = uncovered[route_loads]
+        counts = np.add.reduceat(fresh.astype(np.intp), starts)
+        gain = np.add.reduceat(np.where(fresh, multipliers[route_loads], 0.0), starts)
+        score = np.where(counts > 0, (costs - gain) / np.maximum(counts, 1), np.inf)
+        r = int(np.argmin(score))
+        if score[r] == np.inf:
+            # some load is in no route at all
+            return None
+        taken.append(r)
+        uncovered[route_loads[starts[r]:starts[r] + sizes[r]]] = False
+    taken = np.array(taken, dtype=np.intp)
+    times_covered = np.bincount(route_loads[np.isin(route_of_entry, taken)], minlength=num_loads + 1)
+    keep = np.ones(len(taken), dtype=bool)
+    for idx in np.argsort(-costs[taken], kind='stable'):
+        loads = route_loads[starts[taken[idx]]:starts[taken[idx]] + sizes[taken[idx]]]
+        if (times_covered[loads] > 1).all():
+            keep[idx] = False
+            times_covered[loads] -= 1
+    return taken[keep]
+
+
+def remove_overcover(schedules, dist_matrix, depot_id=0):
+    """
+    A partition from a cover: a load served by several routes stays only in the one where it adds the
+    least distance. Taking a load out never makes a route longer (the triangle inequality holds), so
+    the result is feasible and no more expensive. Emptied routes are dropped.
+    """
+    d = dist_matrix.item
+    schedules = [list(schedule) for schedule in schedules]
+    routes_of = {}
+    for r, schedule in enumerate(schedules):
+        for load_id in schedule:
+            routes_of.setdefault(load_id, []).append(r)
+    for load_id, routes in routes_of.items():
+        if len(routes) == 1:
+            continue
+
+        def removal_saving(r):
+            schedule = schedules[r]
+            k = schedule.index(load_id)
+            prev = schedule[k - 1] if k > 0 else depot_id
+            nxt = schedule[k + 1] if k + 1 < len(schedule) else depot_id
+            return d(prev, load_id) + d(load_id, load_id) + d(load_id, nxt) - d(prev, nxt)
+
+        keep = min(routes, key=removal_saving)
+        for r in routes:
+            if r != keep:
+                schedules[r].remove(load_id)
+    return [schedule for schedule in schedules if schedule]
@@ -0,0 +1,153 @@
+from array import array
+
+
+# endpoint marker for loads that are not on any route yet
+FREE = -1
+
+
+class Routes:
+    """
+    Flat representation of a set of routes over load ids.
+
+    Instead of one object per truck, every load has a successor and predecessor (the depot id at the
+    ends of a route) and the two endpoints of a route point at each other through other_end. The
+    route's distance is kept at its head. That makes the clarke and wright operations O(1):
+    checking whether a load starts or ends a route, extending a route, and joining two routes.
+    The arrays are plain C arrays, so copying a solution (e.g. per restart) is a memcpy.
+    """
+    __slots__ = ('dist_matrix', 'depot_id', 'distance_constraint', 'succ', 'pred', 'other_end', 'distance',
+                 'num_routes')
+
+    def __init__(self, ss, _arrays=None):
+        self.dist_matrix = ss.dist_matrix
+        self.depot_id = ss.depot_id
+        self.distance_constraint = ss.distance_constraint
+        if _arrays is not None:
+            self.succ, self.pred, self.other_end, self.distance, self.num_routes = _arrays
+            return
+        num_loads = len(self.dist_matrix)
+        self.succ = array('l', [self.depot_id]) * num_loads
+        self.pred = array('l', [self.depot_id]) * num_loads
+        self.other_end = array('l', [FREE]) * num_loads
+        self.distance = array('d', [0.0]) * num_loads
+        self.num_routes = 0
+
+    @classmethod
+    def from_schedules(cls, ss, schedules):
+        routes = cls(ss)
+        for schedule in schedules:
+            routes.start_route(schedule[0])
+            for load_id in schedule[1:]:
+                routes.link(routes.other_end[schedule[0]], load_id)
+        return routes
+
+    def copy(self):
+        return Routes(self, (array('l', self.succ), array('l', self.pred), array('l', self.other_end),
+                             array('d', self.distance), self.num_routes))
+
+    def is_free(self, load_id):
+        return self.other_end[load_id] == FREE
+
+    def is_head(self, load_id):
+        return self.pred[load_id] == self.depot_id and self.other_end[load_id] != FREE
+
+    def is_tail(self, load_id):
+        return self.succ[load_id] == self.depot_id and self.other_end[load_id] != FREE
+
+    def single_distance(self, load_id):
+        d = self.dist_matrix.item
+        return d(self.depot_id, load_id) + d(load_id, load_id) + d(load_id, self.depot_id)
+
+    def start_route(self, load_id):
+        """ Put a free load on a route of its own """
+        self.other_end[load_id] = load_id
+        self.succ[load_id] = self.depot_id
+        self.pred[load_id] = self.depot_id
+        self.distance[load_id] = self.single_distance(load_id)
+        self.num_routes += 1
+
+    def linked_distance(self, tail, head):
+        """
+        Distance of the route made by following the route ending at tail with the route starting at head.
+        A free load counts as a route of its own.
+        """
+        d = self.dist_matrix.item
+        first = self.other_end[tail]
+        tail_distance = self.distance[first] if first != FREE else self.single_distance(tail)
+        head_distance = self.distance[head] if self.other_end[head] != FREE else self.single_distance(head)
+        return (tail_distance - d(tail, self.depot_id) + head_distance - d(self.depot_id, head)
+                + d(tail, head))
+
+    def can_link(self, tail, head):
+        return self.linked_distance(tail, head) <= self.distance_constraint
+
+    def link(self, tail, head):
+        """
+        Follow the route ending at tail with the route starting at head. Free loads are put on a route
+        of their own first, so this also covers starting, extending and prepending a route.
+        """
+        new_distance = self.linked_distance(tail, head)
+        if self.other_end[tail] == FREE:
+            self.start_route(tail)
+        if self.other_end[head] == FREE:
+            self.start_route(head)
+        first, last = self.other_end[tail], self.other_end[head]
+        self.succ[tail] = head
+        self.pred[head] = tail
+        self.other_end[first] = last
+        self.other_end[last] = first
+        self.distance[first] = new_distance
+        self.num_routes -= 1
+
+    def split_after(self, load_id):
+        """
+        Cut the route after load_id into two routes. Unlike the operations above this is O(route length):
+        it walks back to the route's head to update other_end, then over both halves for their distances.
+        """
+        next_load_id = self.succ[load_id]
+        if next_load_id == self.depot_id:
+            return
+        first = load_id
+        while self.pred[first] != self.depot_id:
+            first = self.pred[first]
+        last = self.other_end[first]
+        self.succ[load_id] = self.depot_id
+        self.pred[next_load_id] = self.depot_id
+        self.other_end[first] = load_id
+        self.other_end[load_id] = first
+        self.other_end[next_load_id] = last
+        self.other_end[last] = next_load_id
+        self.distance[first] = self.route_distance(first)
+        self.distance[next_load_id] = self.route_distance(next_load_id)
+        self.num_routes += 1
+
+    def route_distance(self, head):
+        """ Distance of the route starting at head, summed leg by leg """
+        d = self.dist_matrix.item
+        distance = 0.0
+        current = self.depot_id
+        load_id = head
+        while load_id != self.depot_id:
+            distance += d(current, load_id) + d(load_id, load_id)
+            current = load_id
+            load_id = self.succ[load_id]
+        return distance + d(current, self.depot_id)
+
+    def heads(self):
+        return [load_id for load_id in range(len(self.succ))
+                if load_id != self.depot_id and self.is_head(load_id)]
+
+    def route(self, head):
+        """ Load ids of the route starting at head, in order """
+        loads = []
+        load_id = head
+        while load_id != self.depot_id:
+            loads.append(load_id)
+            load_id = self.succ[load_id]
+        return loads
+
+    def schedules(self):
+        return [self.route(head) for head in self.heads()]
+
+    def cost(self):
+        return 500 * self.num_routes + sum(self.distance[head] for head in self.heads())
@@ -0,0 +1,179 @@
+import sys
+import argparse
+import hashlib
+import json
+import logging
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import clarke_wright
+import utils
+import main
+
+
+# solver options (argparse dests) a request may set on top of the service defaults. The rest, like
+# --workers, --regions or --memory-budget, are only for whoever starts the service
+REQUEST_OPTIONS = {'time_limit', 'seed', 'local_search_iterations', 'local_search_neighbours', 'best_improvement',
+                   'route_elimination'}
+
+
+class RequestArgumentParser(argparse.ArgumentParser):
+    """ Solver options for one request. Bad options fail the request instead of exiting the process """
+    def error(self, message):
+        raise ValueError(message)
+
+
+class SolverService:
+    """
+    Long lived solver that keeps the imports and recently built problems warm between requests.
+
+    Requests carry a problem in the usual `loadNumber pickup dropoff` format plus optional solver
+    options (main.py flags in REQUEST_OPTIONS) on top of the service defaults. A request's time limit
+    is capped at the default one. Requests are solved in the server's threads, so the defaults can't
+    ask for worker processes. The StaticState of the last few problems is cached by content hash, so
+    re-solving the same problem skips the distance matrix.
+    """
+    def __init__(self, default_args=(), cache_size=32):
+        self.parser = RequestArgumentParser(add_help=False)
+        main.add_solver_arguments(self.parser)
+        self.default_args = list(default_args)
+        # fail at startup rather than on the first request
+        defaults = self.parser.parse_args(self.default_args)
+        if defaults.workers > 1:
+            raise ValueError("the service solves requests in its threads, it can't run --workers processes")
+        self.max_time_limit = defaults.time_limit
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def _static_state(self, problem_str, memory_budget):
+        check_problem_str(problem_str)
+        key = hashlib.sha1(problem_str.encode("utf-8")).hexdigest()
+        with self.lock:
+            ss = self.cache.get(key)
+            if ss is not None:
+                self.cache.move_to_end(key)
+                return ss
+        coordinates = utils.parse_problem_str(problem_str, clarke_wright.DEPOT, 0)
+        ss = clarke_wright.StaticState(coordinates=coordinates, memory_budget=memory_budget)
+        with self.lock:
+            self.cache[key] = ss
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return ss
+
+    def solve(self, problem_str, extra_args=()):
+        """ Returns (solution, cost) for a problem string """
+        start_time = time.time()
+        for arg in extra_args:
+            name = arg.split("=", 1)[0]
+            if name.startswith("--") and name[2:].replace("-", "_") not in REQUEST_OPTIONS:
+                raise ValueError(f"{name} can't be set per request")
+        args = self.parser.parse_args(self.default_args + list(extra_args))
+        args.time_limit = min(args.time_limit, self.max_time_limit)
+        ss = self._static_state(problem_str, main.memory_budget_bytes(args))
+        return main.solve(None, args, start_time, ss=ss)
+
+
+def check_problem_str(problem_str):
+    """ Rejects a problem without the header line or without loads, which would otherwise solve to nothing """
+    lines = problem_str.strip().splitlines()
+    if not lines or lines[0].split()[0][:1].isdigit():
+        raise ValueError("malformed problem: expected a 'loadNumber pickup dropoff' header line first")
+    if len(lines) < 2:
+        raise ValueError("malformed problem: no loads after the header line")
+
+
+def query_to_args(query):
+    """ ?route-elimination&time-limit=5 -> ['--route-elimination', '--time-limit=5'] """
+    args = []
+    for key, value in urllib.parse.parse_qsl(query, keep_blank_values=True):
+        args.append(f"--{key}" if value == "" else f"--{key}={value}")
+    return args
+
+
+def make_handler(service):
+    class SolveHandler(BaseHTTPRequestHandler):
+        """ POST /solve with the problem as the body, solver options as query parameters """
+        def do_GET(self):
+            if urllib.parse.urlsplit(self.path).path == "/health":
+                self._respond(200, "ok\n")
+            else:
+                self._respond(404, "not found\n")
+
+        def do_POST(self):
+            url = urllib.parse.urlsplit(self.path)
+            if url.path != "/solve":
+                self._respond(404, "not found\n")
+                return
+            problem_str = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")
+            try:
+                solution, cost = service.solve(problem_str, query_to_args(url.query))
+            except Exception as e:
+                logging.exception("Failed to solve request")
+                self._respond(400, f"{e}\n")
+                return
+            self._respond(200, main.format_solution(solution), {"X-Solution-Cost": str(cost)})
+
+        def _respond(self, status, body, headers=None):
+            data = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            logging.info("%s - " + format, self.address_string(), *args)
+
+    return SolveHandler
+
+
+def serve_stdin(service, infile=sys.stdin, outfile=sys.stdout):
+    """
+    One JSON request per line: {"id": ..., "problem": "<problem text>", "args": ["--route-elimination"]}.
+    Answers with one line per request: {"id": ..., "solution": "[1, 4, 9]\\n...", "cost": ...} or
+    {"id": ..., "error": "..."}.
+    """
+    for line in infile:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            solution, cost = service.solve(request["problem"], request.get("args", []))
+            response = {"id": request_id, "solution": main.format_solution(solution), "cost": cost}
+        except Exception as e:
+            logging.exception("Failed to solve request")
+            response = {"id": request_id, "error": str(e)}
+        outfile.write(json.dumps(response) + "\n")
+        outfile.flush()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        level=logging.ERROR,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        # stdout carries the responses in --stdin mode
+        handlers=[
+            logging.StreamHandler(sys.stderr)
+        ]
+    )
+    parser = argparse.ArgumentParser(description='Solver service. Any other options are main.py solver options used as defaults for every request')
+    parser.add_argument("--stdin", required=False, action='store_true', help='serve JSON lines on stdin/stdout instead of HTTP')
+    parser.add_argument("--host", required=False, default="127.0.0.1")
+    parser.add_argument("--port", required=False, type=int, default=8765)
+    args, solver_args = parser.parse_known_args()
+
+    service = SolverService(solver_args)
+    if args.stdin:
+        serve_stdin(service)
+    else:
+        httpd = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+        print(f"Serving on http://{args.host}:{args.port}/solve", file=sys.stderr)
+        httpd.serve_forever()
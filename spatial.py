@@ -0,0 +1,77 @@
+import numpy as np
+
+
+class PointGrid:
+    """
+    Uniform grid over a set of points for radius and nearest neighbour queries.
+
+    Points are bucketed by cell and stored sorted by cell key (column major), so every column of a
+    query box is one contiguous slice of the sorted arrays.
+    """
+    def __init__(self, points, ids, cell_size=None):
+        self.points = np.asarray(points, dtype=np.float64)
+        self.ids = np.asarray(ids)
+        if len(self.points) == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.num_rows = 1
+            self.keys = np.zeros(0, dtype=np.intp)
+            return
+
+        self.origin = self.points.min(axis=0)
+        extent = self.points.max(axis=0) - self.origin
+        if cell_size is None:
+            # aim for a couple of points per cell
+            cell_size = max(extent.max(), 1.0) / max(np.sqrt(len(self.points) / 2.0), 1.0)
+        self.cell_size = float(cell_size)
+
+        cells = self._cells(self.points)
+        self.num_rows = int(cells[:, 1].max()) + 1
+        keys = cells[:, 0] * self.num_rows + cells[:, 1]
+        order = np.argsort(keys, kind='stable')
+        self.keys = keys[order]
+        self.points = self.points[order]
+        self.ids = self.ids[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _cells(self, points):
+        return np.floor((points - self.origin) / self.cell_size).astype(np.intp)
+
+    def within(self, point, radius):
+        """ ids and distances of every point within radius of the given point """
+        if len(self) == 0 or radius < 0:
+            return self.ids[:0], np.zeros(0)
+        point = np.asarray(point, dtype=np.float64)
+        low = self._cells(point - radius)
+        high = self._cells(point + radius)
+        low[1] = max(low[1], 0)
+        high[1] = min(high[1], self.num_rows - 1)
+        max_column = self.keys[-1] // self.num_rows
+        slices = []
+        for column in range(max(low[0], 0), min(high[0], max_column) + 1):
+            start, end = np.searchsorted(self.keys, (column * self.num_rows + low[1],
+                                                     column * self.num_rows + high[1] + 1))
+            if start < end:
+                slices.append(np.arange(start, end))
+        if not slices:
+            return self.ids[:0], np.zeros(0)
+        candidates = np.concatenate(slices)
+        diff = self.points[candidates] - point
+        distances = np.sqrt(diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1])
+        close = distances <= radius
+        return self.ids[candidates[close]], distances[close]
+
+    def nearest(self, point, k, max_radius=np.inf):
+        """ ids and distances of the k nearest points to the given point, no further than max_radius """
+        radius = min(self.cell_size, max_radius)
+        while True:
+            ids, distances = self.within(point, radius)
+            if len(ids) >= k or radius >= max_radius or len(ids) == len(self):
+                break
+            radius = min(radius * 2.0, max_radius)
+        if len(ids) > k:
+            closest = np.argpartition(distances, k - 1)[:k]
+            ids, distances = ids[closest], distances[closest]
+        return ids, distances
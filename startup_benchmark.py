@@ -0,0 +1,72 @@
+import sys
+import os
+import json
+import argparse
+import subprocess
+
+
+# modules a plain solve must never pull in at startup
+FORBIDDEN_MODULES = ["matplotlib", "evaluateShared", "subprocess", "multiprocessing"]
+
+
+def measure_imports(cmd):
+    """
+    Runs cmd under `python -X importtime`. Returns ({top level module: cumulative microseconds},
+    set of every module imported)
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime"] + cmd, capture_output=True, text=True, check=True)
+    top_level = {}
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imported.add(name.strip())
+        # nested imports are indented below their parent, only count top level ones
+        if name.startswith(" ") and not name.startswith("  "):
+            top_level[name.strip()] = top_level.get(name.strip(), 0) + int(cumulative)
+    return top_level, imported
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser = argparse.ArgumentParser(description="Cold start import time regression check for main.py")
+    parser.add_argument("--problem", default=os.path.join(here, "training_problems", "problem1.txt"))
+    parser.add_argument("--baseline", default=os.path.join(here, "startup_baseline.json"),
+                        help="json file with the accepted import time, see --update-baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth over the baseline")
+    parser.add_argument("--repeat", type=int, default=5, help="runs to take the fastest of")
+    parser.add_argument("--update-baseline", dest='update_baseline', action='store_true')
+    args = parser.parse_args()
+
+    cmd = [os.path.join(here, "main.py"), args.problem]
+    failures = []
+
+    runs = [measure_imports(cmd) for _ in range(args.repeat)]
+    best, imported = min(runs, key=lambda run: sum(run[0].values()))
+    for module in FORBIDDEN_MODULES:
+        if any(name == module or name.startswith(module + ".") for name in imported):
+            failures.append(f"{module} is imported on the default startup path")
+
+    total_ms = sum(best.values()) / 1000.0
+    print(f"import time: {total_ms:.1f}ms")
+    for name, micros in sorted(best.items(), key=lambda item: -item[1])[:10]:
+        print(f"\t{name}: {micros / 1000.0:.1f}ms")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"import_ms": total_ms}, f, indent=2)
+        print("baseline updated: " + args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline_ms = json.load(f)["import_ms"]
+        allowed_ms = baseline_ms * (1.0 + args.tolerance)
+        print(f"baseline: {baseline_ms:.1f}ms, allowed: {allowed_ms:.1f}ms")
+        if total_ms > allowed_ms:
+            failures.append(f"import time {total_ms:.1f}ms exceeds {allowed_ms:.1f}ms")
+    else:
+        print("no baseline to compare against, run with --update-baseline to record one")
+
+    for failure in failures:
+        print("FAIL: " + failure)
+    sys.exit(1 if failures else 0)
@@ -1,4 +1,6 @@
-from evaluateShared import Point, VRP
+from problem import Point, VRP
+from routes import FREE
+import itertools
 import math
 import numpy as np
 
@@ -9,24 +11,102 @@ def distance(p1: Point, p2: Point):
     return math.sqrt(x_diff*x_diff + y_diff*y_diff)
 
 
-def create_distance_matrix(vrp: VRP, depot: Point, depot_id: int):
+def load_coordinates(vrp: VRP, depot: Point, depot_id: int):
+    """
+    Build the pickup and dropoff coordinate arrays, indexed by load id.
+
+    The depot_id row holds the depot in both arrays, so a load's depot legs fall out of the same
+    dropoff -> pickup computation as the legs between loads.
+    """
     num_loads = len(vrp.loads) + 1
-    distance_matrix = np.zeros((num_loads, num_loads))
-
-    # depot to first load pickup
-    for load in vrp.loads:
-        distance_matrix[depot_id, load.id] = distance(depot, load.pickup)
-    # final load dropoff to depot
-    for load in vrp.loads:
-        distance_matrix[load.id, depot_id] = distance(load.dropoff, depot)
-    # distances to traverse from one load to another
-    for load_i in vrp.loads:
-        for load_j in vrp.loads:
-            # Note that the distance for the load is stored on the diagonal
-            distance_matrix[load_i.id, load_j.id] = distance(load_i.dropoff, load_j.pickup)
+    pickups = np.empty((num_loads, 2))
+    dropoffs = np.empty((num_loads, 2))
+    pickups[depot_id] = (depot.x, depot.y)
+    dropoffs[depot_id] = (depot.x, depot.y)
+    if vrp.loads:
+        ids = np.fromiter((load.id for load in vrp.loads), dtype=np.intp, count=len(vrp.loads))
+        pickups[ids] = [(load.pickup.x, load.pickup.y) for load in vrp.loads]
+        dropoffs[ids] = [(load.dropoff.x, load.dropoff.y) for load in vrp.loads]
+    return pickups, dropoffs
+
+
+# the point brackets and commas of a problem line, turned into whitespace for the bulk number parse
+_PROBLEM_SEPARATORS = str.maketrans("(),", "   ")
+
+
+def parse_problem_str(problem_str: str, depot: Point, depot_id: int):
+    """
+    Bulk parse of a `loadNumber pickup dropoff` problem straight into the pickup and dropoff arrays of
+    load_coordinates, without building a Load per line. The numbers parse to the same floats as
+    problem.loadProblemFromProblemStr.
+    """
+    body = problem_str.split("\n", 1)[1] if "\n" in problem_str else ""
+    values = np.fromstring(body.translate(_PROBLEM_SEPARATORS), sep=" ")
+    if values.size % 5 != 0:
+        raise Exception("malformed problem: expected 'id (x,y) (x,y)' on every line")
+    values = values.reshape(-1, 5)
+    ids = values[:, 0].astype(np.intp)
+    num_loads = len(values) + 1
+    if not np.array_equal(np.sort(ids), np.arange(1, num_loads)):
+        raise Exception(f"malformed problem: load ids should be 1 to {num_loads - 1}")
+    pickups = np.empty((num_loads, 2))
+    dropoffs = np.empty((num_loads, 2))
+    pickups[depot_id] = (depot.x, depot.y)
+    dropoffs[depot_id] = (depot.x, depot.y)
+    pickups[ids] = values[:, 1:3]
+    dropoffs[ids] = values[:, 3:5]
+    return pickups, dropoffs
+
+
+def parse_solution_str(solution_str: str):
+    """ Schedules from the `[1, 4, 9]` per driver lines the solver writes. Empty schedules are skipped """
+    schedules = []
+    for line in solution_str.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        if not (line.startswith("[") and line.endswith("]")):
+            raise Exception(f"malformed solution: expected '[load_id, load_id, ...]' on every line, got: {line}")
+        try:
+            schedule = [int(load_id) for load_id in line[1:-1].split(",") if load_id.strip()]
+        except ValueError:
+            raise Exception(f"malformed solution: load ids should be integers, got: {line}")
+        if schedule:
+            schedules.append(schedule)
+    return schedules
+
+
+def fill_distance_rows(pickups, dropoffs, rows: slice, out):
+    """ Write the dropoff -> pickup distances for the given rows into out """
+    dx = dropoffs[rows, 0, np.newaxis] - pickups[np.newaxis, :, 0]
+    dy = dropoffs[rows, 1, np.newaxis] - pickups[np.newaxis, :, 1]
+    # sqrt(dx*dx + dy*dy) rather than hypot keeps the values bit-identical to distance()
+    out[...] = np.sqrt(dx*dx + dy*dy)
+
+
+def create_distance_matrix_from_coordinates(pickups, dropoffs, dtype=np.float64, block_elements=1 << 22, out=None):
+    """
+    Distance matrix where entry [i, j] is the drive from the dropoff of i to the pickup of j.
+
+    With the depot stored at the depot_id row (see load_coordinates) this gives the depot legs on the
+    depot row/column and the load distances on the diagonal. Rows are computed in blocks so the
+    float64 temporaries stay bounded, which also lets a float32 matrix halve the resident memory.
+    The matrix is written into out, an (n, n) array, if one is given.
+    """
+    num_loads = len(pickups)
+    distance_matrix = np.empty((num_loads, num_loads), dtype=dtype) if out is None else out
+    block_rows = max(1, block_elements // max(1, num_loads))
+    for start in range(0, num_loads, block_rows):
+        rows = slice(start, min(start + block_rows, num_loads))
+        fill_distance_rows(pickups, dropoffs, rows, distance_matrix[rows])
     return distance_matrix
 
 
+def create_distance_matrix(vrp: VRP, depot: Point, depot_id: int, dtype=np.float64):
+    pickups, dropoffs = load_coordinates(vrp, depot, depot_id)
+    return create_distance_matrix_from_coordinates(pickups, dropoffs, dtype=dtype)
+
+
 def get_schedule_distance(schedule: list[int], distance_matrix):
     distance = 0.0
     depot = 0
@@ -41,15 +121,122 @@ def get_schedule_distance(schedule: list[int], distance_matrix):
     return distance
 
 
-def get_solution_cost(schedules: list[list[int]], distance_matrix, expected_loads):
-    total_driven_minutes = 0.0
-    total_loads = 0
-    for idx, schedule in enumerate(schedules):
-        total_loads += len(schedule)
-        schedule_minutes = get_schedule_distance(schedule, distance_matrix)
-        if schedule_minutes > 12 * 60:
-            raise Exception("schedule idx " + str(idx) + " is invalid: driver runs for " + str(schedule_minutes) + " minutes")
-        total_driven_minutes += schedule_minutes
-    if total_loads != expected_loads:
-        raise Exception(f"Should have {expected_loads}, got: {total_loads}!!")
-    return 500 * len(schedules) + total_driven_minutes
+def flatten_schedules(schedules):
+    """ All schedules as one load id array, plus the start offset and length of every route in it """
+    lengths = np.fromiter(map(len, schedules), dtype=np.intp, count=len(schedules))
+    flat = np.fromiter(itertools.chain.from_iterable(schedules), dtype=np.intp, count=int(lengths.sum()))
+    starts = np.zeros(len(schedules), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    return flat, starts, lengths
+
+
+def route_distances(flat, starts, lengths, distance_matrix, depot_id=0):
+    """
+    Distance of every route of flatten_schedules, with one gather per leg type instead of a Python loop
+    per load. The legs of a route are added in driving order like get_schedule_distance, so the
+    distances match it exactly: all routes take their k-th load at once, longest routes first.
+    """
+    distances = np.zeros(len(starts))
+    if len(flat) == 0:
+        return distances
+    prev = np.empty_like(flat)
+    prev[1:] = flat[:-1]
+    prev[starts[lengths > 0]] = depot_id
+    to_pickup = distance_matrix[prev, flat]
+    own = distance_matrix[flat, flat]
+
+    order = np.argsort(-lengths, kind='stable')
+    sorted_starts = starts[order]
+    negated_lengths = -lengths[order]
+    totals = np.zeros(len(starts))
+    for k in range(lengths.max()):
+        # routes with more than k loads are a prefix of the longest first order
+        active = np.searchsorted(negated_lengths, -k, side='left')
+        legs = sorted_starts[:active] + k
+        totals[:active] += to_pickup[legs]
+        totals[:active] += own[legs]
+    last = np.where(lengths > 0, flat[np.maximum(starts + lengths - 1, 0)], depot_id)
+    distances[order] = totals
+    distances += distance_matrix[last, depot_id]
+    return distances
+
+
+def assignment_errors(flat, num_loads, depot_id=0):
+    """ Every unknown, duplicated and unassigned load id of a flat solution, as messages """
+    errors = []
+    known = (flat >= 0) & (flat <= num_loads) & (flat != depot_id)
+    if not known.all():
+        errors.append(f"unknown load ids: {flat[~known].tolist()}")
+    counts = np.bincount(flat[known], minlength=num_loads + 1)
+    counts[depot_id] = 1
+    if (counts > 1).any():
+        errors.append(f"loads in at least two driver schedules: {np.flatnonzero(counts > 1).tolist()}")
+    if (counts == 0).any():
+        errors.append(f"loads not assigned to a driver: {np.flatnonzero(counts == 0).tolist()}")
+    return errors
+
+
+def get_solution_cost(schedules: list[list[int]], distance_matrix, expected_loads, distance_constraint=12 * 60):
+    """ Cost of the schedules. Raises with every assignment error and infeasible schedule at once """
+    flat, starts, lengths = flatten_schedules(schedules)
+    return _flat_solution_cost(flat, starts, lengths, distance_matrix, expected_loads, distance_constraint)
+
+
+def _flat_solution_cost(flat, starts, lengths, distance_matrix, expected_loads, distance_constraint):
+    errors = assignment_errors(flat, expected_loads)
+    if len(flat) != expected_loads:
+        errors.append(f"Should have {expected_loads}, got: {len(flat)}!!")
+    if errors:
+        raise Exception("; ".join(errors))
+    distances = route_distances(flat, starts, lengths, distance_matrix)
+    infeasible = np.flatnonzero(distances > distance_constraint)
+    if len(infeasible):
+        raise Exception("; ".join("schedule idx " + str(idx) + " is invalid: driver runs for " + str(distances[idx]) + " minutes"
+                                  for idx in infeasible))
+    return 500 * len(starts) + sum(distances.tolist())
+
+
+def flatten_routes(routes):
+    """
+    flatten_schedules for a routes.Routes, in the order of routes.schedules() but without walking the
+    routes load by load: every load's route head and position are found by pointer jumping on pred, so
+    it takes log(route length) vectorized steps.
+    """
+    depot_id = routes.depot_id
+    pred = np.frombuffer(routes.pred, dtype='l').astype(np.intp)
+    assigned = np.frombuffer(routes.other_end, dtype='l') != FREE
+    assigned[depot_id] = False
+    load_ids = np.arange(len(pred))
+    # jump points at the load `position` steps back, head at the furthest known load towards the head
+    head = np.where(assigned & (pred != depot_id), pred, load_ids)
+    position = (head != load_ids).astype(np.intp)
+    jump = head.copy()
+    for _ in range(len(pred).bit_length() + 1):
+        if (position[jump] == 0).all():
+            break
+        position += position[jump]
+        jump = jump[jump]
+        head = head[head]
+    else:
+        raise Exception("routes are not linked lists from the depot: found a cycle")
+    head = head[jump]
+
+    heads = np.flatnonzero(assigned & (pred == depot_id))
+    route_index = np.full(len(pred), len(heads))
+    route_index[heads] = np.arange(len(heads))
+    members = np.flatnonzero(assigned)
+    member_routes = route_index[head[members]]
+    if (member_routes == len(heads)).any():
+        raise Exception(f"loads not on a route from the depot: {members[member_routes == len(heads)].tolist()}")
+    lengths = np.bincount(member_routes, minlength=len(heads)).astype(np.intp)
+    starts = np.zeros(len(heads), dtype=np.intp)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    flat = np.empty(len(members), dtype=np.intp)
+    flat[starts[member_routes] + position[members]] = members
+    return flat, starts, lengths
+
+
+def get_routes_cost(routes, expected_loads):
+    """ Same as get_solution_cost for a routes.Routes """
+    flat, starts, lengths = flatten_routes(routes)
+    return _flat_solution_cost(flat, starts, lengths, routes.dist_matrix, expected_loads, routes.distance_constraint)
@@ -1,38 +1,149 @@
-from evaluateShared import Load
-import matplotlib.pyplot as plt
-import matplotlib.cm as cm
-from numpy import linspace
+import numpy as np
+from problem import Load
 
 
-def visualize(loads: list[Load], solution: list[list[int]]):
-    pickup_coords = [(load.pickup.x, load.pickup.y, load.id) for load in loads]
-    dropoff_coords = [(load.dropoff.x, load.dropoff.y) for load in loads]
+# load ids are written next to the pickups only up to this many drawn loads, past that they are noise
+LABEL_LIMIT = 60
 
-    pickup_xs, pickup_ys, pickup_ids = zip(*pickup_coords)
-    dropoff_xs, dropoff_ys = zip(*dropoff_coords)
 
-    plt.figure(figsize=(10, 6))
-    plt.scatter([0], [0], color='teal', label='Depot')
+def _pyplot(path):
+    """ pyplot, on the non-interactive Agg backend when the figure goes to a file """
+    import matplotlib
+    if path is not None:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    return plt
 
-    plt.scatter(pickup_xs, pickup_ys, color='blue', label='Pickup')
-    plt.scatter(dropoff_xs, dropoff_ys, color='red', label='Dropoff')
 
-    num_trucks = len(solution)
+def sample_routes(solution, max_routes, seed=0):
+    """ Indexes of at most max_routes routes of solution, picked at random but repeatably, in order """
+    if max_routes is None or len(solution) <= max_routes:
+        return np.arange(len(solution))
+    return np.sort(np.random.default_rng(seed).choice(len(solution), max_routes, replace=False))
 
-    cm_subsection = linspace(0.0, 1.0, num_trucks)
-    colors = [cm.jet(x) for x in cm_subsection]
 
-    for i, schedule in enumerate(solution):
-        truck_color = colors[i]
-        for j in range(len(schedule)):
-            load_idx = schedule[j] - 1
-            plt.arrow(pickup_coords[load_idx][0], pickup_coords[load_idx][1], dropoff_coords[load_idx][0] - pickup_coords[load_idx][0], dropoff_coords[load_idx][1] - pickup_coords[load_idx][1],
-                      head_width=4, head_length=2, fc=truck_color, ec=truck_color)
-            plt.text(pickup_coords[load_idx][0], pickup_coords[load_idx][1], str(load_idx+1), fontsize=12, ha='right')
+def route_segments(pickups, dropoffs, solution, depot_legs=False, depot_id=0):
+    """
+    The legs of solution as (N, 2, 2) arrays of from/to points, with the route index of each: loads
+    (pickup to dropoff), the deadheads between consecutive loads, and with depot_legs the legs out of
+    and back to the depot.
+    """
+    flat = np.fromiter((load_id for schedule in solution for load_id in schedule), dtype=np.intp)
+    lengths = np.fromiter(map(len, solution), dtype=np.intp, count=len(solution))
+    route_of = np.repeat(np.arange(len(solution)), lengths)
+    ends = np.cumsum(lengths)
+    starts = ends - lengths
+    loads = np.stack([pickups[flat], dropoffs[flat]], axis=1)
+    # every load but a route's last is followed by another one of the same route
+    follows = np.ones(len(flat), dtype=bool)
+    follows[ends[lengths > 0] - 1] = False
+    nxt = np.flatnonzero(follows)
+    deadheads = np.stack([dropoffs[flat[nxt]], pickups[flat[nxt + 1]]], axis=1)
+    segments = {'loads': (loads, route_of), 'deadheads': (deadheads, route_of[nxt])}
+    if depot_legs:
+        used = np.flatnonzero(lengths > 0)
+        depot = np.broadcast_to(dropoffs[depot_id], (len(used), 2))
+        out = np.stack([depot, pickups[flat[starts[used]]]], axis=1)
+        back = np.stack([dropoffs[flat[ends[used] - 1]], depot], axis=1)
+        segments['depot'] = (np.concatenate([out, back]), np.concatenate([used, used]))
+    return segments
 
-    plt.title('VRPPD Visualization')
-    plt.xlabel('X')
-    plt.ylabel('Y')
-    plt.legend()
-    plt.grid(True)
-    plt.show()
+
+def _draw_routes(ax, pickups, dropoffs, solution, colors, depot_legs, alpha=1.0, depot_id=0):
+    """ All legs of solution in three collections, a quiver for the loads and line collections for the rest """
+    from matplotlib.collections import LineCollection
+    segments = route_segments(pickups, dropoffs, solution, depot_legs, depot_id)
+    loads, route_of = segments['loads']
+    ax.quiver(loads[:, 0, 0], loads[:, 0, 1], loads[:, 1, 0] - loads[:, 0, 0], loads[:, 1, 1] - loads[:, 0, 1],
+              color=colors[route_of], angles='xy', scale_units='xy', scale=1, width=0.002, alpha=alpha)
+    deadheads, route_of = segments['deadheads']
+    ax.add_collection(LineCollection(deadheads, colors=colors[route_of], linewidths=0.6, linestyles='dashed',
+                                     alpha=0.6 * alpha))
+    if depot_legs:
+        legs, route_of = segments['depot']
+        ax.add_collection(LineCollection(legs, colors=colors[route_of], linewidths=0.4, linestyles='dotted',
+                                         alpha=0.4 * alpha))
+
+
+def _finish(plt, fig, ax, title, path):
+    ax.set_title(title)
+    ax.set_xlabel('X')
+    ax.set_ylabel('Y')
+    ax.autoscale_view()
+    ax.legend(loc='upper right')
+    ax.grid(True)
+    if path is None:
+        plt.show()
+    else:
+        # the format follows the extension: png, svg, pdf
+        fig.savefig(path, dpi=150, bbox_inches='tight')
+        plt.close(fig)
+
+
+def plot_solution(pickups, dropoffs, solution, path=None, max_routes=None, depot_legs=False, seed=0,
+                  title='VRPPD Visualization', depot_id=0):
+    """
+    Draw solution over the pickup and dropoff coordinate arrays (indexed by load id, the depot at
+    depot_id, as in clarke_wright.StaticState). Every leg goes into one quiver or line collection call,
+    so thousands of loads render in about a second. max_routes draws a random sample of the routes, the
+    loads of the others stay as faint points. Shows the plot, or saves it to path without a display.
+    """
+    plt = _pyplot(path)
+    shown = sample_routes(solution, max_routes, seed)
+    routes = [solution[r] for r in shown]
+    colors = plt.get_cmap('jet')(np.linspace(0.0, 1.0, max(len(routes), 1)))
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.scatter(pickups[1:, 0], pickups[1:, 1], color='blue', s=4, alpha=0.15 if len(routes) < len(solution) else 0.6,
+               label='Pickup')
+    ax.scatter(dropoffs[1:, 0], dropoffs[1:, 1], color='red', s=4, alpha=0.15 if len(routes) < len(solution) else 0.6,
+               label='Dropoff')
+    ax.scatter([dropoffs[depot_id, 0]], [dropoffs[depot_id, 1]], color='teal', s=40, label='Depot', zorder=3)
+    _draw_routes(ax, pickups, dropoffs, routes, colors, depot_legs, depot_id=depot_id)
+
+    drawn = [load_id for schedule in routes for load_id in schedule]
+    if len(drawn) <= LABEL_LIMIT:
+        for load_id in drawn:
+            ax.text(pickups[load_id, 0], pickups[load_id, 1], str(load_id), fontsize=9, ha='right')
+    if len(routes) < len(solution):
+        title = f"{title} ({len(routes)} of {len(solution)} routes)"
+    _finish(plt, fig, ax, title, path)
+
+
+def changed_routes(before, after):
+    """ The routes only in before and the routes only in after, comparing the load order of each route """
+    before_keys = {tuple(schedule) for schedule in before}
+    after_keys = {tuple(schedule) for schedule in after}
+    return ([schedule for schedule in before if tuple(schedule) not in after_keys],
+            [schedule for schedule in after if tuple(schedule) not in before_keys])
+
+
+def plot_changes(pickups, dropoffs, before, after, path=None, depot_legs=False, title='Changed routes',
+                 depot_id=0):
+    """
+    Draw only the routes that differ between two solutions of the same problem: the dropped ones in
+    grey, the new ones in colour, over faint points for every load.
+    """
+    plt = _pyplot(path)
+    removed, added = changed_routes(before, after)
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.scatter(pickups[1:, 0], pickups[1:, 1], color='blue', s=4, alpha=0.15, label='Pickup')
+    ax.scatter(dropoffs[1:, 0], dropoffs[1:, 1], color='red', s=4, alpha=0.15, label='Dropoff')
+    ax.scatter([dropoffs[depot_id, 0]], [dropoffs[depot_id, 1]], color='teal', s=40, label='Depot', zorder=3)
+    if removed:
+        grey = np.tile(np.array([[0.5, 0.5, 0.5, 1.0]]), (len(removed), 1))
+        _draw_routes(ax, pickups, dropoffs, removed, grey, depot_legs, alpha=0.5, depot_id=depot_id)
+    if added:
+        colors = plt.get_cmap('jet')(np.linspace(0.0, 1.0, len(added)))
+        _draw_routes(ax, pickups, dropoffs, added, colors, depot_legs, depot_id=depot_id)
+    _finish(plt, fig, ax, f"{title}: {len(removed)} routes out, {len(added)} in", path)
+
+
+def visualize(loads: list[Load], solution: list[list[int]], path=None, **kwargs):
+    """ plot_solution for a list of Loads with int ids, see main.prepare_problem """
+    size = max((load.id for load in loads), default=0) + 1
+    pickups, dropoffs = np.zeros((size, 2)), np.zeros((size, 2))
+    for load in loads:
+        pickups[load.id] = load.pickup.x, load.pickup.y
+        dropoffs[load.id] = load.dropoff.x, load.dropoff.y
+    plot_solution(pickups, dropoffs, solution, path=path, **kwargs)